@@ -0,0 +1,365 @@
+import json
+import os
+from statistics import NormalDist
+
+import numpy as np
+import pandas as pd
+
+from pp_toy_model import InputPlan
+from batch_powerflow import BatchPowerFlow, run_batch
+from result_store import result_logger
+from simulations import iter_time_series
+
+__all__ = ['StreamingStats',
+           'QuantileSketch',
+           'AdaptiveSampler']
+
+# Files of an adaptive run, next to its results
+STATE_FILE = 'adaptive_state.json'
+SUMMARY_FILE = 'adaptive_summary.json'
+
+class StreamingStats:
+    """Mean and variance of several quantities, updated batch by batch.
+
+    Batches are merged with the parallel form of Welford's algorithm, so
+    the estimates are numerically stable for any number of steps. NaN
+    values, e.g. of steps that did not converge, are not counted.
+    """
+
+    def __init__(self, n_columns):
+        self.count = np.zeros(n_columns)
+        self.mean = np.zeros(n_columns)
+        self.m2 = np.zeros(n_columns)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        valid = ~np.isnan(values)
+        n_batch = valid.sum(axis=0)
+        mean_batch = (np.where(valid, values, 0.).sum(axis=0)
+                      / np.maximum(n_batch, 1))
+        m2_batch = np.where(valid, values - mean_batch, 0.)
+        m2_batch = (m2_batch**2).sum(axis=0)
+
+        # Merge batch moments into the running moments
+        count = self.count + n_batch
+        delta = mean_batch - self.mean
+        weight = n_batch/np.maximum(count, 1)
+        self.mean = self.mean + delta*weight
+        self.m2 = self.m2 + m2_batch + delta**2*self.count*weight
+        self.count = count
+
+    @property
+    def variance(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 1, self.m2/(self.count - 1), np.nan)
+
+    def ci_half_width(self, confidence=0.95):
+        """Half width of the normal confidence interval of the mean."""
+        z = NormalDist().inv_cdf(0.5 + confidence/2)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return z*np.sqrt(self.variance/self.count)
+
+    def state(self):
+        return {'count': self.count.tolist(),
+                'mean': self.mean.tolist(),
+                'm2': self.m2.tolist()}
+
+    def load_state(self, state):
+        self.count = np.array(state['count'], dtype=float)
+        self.mean = np.array(state['mean'], dtype=float)
+        self.m2 = np.array(state['m2'], dtype=float)
+
+class QuantileSketch:
+    """Quantile estimates of several quantities in bounded memory.
+
+    A merging digest: values are kept as weighted centroids, compressed
+    after every batch to at most `compression` centroids per quantity.
+    Centroids are narrow near the tails, so extreme quantiles stay
+    accurate; the minimum and maximum are exact.
+    """
+
+    def __init__(self, n_columns, compression=200):
+        self.compression = compression
+        self.means = [np.empty(0) for _ in range(n_columns)]
+        self.weights = [np.empty(0) for _ in range(n_columns)]
+        self.min = np.full(n_columns, np.nan)
+        self.max = np.full(n_columns, np.nan)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        for j in range(values.shape[1]):
+            x = values[:, j][~np.isnan(values[:, j])]
+            if len(x) == 0:
+                continue
+            self.min[j] = np.fmin(self.min[j], x.min())
+            self.max[j] = np.fmax(self.max[j], x.max())
+            self.means[j], self.weights[j] = self._compress(
+                np.concatenate([self.means[j], x]),
+                np.concatenate([self.weights[j], np.ones(len(x))]))
+
+    def _compress(self, means, weights):
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+        cum = np.cumsum(weights)
+        q_mid = (cum - weights/2)/cum[-1]
+
+        # Arcsine scale: equal steps in k are narrow in q near 0 and 1
+        k = np.floor(self.compression*(np.arcsin(2*q_mid - 1)/np.pi + 0.5))
+        _, cluster = np.unique(k, return_inverse=True)
+        weight = np.bincount(cluster, weights)
+        mean = np.bincount(cluster, weights*means)/weight
+        return mean, weight
+
+    def quantile(self, q):
+        """Estimates of quantile(s) `q`, shape (len(q), columns)."""
+        q = np.atleast_1d(q)
+        estimates = np.full((len(q), len(self.means)), np.nan)
+        for (j, (means, weights)) in enumerate(zip(self.means,
+                                                   self.weights)):
+            if len(means) == 0:
+                continue
+            cum = np.cumsum(weights)
+            positions = np.concatenate([[0.], cum - weights/2, [cum[-1]]])
+            points = np.concatenate([[self.min[j]], means, [self.max[j]]])
+            estimates[:, j] = np.interp(q*cum[-1], positions, points)
+        return estimates
+
+    def state(self):
+        return {'compression': self.compression,
+                'means': [m.tolist() for m in self.means],
+                'weights': [w.tolist() for w in self.weights],
+                'min': self.min.tolist(),
+                'max': self.max.tolist()}
+
+    def load_state(self, state):
+        self.compression = state['compression']
+        self.means = [np.array(m, dtype=float) for m in state['means']]
+        self.weights = [np.array(w, dtype=float) for w in state['weights']]
+        self.min = np.array(state['min'], dtype=float)
+        self.max = np.array(state['max'], dtype=float)
+
+class AdaptiveSampler:
+    """Samples noise scenarios in batches until the metrics converge.
+
+    Every batch draws `batch_size` noisy profiles with
+    `simulations.iter_time_series`, which follows the distribution of
+    `metrics.apply_load_gen_noise`, and evaluates the metrics on them.
+    Streaming means, variances and quantile sketches of every metric are
+    updated after each batch. Sampling stops once the confidence interval
+    of every metric mean is narrower than the target width, or after
+    `max_steps` steps.
+
+    The estimator state and the random generator state are saved to
+    `path` after every batch, so an interrupted run resumes where it
+    stopped and draws the same scenarios as an uninterrupted one.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the run; results, state and summary are written here.
+    base_yaml : str
+        Base profile in the format of `eq_yaml_parser`.
+    net : pandapowerNet
+        Network object from `create_toy_model`.
+    metrics : list
+        Output of `metrics.create_metrics`.
+    batch_size : int
+        Number of steps per batch.
+    target_width : float
+        Target full width of the confidence interval of each metric mean.
+    relative : bool
+        Whether `target_width` is relative to the absolute metric mean.
+    confidence : float
+        Confidence level of the intervals.
+    min_steps, max_steps : int
+        Bounds on the number of steps.
+    quantiles : tuple of float
+        Quantiles reported in the estimates.
+    rng : numpy.random.Generator or int, optional
+        Random generator or seed of a new run.
+    mode : str
+        'dc' or 'ac' for the batched power flow of `batch_powerflow`.
+    simulation_step_func : callable, optional
+        Step function (net, metrics) -> Series, as for `run_simulations`.
+        If given, steps are evaluated one by one with it instead of the
+        batched power flow.
+    log_results : bool
+        Write the metric values of every step to the results of `path`.
+    backend : str
+        Result backend, a key of `result_store.RESULT_BACKENDS`.
+    **noise_kwargs
+        Passed on to `metrics.sample_load_gen_noise`.
+    """
+
+    def __init__(self, path, base_yaml, net, metrics, batch_size=1000,
+                 target_width=0.01, relative=True, confidence=0.95,
+                 min_steps=1000, max_steps=1000000,
+                 quantiles=(0.05, 0.5, 0.95), rng=None, mode='dc',
+                 simulation_step_func=None, log_results=True,
+                 backend='csv', **noise_kwargs):
+        self.path = path
+        self.base_yaml = base_yaml
+        self.net = net
+        self.metrics = metrics
+        self.names = [name for (name, _) in metrics]
+        self.batch_size = batch_size
+        self.target_width = target_width
+        self.relative = relative
+        self.confidence = confidence
+        self.min_steps = min_steps
+        self.max_steps = max_steps
+        self.quantiles = quantiles
+        self.mode = mode
+        self.simulation_step_func = simulation_step_func
+        self.log_results = log_results
+        self.backend = backend
+        self.noise_kwargs = noise_kwargs
+        self.solver = None
+
+        self.rng = np.random.default_rng(rng)
+        self.stats = StreamingStats(len(self.names))
+        self.sketch = QuantileSketch(len(self.names))
+        self.steps = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        if os.path.isfile(path + STATE_FILE):
+            self._load_state()
+
+    def _load_state(self):
+        with open(self.path + STATE_FILE, 'r') as state_file:
+            state = json.load(state_file)
+        if state['metrics'] != self.names:
+            raise ValueError(f'{self.path} holds a run of the metrics '
+                             f'{state["metrics"]}.')
+        self.steps = state['steps']
+        self.batch_size = state['batch_size']
+        self.rng.bit_generator.state = state['rng']
+        self.stats.load_state(state['stats'])
+        self.sketch.load_state(state['sketch'])
+
+    def _save_state(self):
+        state = {'metrics': self.names,
+                 'steps': self.steps,
+                 'batch_size': self.batch_size,
+                 'rng': self.rng.bit_generator.state,
+                 'stats': self.stats.state(),
+                 'sketch': self.sketch.state()}
+
+        # Replace atomically so a killed run never leaves a broken state
+        with open(self.path + STATE_FILE + '.tmp', 'w') as state_file:
+            json.dump(state, state_file)
+        os.replace(self.path + STATE_FILE + '.tmp', self.path + STATE_FILE)
+
+    def widths(self):
+        """Full confidence interval widths of the metric means."""
+        return 2*self.stats.ci_half_width(self.confidence)
+
+    def converged(self):
+        if self.steps < self.min_steps:
+            return False
+        target = self.target_width
+        if self.relative:
+            target = target*np.abs(self.stats.mean)
+        return bool(np.all(self.widths() <= target))
+
+    def _batch(self, n_steps):
+        eq_frame_dict = next(iter_time_series(
+            self.base_yaml, self.net, n_steps, chunk_size=n_steps,
+            rng=self.rng, **self.noise_kwargs))
+        steps = range(self.steps, self.steps + n_steps)
+        for eq_frame in eq_frame_dict.values():
+            eq_frame.index = pd.RangeIndex(steps.start, steps.stop)
+
+        # Evaluate step by step with the step function
+        if self.simulation_step_func is not None:
+            plan = InputPlan(self.net, eq_frame_dict)
+            rows = []
+            for n in steps:
+                plan.apply(self.net, n)
+                rows.append(self.simulation_step_func(self.net,
+                                                      self.metrics))
+            return pd.DataFrame(rows, index=steps)[self.names]
+
+        # Evaluate in one batch, with the solver built once per run
+        if self.solver is None:
+            self.solver = BatchPowerFlow(self.net)
+        return pd.concat(run_batch(self.net, self.metrics, eq_frame_dict,
+                                   steps, mode=self.mode,
+                                   chunk_size=n_steps, solver=self.solver))
+
+    def run(self, progress_bar=None):
+        """Sample batches until convergence or `max_steps`.
+
+        Returns
+        -------
+        estimates : DataFrame
+            See `estimates`.
+        """
+        with result_logger(self.path, backend=self.backend) as l:
+            while not self.converged() and self.steps < self.max_steps:
+                n_steps = min(self.batch_size, self.max_steps - self.steps)
+                res_frame = self._batch(n_steps)
+
+                # Results of a batch logged before an interruption are kept
+                # on disk, but the statistics count the whole batch
+                if self.log_results:
+                    if not l.header:
+                        l.write_header(res_frame.columns)
+                    if l.last_run is not None:
+                        l.write_frame(res_frame.loc[l.last_run + 1:])
+                    else:
+                        l.write_frame(res_frame)
+
+                values = res_frame.reindex(range(self.steps,
+                                                 self.steps + n_steps))
+                self.stats.update(values[self.names].values)
+                self.sketch.update(values[self.names].values)
+                self.steps += n_steps
+
+                # Results are on disk before the state that counts them
+                l.flush()
+                self._save_state()
+                if progress_bar is not None:
+                    progress_bar(self)
+
+        estimates = self.estimates()
+        with open(self.path + SUMMARY_FILE, 'w') as summary_file:
+            json.dump(self.summary(estimates), summary_file, indent=2)
+        return estimates
+
+    def estimates(self):
+        """Current estimates, one row per metric.
+
+        Columns are the number of valid steps, mean, standard deviation,
+        the confidence interval of the mean and its width, and the
+        quantiles as 'q{percent}'.
+        """
+        half_width = self.stats.ci_half_width(self.confidence)
+        estimates = pd.DataFrame({'count': self.stats.count,
+                                  'mean': self.stats.mean,
+                                  'std': np.sqrt(self.stats.variance),
+                                  'ci_low': self.stats.mean - half_width,
+                                  'ci_high': self.stats.mean + half_width,
+                                  'ci_width': 2*half_width},
+                                 index=pd.Index(self.names, name='metric'))
+        for (q, values) in zip(self.quantiles,
+                               self.sketch.quantile(self.quantiles)):
+            estimates[f'q{100*q:g}'] = values
+        return estimates
+
+    def summary(self, estimates=None):
+        """Steps run and saved, convergence and estimates as a dict.
+
+        `steps_saved` is `max_steps - steps`, the steps that convergence
+        saved over a run of `max_steps`.
+        """
+        if estimates is None:
+            estimates = self.estimates()
+        return {'steps': self.steps,
+                'max_steps': self.max_steps,
+                'steps_saved': self.max_steps - self.steps,
+                'converged': self.converged(),
+                'target_width': self.target_width,
+                'relative': self.relative,
+                'confidence': self.confidence,
+                'estimates': json.loads(estimates.to_json(orient='index'))}
@@ -0,0 +1,485 @@
+import numpy as np
+import pandas as pd
+
+__all__ = ['BatchPowerFlow',
+           'run_batch',
+           'batch_metrics',
+           'compare_to_pandapower']
+
+SQRT3 = np.sqrt(3)
+
+class BatchPowerFlow:
+    """Vectorized DC and AC power flow for a fixed network topology.
+
+    The admittance matrix and all element-to-bus mappings are built once
+    from a Pandapower network. Afterwards, any number of injection
+    scenarios can be solved at once: the DC power flow as one matrix
+    product, the AC power flow as a batched Newton-Raphson iteration.
+
+    Only buses, lines, loads, generators and external grids are taken into
+    account, which covers everything `create_toy_model` generates. Element
+    and line states (in service, parameters) are read at construction time;
+    create a new instance after changing the topology.
+
+    Parameters
+    ----------
+    net : pandapowerNet
+        Network object, e.g. from `pp_toy_model.create_toy_model`.
+    """
+
+    def __init__(self, net):
+        self.net = net
+        self.sn_mva = float(net.sn_mva)
+        self.f_hz = float(net.f_hz)
+
+        # Bus positions of in-service buses
+        bus = net.bus
+        self.bus_index = bus.index[bus['in_service'].values.astype(bool)]
+        self.n_bus = len(self.bus_index)
+        bus_lookup = pd.Series(np.arange(self.n_bus), index=self.bus_index)
+        self.vn_kv = bus.loc[self.bus_index, 'vn_kv'].values.astype(float)
+
+        # Line admittances in per unit, out-of-service lines excluded
+        line = net.line
+        line_on = (line['in_service'].values.astype(bool)
+                   & line['from_bus'].isin(self.bus_index).values
+                   & line['to_bus'].isin(self.bus_index).values)
+        self.line_index = line.index
+        self.line_on = line_on
+        on = line.loc[line_on]
+        self.f = bus_lookup[on['from_bus']].values
+        self.t = bus_lookup[on['to_bus']].values
+
+        length = on['length_km'].values
+        parallel = on['parallel'].values
+        z_base = self.vn_kv[self.f]**2 / self.sn_mva
+        r_pu = on['r_ohm_per_km'].values*length/parallel/z_base
+        x_pu = on['x_ohm_per_km'].values*length/parallel/z_base
+        b_pu = (2*np.pi*self.f_hz*on['c_nf_per_km'].values*1e-9
+                *length*parallel*z_base)
+        g_us = on['g_us_per_km'].values if 'g_us_per_km' in on else 0.
+        g_pu = g_us*1e-6*length*parallel*z_base
+        self.x_pu = x_pu
+
+        y_series = 1/(r_pu + 1j*x_pu)
+        y_shunt = (g_pu + 1j*b_pu)/2
+        self.y_ff = y_series + y_shunt
+        self.y_ft = -y_series
+        self.y_tf = -y_series
+        self.y_tt = y_series + y_shunt
+
+        # Dense bus admittance matrix; the toy grids have tens of buses
+        n = self.n_bus
+        self.y_bus = np.zeros((n, n), dtype=complex)
+        np.add.at(self.y_bus, (self.f, self.f), self.y_ff)
+        np.add.at(self.y_bus, (self.f, self.t), self.y_ft)
+        np.add.at(self.y_bus, (self.t, self.f), self.y_tf)
+        np.add.at(self.y_bus, (self.t, self.t), self.y_tt)
+
+        # DC susceptance matrix, neglecting resistance as Pandapower does
+        b_dc = 1/x_pu
+        self.b_bus = np.zeros((n, n))
+        np.add.at(self.b_bus, (self.f, self.f), b_dc)
+        np.add.at(self.b_bus, (self.f, self.t), -b_dc)
+        np.add.at(self.b_bus, (self.t, self.f), -b_dc)
+        np.add.at(self.b_bus, (self.t, self.t), b_dc)
+
+        # Thermal limits for loading computation
+        self.i_max_ka = (on['max_i_ka'].values*on['df'].values*parallel)
+
+        # Element-to-bus incidence for loads and generators
+        def incidence(element):
+            table = net[element]
+            on = (table['in_service'].values.astype(bool)
+                  & table['bus'].isin(self.bus_index).values)
+            pos = np.flatnonzero(on)
+            c = np.zeros((len(table.index), n))
+            c[pos, bus_lookup[table['bus'].values[pos]].values] = 1.
+            return c
+
+        self.c_load = incidence('load')
+        self.c_gen = incidence('gen')
+
+        # Bus types: reference (slack gen or external grid), PV, PQ
+        gen_on = self.c_gen.any(axis=1)
+        slack = net.gen['slack'].values.astype(bool) & gen_on
+        is_ref = self.c_gen[slack].any(axis=0)
+        is_pv = self.c_gen.any(axis=0) & ~is_ref
+        self.c_ext = np.zeros((0, n))
+        if len(net.ext_grid.index):
+            self.c_ext = incidence('ext_grid')
+            is_ref |= self.c_ext.any(axis=0)
+            is_pv &= ~is_ref
+        if not is_ref.any():
+            raise ValueError('Network has no slack bus.')
+
+        self.ref = np.flatnonzero(is_ref)
+        self.pv = np.flatnonzero(is_pv)
+        self.pq = np.flatnonzero(~is_ref & ~is_pv)
+        self.pvpq = np.concatenate([self.pv, self.pq])
+
+        self._b_red_inv = None
+
+    @property
+    def b_red_inv(self):
+        """Inverse of the DC susceptance matrix of non-reference buses."""
+        if self._b_red_inv is None:
+            self._b_red_inv = np.linalg.inv(self.b_bus[np.ix_(self.pvpq,
+                                                              self.pvpq)])
+        return self._b_red_inv
+
+    def element_frames(self, eq_frame_dict, steps=None):
+        """Element quantities per step as arrays in table order.
+
+        Values of the network tables are used for every element and
+        quantity that is not given in the input frames.
+
+        Parameters
+        ----------
+        eq_frame_dict : dict
+            Maps (element, quantity) to a frame with one row per step
+            and element names as columns, as used by `run_simulations`.
+        steps : array-like, optional
+            Row labels to select. The default is all rows.
+
+        Returns
+        -------
+        values : dict
+            Maps (element, quantity) to an array of shape (steps, elements).
+        """
+        n_steps = None
+        values = {}
+        for (element, quantity), eq_frame in eq_frame_dict.items():
+            if steps is not None:
+                eq_frame = eq_frame.loc[steps]
+            n_steps = len(eq_frame.index)
+            table = self.net[element]
+            array = np.tile(table[quantity].values.astype(float),
+                            (n_steps, 1))
+            name_map = getattr(self.net, element + '_name_map')
+            pos = table.index.get_indexer(name_map[eq_frame.columns].values)
+            array[:, pos] = eq_frame.values
+            values[(element, quantity)] = array
+
+        if n_steps is None:
+            n_steps = 1 if steps is None else len(steps)
+
+        # Fill remaining quantities from the network tables
+        for key in [('load', 'p_mw'), ('load', 'q_mvar'),
+                    ('gen', 'p_mw'), ('gen', 'vm_pu')]:
+            if key not in values:
+                element, quantity = key
+                column = self.net[element][quantity].values.astype(float)
+                values[key] = np.tile(column, (n_steps, 1))
+
+        return values
+
+    def injections(self, values):
+        """Bus power injections and voltage set points in per unit.
+
+        Returns
+        -------
+        s_bus : ndarray
+            Complex specified power injection, shape (steps, buses).
+        vm_set : ndarray
+            Voltage magnitude set points, ones at PQ buses.
+        """
+        load_scaling = self.net.load['scaling'].values
+        gen_scaling = self.net.gen['scaling'].values
+
+        p = (values[('gen', 'p_mw')]*gen_scaling) @ self.c_gen
+        p -= (values[('load', 'p_mw')]*load_scaling) @ self.c_load
+        q = -(values[('load', 'q_mvar')]*load_scaling) @ self.c_load
+        s_bus = (p + 1j*q)/self.sn_mva
+
+        # Voltage set points from generators, external grids override
+        n_steps = len(s_bus)
+        vm_set = np.ones((n_steps, self.n_bus))
+        gen_buses = self.c_gen.argmax(axis=1)
+        gen_on = self.c_gen.any(axis=1)
+        vm_set[:, gen_buses[gen_on]] = values[('gen', 'vm_pu')][:, gen_on]
+        if len(self.c_ext):
+            ext_buses = self.c_ext.argmax(axis=1)
+            ext_on = self.c_ext.any(axis=1)
+            vm_set[:, ext_buses[ext_on]] = (self.net.ext_grid['vm_pu']
+                                            .values[ext_on])
+        return s_bus, vm_set
+
+    def solve_dc(self, s_bus):
+        """DC power flow for a batch of injections.
+
+        Returns
+        -------
+        res : dict
+            Bus voltages and line results, see `line_results`.
+        """
+        n_steps = len(s_bus)
+        va = np.zeros((n_steps, self.n_bus))
+        va[:, self.pvpq] = s_bus.real[:, self.pvpq] @ self.b_red_inv.T
+        vm = np.ones((n_steps, self.n_bus))
+
+        p_from = (va[:, self.f] - va[:, self.t])/self.x_pu*self.sn_mva
+        i_from_ka = np.abs(p_from)/(SQRT3*self.vn_kv[self.f])
+        i_to_ka = np.abs(p_from)/(SQRT3*self.vn_kv[self.t])
+        i_ka = np.maximum(i_from_ka, i_to_ka)
+
+        converged = np.ones(n_steps, dtype=bool)
+        iterations = np.ones(n_steps, dtype=int)
+        return self._results(vm, va, p_from, i_ka, converged, iterations)
+
+    def solve_ac(self, s_bus, vm_set, v_init=None,
+                 tolerance_mva=1e-8, max_iteration=10):
+        """AC power flow for a batch of injections with Newton-Raphson.
+
+        All steps are iterated together; steps that have converged are
+        dropped from subsequent iterations.
+
+        Parameters
+        ----------
+        s_bus, vm_set : ndarray
+            Output of `injections`.
+        v_init : ndarray, optional
+            Complex initial bus voltages, e.g. a previous solution.
+            The default is a flat start at the voltage set points.
+        tolerance_mva : float
+            Convergence tolerance on the power mismatch in per unit.
+        max_iteration : int
+            Maximum number of Newton-Raphson iterations.
+
+        Returns
+        -------
+        res : dict
+            Bus voltages and line results, see `line_results`.
+        """
+        n_steps = len(s_bus)
+        if v_init is None:
+            v = vm_set.astype(complex)
+        else:
+            v = np.array(v_init, dtype=complex)
+            v[:, self.ref] = vm_set[:, self.ref]
+            v[:, self.pv] *= vm_set[:, self.pv]/np.abs(v[:, self.pv])
+
+        pvpq, pq = self.pvpq, self.pq
+        n_pvpq = len(pvpq)
+        y_bus = self.y_bus
+
+        converged = np.zeros(n_steps, dtype=bool)
+        iterations = np.zeros(n_steps, dtype=int)
+        active = np.arange(n_steps)
+
+        # Inner logic for the power mismatch of a subset of steps
+        def mismatch(v, s):
+            i_bus = v @ y_bus.T
+            ds = v*np.conj(i_bus) - s
+            return (np.concatenate([ds.real[:, pvpq], ds.imag[:, pq]],
+                                   axis=1), i_bus)
+
+        for it in range(max_iteration + 1):
+            v_a = v[active]
+            f, i_bus = mismatch(v_a, s_bus[active])
+            done = np.abs(f).max(axis=1, initial=0.) < tolerance_mva
+            converged[active[done]] = True
+            iterations[active[done]] = it
+            active, v_a, i_bus, f = (active[~done], v_a[~done],
+                                     i_bus[~done], f[~done])
+            if len(active) == 0 or it == max_iteration:
+                break
+
+            # Batched Jacobian of the power injections
+            v_norm = v_a/np.abs(v_a)
+            diag_i = np.conj(i_bus)
+            ds_dvm = (v_a[:, :, None]*np.conj(y_bus[None]*v_norm[:, None, :]))
+            idx = np.arange(self.n_bus)
+            ds_dvm[:, idx, idx] += diag_i*v_norm
+            ds_dva = -1j*v_a[:, :, None]*np.conj(y_bus[None]*v_a[:, None, :])
+            ds_dva[:, idx, idx] += 1j*v_a*diag_i
+
+            j11 = ds_dva.real[:, pvpq][:, :, pvpq]
+            j12 = ds_dvm.real[:, pvpq][:, :, pq]
+            j21 = ds_dva.imag[:, pq][:, :, pvpq]
+            j22 = ds_dvm.imag[:, pq][:, :, pq]
+            jac = np.concatenate([np.concatenate([j11, j12], axis=2),
+                                  np.concatenate([j21, j22], axis=2)],
+                                 axis=1)
+            dx = -np.linalg.solve(jac, f[:, :, None])[:, :, 0]
+
+            # Update angles and magnitudes
+            va = np.angle(v_a)
+            vm = np.abs(v_a)
+            va[:, pvpq] += dx[:, :n_pvpq]
+            vm[:, pq] += dx[:, n_pvpq:]
+            v[active] = vm*np.exp(1j*va)
+
+        iterations[active] = max_iteration
+
+        # Branch flows from the converged voltages
+        v_f, v_t = v[:, self.f], v[:, self.t]
+        i_f = self.y_ff*v_f + self.y_ft*v_t
+        i_t = self.y_tf*v_f + self.y_tt*v_t
+        s_f = v_f*np.conj(i_f)*self.sn_mva
+        s_t = v_t*np.conj(i_t)*self.sn_mva
+        vm = np.abs(v)
+        i_from_ka = np.abs(s_f)/(SQRT3*vm[:, self.f]*self.vn_kv[self.f])
+        i_to_ka = np.abs(s_t)/(SQRT3*vm[:, self.t]*self.vn_kv[self.t])
+        i_ka = np.maximum(i_from_ka, i_to_ka)
+
+        return self._results(vm, np.angle(v), s_f.real, i_ka,
+                             converged, iterations)
+
+    def _results(self, vm, va, p_from, i_ka, converged, iterations):
+
+        # Scatter line results back to all lines in table order
+        n_steps = len(vm)
+        n_lines = len(self.line_index)
+        res = {'vm_pu': vm,
+               'va_degree': np.degrees(va),
+               'converged': converged,
+               'iterations': iterations}
+        for name, values in [('p_from_mw', p_from),
+                             ('i_ka', i_ka),
+                             ('loading_percent', i_ka/self.i_max_ka*100)]:
+            full = np.zeros((n_steps, n_lines))
+            full[:, self.line_on] = values
+            res[name] = full
+        return res
+
+    def solve(self, values, mode='dc', **kwargs):
+        """Solve element quantities from `element_frames` in one batch."""
+        s_bus, vm_set = self.injections(values)
+        if mode == 'dc':
+            return self.solve_dc(s_bus)
+        elif mode == 'ac':
+            return self.solve_ac(s_bus, vm_set, **kwargs)
+        else:
+            raise ValueError(f'Unknown power flow mode: {mode}')
+
+def _mask_unconverged(res):
+    """Set the results of steps that did not converge to NaN, in place."""
+    failed = ~res['converged']
+    if failed.any():
+        for name in ['vm_pu', 'va_degree', 'p_from_mw', 'i_ka',
+                     'loading_percent']:
+            res[name][failed] = np.nan
+    return res
+
+def batch_metrics(net, metrics, res, index=None):
+    """Evaluate metrics on a batch of line results.
+
+    Returns
+    -------
+    res_frame : DataFrame
+        One row per step and one column per metric.
+    """
+    from metrics import MetricEngine
+
+    return MetricEngine(net, metrics).frame(res, index=index)
+
+def run_batch(net, metrics, eq_frame_dict, steps, mode='dc',
+              chunk_size=10000, solver=None, raw_store=None):
+    """Solve steps of the input frames in chunks and yield metric frames.
+
+    Parameters
+    ----------
+    net : pandapowerNet
+        Network object, e.g. from `pp_toy_model.create_toy_model`.
+    metrics : list
+        Output of `metrics.create_metrics`.
+    eq_frame_dict : dict
+        Maps (element, quantity) to an input frame.
+    steps : range
+        Steps to solve.
+    mode : str
+        'dc' or 'ac'.
+    chunk_size : int
+        Number of steps solved at once.
+    solver : BatchPowerFlow, optional
+        Precomputed solver for `net`.
+    raw_store : result_store.RawResultStore, optional
+        Store for the raw line and bus results of every step.
+
+    Yields
+    ------
+    res_frame : DataFrame
+        Metric values for one chunk of steps, indexed by step. Steps
+        whose AC power flow did not converge get NaN metrics.
+    """
+    from metrics import MetricEngine
+
+    if solver is None:
+        solver = BatchPowerFlow(net)
+    engine = MetricEngine(net, metrics)
+
+    for start in range(steps.start, steps.stop, chunk_size):
+        chunk = range(start, min(start + chunk_size, steps.stop))
+        values = solver.element_frames(eq_frame_dict, steps=chunk)
+        res = _mask_unconverged(solver.solve(values, mode=mode))
+        if raw_store is not None:
+            raw_store.write_batch(chunk, res, net, solver.bus_index)
+        res_frame = engine.frame(res, index=chunk)
+        res_frame.iloc[~res['converged']] = np.nan
+        yield res_frame
+
+def compare_to_pandapower(net, eq_frame_dict, steps, mode='ac'):
+    """Cross-check batch results against Pandapower step by step.
+
+    Returns
+    -------
+    deviation : DataFrame
+        Maximum absolute deviation of line loading (%), line current (kA)
+        and bus voltage angle (degrees) per step.
+    """
+    import pandapower as pp
+    from pp_toy_model import InputPlan
+
+    solver = BatchPowerFlow(net)
+    values = solver.element_frames(eq_frame_dict, steps=steps)
+    res = solver.solve(values, mode=mode)
+
+    deviation = pd.DataFrame(index=steps,
+                             columns=['loading_percent', 'i_ka', 'va_degree'],
+                             dtype=float)
+    plan = InputPlan(net, eq_frame_dict)
+    for i, n in enumerate(steps):
+        plan.apply(net, n)
+        if mode == 'dc':
+            pp.rundcpp(net)
+        else:
+            pp.runpp(net)
+        for column in ['loading_percent', 'i_ka']:
+            diff = res[column][i] - net.res_line[column].values
+            deviation.loc[n, column] = np.abs(diff).max()
+        va = net.res_bus.loc[solver.bus_index, 'va_degree'].values
+        deviation.loc[n, 'va_degree'] = np.abs(res['va_degree'][i] - va).max()
+
+    return deviation
+
+if __name__ == '__main__':
+    import os
+    import tempfile
+    import yaml
+    from pp_toy_model import create_toy_model
+
+    # Cross-check with random injections on 1, 2 and 4 substations
+    rng = np.random.default_rng(0)
+    with open('config/example_config.yaml', 'r') as config_file:
+        config = yaml.safe_load(config_file)
+
+    for n_subs in [1, 2, 4]:
+        config['substations'] = n_subs
+        with tempfile.TemporaryDirectory() as tmp:
+            config_path = os.path.join(tmp, 'config.yaml')
+            with open(config_path, 'w') as config_file:
+                yaml.dump(config, config_file)
+            net = create_toy_model(config_path)
+
+        names = net.bus['name'].values
+        eq_frame_dict = {
+            ('load', 'p_mw'): pd.DataFrame(rng.uniform(0, 3000, (10, len(names))),
+                                           columns=names),
+            ('gen', 'p_mw'): pd.DataFrame(rng.uniform(0, 3000, (10, len(names))),
+                                          columns=names)}
+        for mode in ['dc', 'ac']:
+            deviation = compare_to_pandapower(net, eq_frame_dict,
+                                              range(10), mode=mode)
+            print(f'{n_subs} substation(s), {mode}:',
+                  dict(deviation.max()))
@@ -0,0 +1,464 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import pandapower as pp
+import yaml
+
+from pp_toy_model import create_toy_model, InputPlan
+from powerflow_cache import PowerFlowCache
+from metrics import (METRICS, MetricEngine, apply_load_gen_noise,
+                     create_metrics)
+from batch_powerflow import run_batch
+from result_store import result_logger
+from grid_file import save_grid
+from simulations import (create_time_series, generate_time_series,
+                         init_simulations, run_simulations)
+
+__all__ = ['BENCHMARKS',
+           'run_benchmarks',
+           'save_baseline',
+           'compare_to_baseline']
+
+# Files shipped with the repository
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+CONFIG_FILE = os.path.join(REPO_DIR, 'config', 'example_config.yaml')
+CHRONICS_DIR = os.path.join(REPO_DIR, 'grid2op_env', 'chronics', '000', '')
+
+# Fixed seed of all generated inputs
+SEED = 0
+
+# Substation counts of the shipped coordinate files
+SUBSTATIONS = (1, 2, 4)
+
+# Modules timed by the import benchmark, each in a fresh interpreter
+IMPORT_MODULES = ('pp_toy_model', 'simulations', 'plotting', 'metrics',
+                  'batch_powerflow', 'grid_file')
+
+# Dependencies the grid file hot path must not import
+HEAVY_MODULES = ('pandapower', 'seaborn', 'matplotlib', 'tqdm', 'scipy')
+
+# Times code given as argument, then prints the heavy modules it loaded
+IMPORT_SCRIPT = '''import sys, time
+start = time.perf_counter()
+exec(sys.argv[1])
+print(time.perf_counter() - start)
+print(' '.join(m for m in sys.argv[2:] if m in sys.modules))
+'''
+
+# Metrics of one DC power flow on a grid file, without Pandapower
+HOT_PATH = '''from grid_file import load_grid
+from metrics import METRICS, create_metrics
+from batch_powerflow import BatchPowerFlow, batch_metrics
+grid = load_grid({grid_file!r})
+solver = BatchPowerFlow(grid)
+batch_metrics(grid, create_metrics(list(METRICS)),
+              solver.solve(solver.element_frames({{}}), mode='dc'))
+'''
+
+class PhaseTimer:
+    """Accumulates wall-clock time per named phase of a benchmark."""
+
+    def __init__(self):
+        self.seconds = {}
+
+    @contextmanager
+    def __call__(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[phase] = (self.seconds.get(phase, 0.)
+                                   + time.perf_counter() - start)
+
+def _step(net, metrics):
+    pp.runpp(net)
+    return pd.Series({name: metric(net) for (name, metric) in metrics})
+
+def _time_code(code):
+
+    # Fresh interpreter, so that no module is imported already
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [REPO_DIR] + [p for p in [env.get('PYTHONPATH')] if p])
+    output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT, code,
+                             *HEAVY_MODULES], env=env, check=True,
+                            capture_output=True, text=True).stdout
+    seconds, loaded = output.splitlines()[-2:]
+    return float(seconds), loaded.split()
+
+def _base_profile(net, path):
+
+    # Same draw for loads and generators in the format of eq_yaml_parser
+    rng = np.random.default_rng(SEED)
+    profile = {}
+    for element in ['load', 'gen']:
+        table = net[element]
+        zones = net.bus.loc[table['bus'], 'zone'].values
+        values = rng.uniform(0., 100., len(table.index))
+        zone_dict = profile.setdefault(element, {}).setdefault('p_mw', {})
+        for (name, zone, value) in zip(table['name'], zones, values):
+            zone_dict.setdefault(zone, {})[name[len(zone) + 1:]] = \
+                float(value)
+    with open(path, 'w') as profile_file:
+        yaml.dump(profile, profile_file)
+    return path
+
+def bench_imports(tmp_dir, quick):
+    """Import time of modules and of the grid file hot path.
+
+    Every import is timed in a fresh interpreter, best of three runs.
+    The hot path loads a grid file, solves a DC power flow and evaluates
+    the metrics; it fails if it imports any of `HEAVY_MODULES`.
+    """
+    repeats = 1 if quick else 3
+    grid_file = tmp_dir + 'grid.npz'
+    save_grid(create_toy_model(CONFIG_FILE, substations=4), grid_file)
+    phases = {}
+    codes = [(f'import_{module}', f'import {module}')
+             for module in IMPORT_MODULES]
+    codes.append(('hot_path', HOT_PATH.format(grid_file=grid_file)))
+    for (phase, code) in codes:
+        runs = [_time_code(code) for _ in range(repeats)]
+        phases[phase] = min(seconds for (seconds, _) in runs)
+        if phase == 'hot_path' and runs[0][1]:
+            raise RuntimeError(f'Hot path imports {", ".join(runs[0][1])}')
+    return len(codes), phases
+
+def _chronics():
+    load = pd.read_csv(CHRONICS_DIR + 'load_p.csv', sep=';')
+    gen = pd.read_csv(CHRONICS_DIR + 'prod_p.csv', sep=';')
+    return {('load', 'p_mw'): load, ('gen', 'p_mw'): gen}
+
+def bench_build(tmp_dir, quick):
+    """Network construction, without and with the build cache."""
+    timer = PhaseTimer()
+    repeats = 5 if quick else 20
+    for n_subs in SUBSTATIONS:
+        with timer(f'build_{n_subs}'):
+            for _ in range(repeats):
+                create_toy_model(CONFIG_FILE, cache=False,
+                                 substations=n_subs)
+    with timer('cached_copy'):
+        for _ in range(repeats):
+            create_toy_model(CONFIG_FILE, substations=4)
+    return repeats*(len(SUBSTATIONS) + 1), timer.seconds
+
+def bench_time_series(tmp_dir, quick):
+    """Seeded time series generation and writing of simulation inputs."""
+    timer = PhaseTimer()
+    length = 10000 if quick else 100000
+    net = create_toy_model(CONFIG_FILE, substations=4)
+    base_yaml = _base_profile(net, tmp_dir + 'base.yaml')
+    with timer('generate'):
+        eq_frame_dict = generate_time_series(base_yaml, net, length,
+                                             rng=SEED)
+    with timer('write'):
+        init_simulations(tmp_dir + 'time_series/', eq_frame_dict)
+    return length, timer.seconds
+
+def bench_create_time_series(tmp_dir, quick):
+    """Step-by-step time series generation of `create_time_series`.
+
+    Counterpart of `bench_time_series` on the same network and base
+    profile, with fewer steps as every step goes through the network.
+    """
+    timer = PhaseTimer()
+    length = 100 if quick else 1000
+    net = create_toy_model(CONFIG_FILE, substations=4)
+    base_yaml = _base_profile(net, tmp_dir + 'base.yaml')
+    np.random.seed(SEED)
+    with timer('create'):
+        create_time_series(base_yaml, net, apply_load_gen_noise, length)
+    return length, timer.seconds
+
+def bench_simulation(tmp_dir, quick):
+    """Per-step AC simulation loop on the shipped chronics.
+
+    The loop of `run_simulations` is timed phase by phase: applying the
+    inputs, the power flow, the metrics and writing the results.
+    """
+    timer = PhaseTimer()
+    eq_frame_dict = _chronics()
+    n_steps = 200 if quick else len(eq_frame_dict[('load', 'p_mw')].index)
+    net = create_toy_model(CONFIG_FILE, substations=1)
+    metrics = create_metrics(list(METRICS))
+    plan = InputPlan(net, eq_frame_dict)
+
+    with result_logger(tmp_dir + 'simulation/') as l:
+        l.write_header(pd.Index([name for (name, _) in metrics]))
+        for n in range(n_steps):
+            with timer('set_inputs'):
+                plan.apply(net, n)
+            with timer('power_flow'):
+                pp.runpp(net)
+            with timer('metrics'):
+                results = pd.Series({name: metric(net)
+                                     for (name, metric) in metrics})
+            with timer('write'):
+                l.write_res(n, results)
+    return n_steps, timer.seconds
+
+def bench_run_simulations(tmp_dir, quick):
+    """End-to-end `run_simulations` on the shipped chronics."""
+    timer = PhaseTimer()
+    eq_frame_dict = _chronics()
+    n_steps = 200 if quick else len(eq_frame_dict[('load', 'p_mw')].index)
+    path = tmp_dir + 'run_simulations/'
+    init_simulations(path, eq_frame_dict)
+    net = create_toy_model(CONFIG_FILE, substations=1)
+    metrics = create_metrics(list(METRICS))
+    with timer('run'):
+        run_simulations(path, net, metrics, _step, until=n_steps)
+    return n_steps, timer.seconds
+
+def bench_cached_simulations(tmp_dir, quick):
+    """`run_simulations` on the chronics with `PowerFlowCache` steps."""
+    timer = PhaseTimer()
+    eq_frame_dict = _chronics()
+    n_steps = 200 if quick else len(eq_frame_dict[('load', 'p_mw')].index)
+    path = tmp_dir + 'cached_simulations/'
+    init_simulations(path, eq_frame_dict)
+    net = create_toy_model(CONFIG_FILE, substations=1)
+    metrics = create_metrics(list(METRICS))
+    solver = PowerFlowCache()
+    with timer('run'):
+        run_simulations(path, net, metrics, solver.simulation_step,
+                        until=n_steps)
+    return n_steps, timer.seconds
+
+def _bench_batch(mode):
+    def bench(tmp_dir, quick):
+        timer = PhaseTimer()
+        length = 2000 if quick else 20000
+        metrics = create_metrics(list(METRICS))
+        for n_subs in SUBSTATIONS:
+            net = create_toy_model(CONFIG_FILE, substations=n_subs)
+            eq_frame_dict = generate_time_series(
+                _base_profile(net, tmp_dir + 'base.yaml'), net, length,
+                rng=SEED)
+            with timer(f'{mode}_{n_subs}'):
+                for _ in run_batch(net, metrics, eq_frame_dict,
+                                   range(length), mode=mode):
+                    pass
+        return length*len(SUBSTATIONS), timer.seconds
+    bench.__doc__ = f'Batched {mode.upper()} power flow with metrics.'
+    return bench
+
+def bench_metrics(tmp_dir, quick):
+    """METRICS evaluated per step on the network and in batches."""
+    timer = PhaseTimer()
+    n_steps = 200 if quick else 1000
+    net = create_toy_model(CONFIG_FILE, substations=4)
+    metrics = create_metrics(list(METRICS))
+    pp.runpp(net)
+    with timer('per_step'):
+        for _ in range(n_steps):
+            pd.Series({name: metric(net) for (name, metric) in metrics})
+
+    # Batch of line results with the shape of a simulation chunk
+    engine = MetricEngine(net, metrics)
+    rng = np.random.default_rng(SEED)
+    res = {quantity: rng.uniform(0., 100., (n_steps, len(net.line.index)))
+           for quantity in ['loading_percent', 'i_ka', 'p_from_mw']}
+    with timer('batch'):
+        engine.frame(res)
+    return n_steps, timer.seconds
+
+def _bench_io(backend):
+    def bench(tmp_dir, quick):
+        timer = PhaseTimer()
+        n_steps = 20000 if quick else 200000
+        rng = np.random.default_rng(SEED)
+        res_frame = pd.DataFrame(rng.uniform(0., 100., (n_steps,
+                                                        len(METRICS))),
+                                 columns=list(METRICS))
+        path = tmp_dir + f'io_{backend}/'
+
+        # Row-wise writes as in the per-step loop, then frame-wise writes
+        rows = list(res_frame.iloc[:min(n_steps, 20000)].iterrows())
+        with timer('write_rows'):
+            with result_logger(path, 'rows', backend) as l:
+                l.write_header(res_frame.columns)
+                for (n, results) in rows:
+                    l.write_res(n, results)
+        with timer('write_frame'):
+            with result_logger(path, 'frame', backend) as l:
+                l.write_header(res_frame.columns)
+                l.write_frame(res_frame)
+        with timer('resume'):
+            result_logger(path, 'frame', backend)
+        with timer('read'):
+            np.asarray(result_logger(path, 'frame', backend).read())
+        with timer('read_column'):
+            np.asarray(result_logger(path, 'frame', backend)
+                       .read(columns=res_frame.columns[:1]))
+        return n_steps, timer.seconds
+    bench.__doc__ = f'Result logging and loading with the {backend} backend.'
+    return bench
+
+BENCHMARKS = {'imports': bench_imports,
+              'build': bench_build,
+              'time_series': bench_time_series,
+              'create_time_series': bench_create_time_series,
+              'simulation': bench_simulation,
+              'run_simulations': bench_run_simulations,
+              'cached_simulations': bench_cached_simulations,
+              'batch_dc': _bench_batch('dc'),
+              'batch_ac': _bench_batch('ac'),
+              'metrics': bench_metrics,
+              'io_csv': _bench_io('csv'),
+              'io_npy': _bench_io('npy')}
+
+def _run_once(bench, quick, trace):
+    tmp_dir = tempfile.mkdtemp() + '/'
+    try:
+        if trace:
+            tracemalloc.start()
+        n_steps, phases = bench(tmp_dir, quick)
+        peak = tracemalloc.get_traced_memory()[1] if trace else None
+    finally:
+        if trace:
+            tracemalloc.stop()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return n_steps, phases, peak
+
+def run_benchmarks(names=None, quick=False, memory=True, repeat=1):
+    """Run benchmarks and collect their results.
+
+    Every benchmark uses fixed seeds and the shipped configurations.
+    Times are the best of `repeat` runs. Peak memory is measured with
+    `tracemalloc` in one additional run, as tracing slows down the code.
+
+    Parameters
+    ----------
+    names : list, optional
+        Keys of `BENCHMARKS` to run. The default is all benchmarks.
+    quick : bool
+        Use smaller inputs, e.g. for checking a change quickly.
+    memory : bool
+        Measure the peak memory of each benchmark.
+    repeat : int
+        Number of timed runs of each benchmark.
+
+    Returns
+    -------
+    results : dict
+        Environment under 'meta' and per benchmark the number of steps,
+        total seconds, steps per second, peak memory in MiB and seconds
+        per phase under 'benchmarks'.
+    """
+    results = {'meta': {'python': platform.python_version(),
+                        'numpy': np.__version__,
+                        'pandas': pd.__version__,
+                        'pandapower': pp.__version__,
+                        'platform': platform.platform(),
+                        'quick': quick,
+                        'seed': SEED,
+                        'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+               'benchmarks': {}}
+    for name in (BENCHMARKS if names is None else names):
+        bench = BENCHMARKS[name]
+        best = None
+        for _ in range(repeat):
+            n_steps, phases, _ = _run_once(bench, quick, trace=False)
+            if best is None or sum(phases.values()) < sum(best.values()):
+                best = phases
+        seconds = sum(best.values())
+        peak = _run_once(bench, quick, trace=True)[2] if memory else None
+        results['benchmarks'][name] = {
+            'steps': n_steps,
+            'seconds': seconds,
+            'steps_per_s': n_steps/seconds if seconds > 0 else float('inf'),
+            'peak_mib': None if peak is None else peak/2**20,
+            'phases': best}
+        _print_result(name, results['benchmarks'][name])
+    return results
+
+def _print_result(name, result):
+    peak = ('' if result['peak_mib'] is None
+            else f", peak {result['peak_mib']:.1f} MiB")
+    print(f"{name}: {result['steps']} steps in {result['seconds']:.3f} s, "
+          f"{result['steps_per_s']:.1f} steps/s{peak}")
+    for (phase, seconds) in result['phases'].items():
+        print(f'    {phase}: {seconds:.3f} s')
+
+def save_baseline(results, baseline_file):
+    with open(baseline_file, 'w') as baseline:
+        json.dump(results, baseline, indent=2)
+
+def compare_to_baseline(results, baseline_file, tolerance=0.1):
+    """Compare results to a saved baseline.
+
+    Prints the ratio of the time of each benchmark and phase to the
+    baseline. Ratios above `1 + tolerance` are flagged as regressions.
+
+    Returns
+    -------
+    regressions : list
+        Names of benchmarks and phases that became slower.
+    """
+    with open(baseline_file, 'r') as baseline:
+        baseline = json.load(baseline)
+    if baseline['meta'].get('quick') != results['meta']['quick']:
+        print('Warning: baseline and results use different input sizes.')
+
+    regressions = []
+    for (name, result) in results['benchmarks'].items():
+        if name not in baseline['benchmarks']:
+            continue
+        base = baseline['benchmarks'][name]
+        timings = [(name, result['seconds'], base['seconds'])]
+        timings += [(f'{name}.{phase}', seconds, base['phases'][phase])
+                    for (phase, seconds) in result['phases'].items()
+                    if phase in base['phases']]
+        for (label, seconds, base_seconds) in timings:
+            ratio = seconds/base_seconds if base_seconds > 0 else 1.
+            flag = ' REGRESSION' if ratio > 1 + tolerance else ''
+            if ratio > 1 + tolerance:
+                regressions.append(label)
+            print(f'{label}: {base_seconds:.3f} s -> {seconds:.3f} s '
+                  f'({ratio:.2f}x){flag}')
+    return regressions
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Run the benchmark suite.')
+    parser.add_argument('names', nargs='*',
+                        help=f'benchmarks to run, all by default: '
+                             f'{", ".join(BENCHMARKS)}')
+    parser.add_argument('--quick', action='store_true',
+                        help='use smaller inputs')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip the peak memory measurement')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='timed runs per benchmark, best is kept')
+    parser.add_argument('--save', metavar='FILE',
+                        help='save results as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare results to a JSON baseline')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative slowdown flagged as regression')
+    args = parser.parse_args()
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f'unknown benchmarks: {", ".join(sorted(unknown))}')
+
+    results = run_benchmarks(args.names or None, quick=args.quick,
+                             memory=not args.no_memory, repeat=args.repeat)
+    if args.save:
+        save_baseline(results, args.save)
+    if args.compare:
+        regressions = compare_to_baseline(results, args.compare,
+                                          args.tolerance)
+        sys.exit(1 if regressions else 0)
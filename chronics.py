@@ -0,0 +1,219 @@
+import bz2
+import lzma
+import os
+import shutil
+from functools import partial
+
+import numpy as np
+
+from simulations import InputReader, count_steps, iter_time_series
+
+__all__ = ['CHRONICS_FILES',
+           'COMPRESSION_SUFFIX',
+           'write_chronics',
+           'export_simulation',
+           'export_simulations',
+           'export_time_series']
+
+# Chronics file of each simulation input, as read by GridStateFromFile
+CHRONICS_FILES = {('load', 'p_mw'): 'load_p',
+                  ('load', 'q_mvar'): 'load_q',
+                  ('gen', 'p_mw'): 'prod_p',
+                  ('gen', 'vm_pu'): 'prod_v'}
+
+# File name suffix of each compression, all readable by grid2op
+COMPRESSION_SUFFIX = {None: '', 'bz2': '.bz2', 'xz': '.xz'}
+
+# Defaults matching grid2op_env/chronics/000
+START_DATETIME = '2019-01-05 23:55'
+TIME_INTERVAL = '00:05'
+
+def _open(file_name, compression):
+    if compression == 'bz2':
+        return bz2.open(file_name, 'wt', newline='')
+    if compression == 'xz':
+        return lzma.open(file_name, 'wt', newline='')
+    return open(file_name, 'w', newline='')
+
+def write_chronics(folder, chunks, start_datetime=START_DATETIME,
+                   time_interval=TIME_INTERVAL, compression=None,
+                   vn_kv=None, float_format=None, overwrite=False):
+    """Stream simulation inputs into one Multifolder chronics folder.
+
+    Every input maps to its file in `CHRONICS_FILES`, written as in
+    grid2op_env/chronics/000: separated by semicolons, with element names
+    as header and no index. Chunks are appended as they arrive, so memory
+    use does not depend on the length of the chronics. The folder is
+    written under a temporary name and renamed when complete, so readers
+    never see partial chronics.
+
+    Parameters
+    ----------
+    folder : str
+        Chronics folder to create.
+    chunks : iterable of dict
+        Maps (element, quantity) to a frame of consecutive steps, e.g.
+        from `simulations.iter_time_series` or `InputReader`.
+    start_datetime : str
+        Content of start_datetime.info.
+    time_interval : str
+        Content of time_interval.info.
+    compression : str, optional
+        'bz2' or 'xz' to compress the CSV files.
+    vn_kv : float, optional
+        Nominal voltage to convert generator setpoints from per unit to
+        the kV of prod_v. Setpoints are only exported if it is given.
+    float_format : str, optional
+        Format of the values, e.g. '%.6g' for smaller files. The default
+        keeps the full precision.
+    overwrite : bool
+        Replace an existing folder. Otherwise existing folders are kept,
+        so an interrupted export can be resumed.
+
+    Returns
+    -------
+    written : bool
+        Whether the folder was written.
+    """
+    folder = folder.rstrip('/')
+    if os.path.isdir(folder) and not overwrite:
+        return False
+    tmp_folder = folder + '.tmp'
+    if os.path.isdir(tmp_folder):
+        shutil.rmtree(tmp_folder)
+    os.makedirs(tmp_folder)
+
+    suffix = COMPRESSION_SUFFIX[compression]
+    files = {}
+    try:
+        for eq_frame_dict in chunks:
+            for ((element, quantity), eq_frame) in eq_frame_dict.items():
+                name = CHRONICS_FILES.get((element, quantity))
+                if name is None or (name == 'prod_v' and vn_kv is None):
+                    continue
+                if name == 'prod_v':
+                    eq_frame = eq_frame*vn_kv
+                header = name not in files
+                if header:
+                    files[name] = _open(f'{tmp_folder}/{name}.csv{suffix}',
+                                        compression)
+                eq_frame.to_csv(files[name], sep=';', index=False,
+                                header=header, float_format=float_format)
+    finally:
+        for chronics_file in files.values():
+            chronics_file.close()
+
+    with open(tmp_folder + '/start_datetime.info', 'w') as info:
+        info.write(start_datetime)
+    with open(tmp_folder + '/time_interval.info', 'w') as info:
+        info.write(time_interval)
+
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    os.replace(tmp_folder, folder)
+    return True
+
+def export_simulation(path, folder, start=0, stop=None, chunk_size=10000,
+                      **chronics_kwargs):
+    """Export the inputs of a simulation directory as one chronics folder.
+
+    Inputs are streamed with `InputReader`, from the binary files of
+    `convert_inputs_to_npy` if they exist. Keyword arguments are passed
+    on to `write_chronics`.
+    """
+    if stop is None:
+        stop = count_steps(path)
+    chunks = InputReader(path, start, stop, chunk_size)
+    return write_chronics(folder, chunks, **chronics_kwargs)
+
+def _folder_names(chronics_dir, n):
+    width = max(3, len(str(n - 1)))
+    return [os.path.join(chronics_dir, f'{i:0{width}d}') for i in range(n)]
+
+def _export_time_series(folder, seed, base_yaml, net, length, chunk_size,
+                        elements, quantities, noise_kwargs, **chronics_kwargs):
+    chunks = iter_time_series(base_yaml, net, length, chunk_size=chunk_size,
+                              rng=seed, elements=elements,
+                              quantities=quantities, **noise_kwargs)
+    return write_chronics(folder, chunks, **chronics_kwargs)
+
+def _run_pool(func, tasks, n_workers):
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from tqdm import tqdm
+
+    if n_workers == 1:
+        return [func(*task) for task in tqdm(tasks)]
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = [pool.submit(func, *task) for task in tasks]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            future.result()
+    return [future.result() for future in futures]
+
+def export_simulations(paths, chronics_dir, n_workers=None, chunk_size=10000,
+                       **chronics_kwargs):
+    """Export simulation directories as chronics folders in parallel.
+
+    The inputs of `paths[i]` are written to the i-th folder of
+    `chronics_dir`, named '000', '001', ... as Multifolder expects.
+    Keyword arguments are passed on to `write_chronics`.
+
+    Returns
+    -------
+    folders : list of str
+        Chronics folders, in the order of `paths`.
+    """
+    folders = _folder_names(chronics_dir, len(paths))
+    export = partial(export_simulation, chunk_size=chunk_size, 
+                     **chronics_kwargs)
+    _run_pool(export, list(zip(paths, folders)), n_workers)
+    return folders
+
+def export_time_series(chronics_dir, base_yaml, net, n_chronics, length,
+                       rng=None, n_workers=None, chunk_size=10000,
+                       elements='all', quantities='all', noise_kwargs=None,
+                       **chronics_kwargs):
+    """Generate noisy time series directly into chronics folders.
+
+    Each folder gets an independent stream of `simulations.iter_time_series`,
+    seeded from `rng`, so the export is reproducible regardless of the
+    number of workers. Folders that already exist are skipped unless
+    `overwrite=True` is passed, so an interrupted export can be resumed.
+
+    Parameters
+    ----------
+    chronics_dir : str
+        Directory of the chronics folders.
+    base_yaml : str
+        Base profile in the format of `eq_yaml_parser`.
+    net : pandapowerNet
+        Network object from `create_toy_model`.
+    n_chronics : int
+        Number of chronics folders.
+    length : int
+        Number of steps per chronics folder.
+    rng : numpy.random.Generator or int, optional
+        Random generator or seed from which the folder seeds are drawn.
+    n_workers : int, optional
+        Number of processes. The default is the number of CPUs.
+    chunk_size : int
+        Number of steps generated and written at once.
+    elements, quantities : 'all' or list
+        Inputs to generate, see `iter_time_series`.
+    noise_kwargs : dict, optional
+        Passed on to `metrics.sample_load_gen_noise`.
+    **chronics_kwargs
+        Passed on to `write_chronics`.
+
+    Returns
+    -------
+    folders : list of str
+        Chronics folders.
+    """
+    seeds = np.random.default_rng(rng).integers(2**63, size=n_chronics)
+    folders = _folder_names(chronics_dir, n_chronics)
+    export = partial(_export_time_series, base_yaml=base_yaml, net=net,
+                     length=length, chunk_size=chunk_size, elements=elements,
+                     quantities=quantities, noise_kwargs=noise_kwargs or {},
+                     **chronics_kwargs)
+    _run_pool(export, list(zip(folders, seeds)), n_workers)
+    return folders
@@ -0,0 +1,267 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from metrics import MetricEngine
+from sensitivities import load_sensitivities
+from result_store import result_logger
+
+__all__ = ['CubeStore',
+           'ContingencyAnalysis']
+
+class CubeStore:
+    """Chunked on-disk store of (step x contingency x line) arrays.
+
+    Every chunk of steps is one `.npy` file in the directory
+    `path + name + '/'`, with a small `index.json` listing the chunks,
+    contingencies and lines, so appending and resuming take constant
+    time. Chunks are memory-mapped when read.
+
+    Parameters
+    ----------
+    path : str
+        Simulation directory.
+    name : str
+        Name of the store within the directory.
+    dtype : str
+        Data type of the stored values; 'float32' halves the size of
+        the cube compared to the computed float64 values.
+    """
+
+    def __init__(self, path, name='n1_loading', dtype='float32'):
+        self.file = path + name + '/'
+        self.dtype = dtype
+        self.chunks = []
+        self.last_run = None
+        self.contingencies = None
+        self.lines = None
+        if os.path.isfile(self.file + 'index.json'):
+            with open(self.file + 'index.json', 'r') as index_file:
+                index = json.load(index_file)
+            self.chunks = index['chunks']
+            self.last_run = index['last_run']
+            self.contingencies = index['contingencies']
+            self.lines = index['lines']
+            self.dtype = index['dtype']
+
+    def _write_index(self):
+        index = {'chunks': self.chunks,
+                 'last_run': self.last_run,
+                 'contingencies': self.contingencies,
+                 'lines': self.lines,
+                 'dtype': self.dtype}
+        with open(self.file + 'index.json.tmp', 'w') as index_file:
+            json.dump(index, index_file)
+        os.replace(self.file + 'index.json.tmp', self.file + 'index.json')
+
+    def write_chunk(self, steps, cube, contingencies, lines):
+        if len(steps) == 0:
+            return
+        if not os.path.isdir(self.file):
+            os.makedirs(self.file)
+        self.contingencies = [str(c) for c in contingencies]
+        self.lines = [str(l) for l in lines]
+        name = f'chunk_{len(self.chunks):06d}'
+        np.save(self.file + name + '_index.npy',
+                np.asarray(steps, dtype=np.int64))
+        np.save(self.file + name + '.npy', cube.astype(self.dtype))
+        self.chunks.append(name)
+        self.last_run = int(steps[-1])
+        self._write_index()
+
+    def iter_chunks(self):
+        """Yield (steps, memory-mapped cube) chunk by chunk."""
+        for name in self.chunks:
+            yield (np.load(self.file + name + '_index.npy'),
+                   np.load(self.file + name + '.npy', mmap_mode='r'))
+
+    def read(self):
+        """All steps and the whole cube in memory."""
+        chunks = list(self.iter_chunks())
+        if len(chunks) == 0:
+            return np.empty(0, dtype=np.int64), np.empty((0, 0, 0))
+        return (np.concatenate([steps for (steps, _) in chunks]),
+                np.concatenate([cube for (_, cube) in chunks]))
+
+    def exists(self):
+        return os.path.isfile(self.file + 'index.json')
+
+    def remove(self):
+        shutil.rmtree(self.file)
+
+class ContingencyAnalysis:
+    """Single line outages of every step, evaluated in batch.
+
+    Post-outage flows of the DC power flow follow from the base flows by
+    the line outage distribution factors (LODF): with line k out, the
+    flow on line l changes by LODF[l, k] times the base flow on k. All
+    outages of a chunk of steps are therefore one broadcast operation
+    instead of a power flow per step and outage. Outages that island
+    buses are reported in `islanding` and give NaN results.
+
+    Parameters
+    ----------
+    net : pandapowerNet
+        Network object from `create_toy_model`.
+    metrics : list
+        Output of `metrics.create_metrics`, evaluated per contingency.
+    contingencies : list, optional
+        Labels of the lines to take out of service. The default is all
+        lines in service.
+    cache_dir : str or None
+        Cache directory of `sensitivities.load_sensitivities`.
+    """
+
+    def __init__(self, net, metrics, contingencies=None, cache_dir=None):
+        self.net = net
+        self.sens = load_sensitivities(net, cache_dir=cache_dir)
+        self.engine = MetricEngine(net, metrics)
+        in_service = net.line['in_service'].values.astype(bool)
+        if contingencies is None:
+            contingencies = net.line.index[in_service]
+        self.contingencies = pd.Index(contingencies)
+        self.cont_pos = net.line.index.get_indexer(self.contingencies)
+        if (self.cont_pos < 0).any():
+            raise KeyError(f'Unknown lines: '
+                           f'{list(self.contingencies[self.cont_pos < 0])}')
+
+        # Flow changes per unit of pre-outage flow, (contingencies, lines)
+        lodf = self.sens.lodf[:, self.cont_pos].T
+        self.islanding = self.contingencies[~np.isfinite(lodf).all(axis=1)]
+        self.lodf = np.where(np.isfinite(lodf), lodf, np.nan)
+
+        # Line states per contingency
+        self.in_service = np.tile(in_service, (len(self.contingencies), 1))
+        self.in_service[np.arange(len(self.contingencies)),
+                        self.cont_pos] = False
+
+    def flows(self, p_bus):
+        """Post-outage DC line flows in MW, shape (steps, contingencies, lines)."""
+        p_line = self.sens.flows(p_bus)
+        return (p_line[:, None, :]
+                + p_line[:, self.cont_pos, None]*self.lodf[None, :, :])
+
+    def evaluate(self, p_bus):
+        """Loading cube and metrics of all contingencies.
+
+        Returns
+        -------
+        loading : ndarray
+            Loading in %, shape (steps, contingencies, lines).
+        values : ndarray
+            Metric values, shape (steps, contingencies, metrics).
+        """
+        p_line = self.flows(p_bus)
+        n_steps, n_cont, n_lines = p_line.shape
+        res = self.sens.line_results(p_line.reshape(-1, n_lines))
+        in_service = np.broadcast_to(self.in_service[None],
+                                     p_line.shape).reshape(-1, n_lines)
+        values = self.engine.evaluate_batch(res, in_service)
+        return (res['loading_percent'].reshape(p_line.shape),
+                values.reshape(n_steps, n_cont, -1))
+
+    def summary(self, values, index=None):
+        """Result frame of the worst contingency per step and metric.
+
+        For every metric, `{metric}_n1_max` holds the largest value over
+        all contingencies and `{metric}_n1_worst` the position of that
+        contingency in `contingencies`.
+        """
+        columns = {}
+        for (m, name) in enumerate(self.engine.names):
+            score = np.where(np.isnan(values[:, :, m]), -np.inf,
+                             values[:, :, m])
+            worst = score.argmax(axis=1)
+            columns[f'{name}_n1_max'] = score.max(axis=1)
+            columns[f'{name}_n1_worst'] = worst
+        return pd.DataFrame(columns, index=index)
+
+    def frame(self, values, index=None):
+        """Result frame of every metric and contingency.
+
+        Columns are named `{metric}_out_{line name}`.
+        """
+        line_names = self.net.line.loc[self.contingencies, 'name']
+        columns = [f'{name}_out_{line_name}' for line_name in line_names
+                   for name in self.engine.names]
+        return pd.DataFrame(values.reshape(len(values), -1), index=index,
+                            columns=columns)
+
+    def run(self, eq_frame_dict, steps=None, path=None, chunk_size=1000,
+            backend='csv', store_cube=True):
+        """Screen all contingencies for every step of the input frames.
+
+        With `path`, per-contingency metrics are logged as 'res_n1', the
+        worst contingency per step as 'res_n1_summary' and the loading
+        cube to a `CubeStore`; steps logged before are skipped, so an
+        interrupted run resumes.
+
+        Parameters
+        ----------
+        eq_frame_dict : dict
+            Maps (element, quantity) to an input frame.
+        steps : range, optional
+            Steps to screen. The default is all rows of the inputs.
+        path : str, optional
+            Simulation directory for the results.
+        chunk_size : int
+            Number of steps evaluated at once.
+        backend : str
+            Result backend, a key of `result_store.RESULT_BACKENDS`.
+        store_cube : bool
+            Store the loading cube.
+
+        Returns
+        -------
+        summary : DataFrame
+            See `summary`, for the steps computed in this call.
+        """
+        if steps is None:
+            index = next(iter(eq_frame_dict.values())).index
+            steps = range(index[0], index[-1] + 1)
+        if path is None:
+            return pd.concat([self.summary(values, index=chunk)
+                              for (chunk, _, values)
+                              in self._iter_chunks(eq_frame_dict, steps,
+                                                   chunk_size)])
+
+        cube_store = CubeStore(path) if store_cube else None
+        frames = []
+        with result_logger(path, 'res_n1', backend) as l, \
+             result_logger(path, 'res_n1_summary', backend) as s:
+            first = steps.start
+            if l.last_run is not None:
+                first = max(first, l.last_run + 1)
+            for (chunk, loading, values) in self._iter_chunks(
+                    eq_frame_dict, range(first, steps.stop), chunk_size):
+                summary = self.summary(values, index=chunk)
+                res_frame = self.frame(values, index=chunk)
+                if cube_store is not None and (cube_store.last_run is None
+                        or cube_store.last_run < chunk[-1]):
+                    keep = np.asarray(chunk) > (-1 if cube_store.last_run
+                                                is None
+                                                else cube_store.last_run)
+                    cube_store.write_chunk(np.asarray(chunk)[keep],
+                                           loading[keep],
+                                           self.contingencies,
+                                           self.net.line.index)
+                for (logger, frame) in [(s, summary), (l, res_frame)]:
+                    if not logger.header:
+                        logger.write_header(frame.columns)
+                    if logger.last_run is not None:
+                        frame = frame.loc[logger.last_run + 1:]
+                    logger.write_frame(frame)
+                frames.append(summary)
+        return pd.concat(frames) if frames else pd.DataFrame()
+
+    def _iter_chunks(self, eq_frame_dict, steps, chunk_size):
+        model = self.sens.model
+        for start in range(steps.start, steps.stop, chunk_size):
+            chunk = range(start, min(start + chunk_size, steps.stop))
+            values = model.element_frames(eq_frame_dict, steps=chunk)
+            loading, metric_values = self.evaluate(
+                self.sens.bus_injections(values))
+            yield chunk, loading, metric_values
@@ -0,0 +1,127 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+__all__ = ['GRID_EXTENSION',
+           'GridTables',
+           'save_grid',
+           'load_grid']
+
+# File extension of serialized grids
+GRID_EXTENSION = '.npz'
+
+# Table columns read by BatchPowerFlow, MetricEngine, InputPlan and
+# sensitivity_key; columns missing in a network are skipped
+GRID_COLUMNS = {'bus': ['name', 'vn_kv', 'zone', 'in_service'],
+                'line': ['name', 'from_bus', 'to_bus', 'length_km',
+                         'r_ohm_per_km', 'x_ohm_per_km', 'c_nf_per_km',
+                         'g_us_per_km', 'max_i_ka', 'df', 'parallel',
+                         'in_service'],
+                'load': ['name', 'bus', 'p_mw', 'q_mvar', 'scaling',
+                         'in_service'],
+                'gen': ['name', 'bus', 'p_mw', 'vm_pu', 'slack', 'scaling',
+                        'in_service'],
+                'ext_grid': ['name', 'bus', 'vm_pu', 'va_degree',
+                             'in_service']}
+
+# Elements with a name map, as set by create_toy_model
+NAME_MAPS = ('bus', 'line', 'load', 'gen')
+
+class GridTables(dict):
+    """Pandapower-free stand-in for a toy model network.
+
+    Holds the element tables of `GRID_COLUMNS` as DataFrames, the name
+    maps, `inner_line_idx`, `config_hash`, `sn_mva` and `f_hz`, with
+    attribute and item access like a pandapowerNet. That is all that
+    `batch_powerflow.BatchPowerFlow`, `metrics.MetricEngine`,
+    `sensitivities.load_sensitivities` and `pp_toy_model.InputPlan`
+    read, so batched power flows and metrics run on it without
+    importing Pandapower. Sensitivities are shared with the network the
+    grid was saved from through `config_hash`.
+    """
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key) from None
+
+    def __setattr__(self, key, value):
+        self[key] = value
+
+def save_grid(net, grid_file):
+    """Serialize the tables of a network that the batched code reads.
+
+    Parameters
+    ----------
+    net : pandapowerNet or GridTables
+        Network object, e.g. from `pp_toy_model.create_toy_model`.
+    grid_file : str
+        Output file, ending in `GRID_EXTENSION`.
+    """
+    arrays = {'sn_mva': np.float64(net.sn_mva),
+              'f_hz': np.float64(net.f_hz)}
+    for (element, columns) in GRID_COLUMNS.items():
+        table = net[element]
+        arrays[f'{element}/index'] = table.index.values.astype(np.int64)
+        for column in columns:
+            if column not in table:
+                continue
+            values = table[column].values
+            if values.dtype == object:
+                values = values.astype(str)
+            arrays[f'{element}/{column}'] = values
+    if 'config_hash' in net:
+        arrays['config_hash'] = np.str_(net.config_hash)
+    if 'inner_line_idx' in net:
+        arrays['inner_line_idx'] = np.asarray(net.inner_line_idx,
+                                              dtype=np.int64)
+
+    # Write to a temporary file so concurrent readers never see parts
+    tmp_file = f'{grid_file}.{os.getpid()}.tmp{GRID_EXTENSION}'
+    np.savez(tmp_file, **arrays)
+    os.replace(tmp_file, grid_file)
+
+def load_grid(grid_file):
+    """Load a grid written by `save_grid`.
+
+    Returns
+    -------
+    grid : GridTables
+    """
+    grid = GridTables()
+    with np.load(grid_file) as arrays:
+        grid.sn_mva = float(arrays['sn_mva'])
+        grid.f_hz = float(arrays['f_hz'])
+        for (element, columns) in GRID_COLUMNS.items():
+            grid[element] = pd.DataFrame(
+                {column: arrays[f'{element}/{column}'] for column in columns
+                 if f'{element}/{column}' in arrays},
+                index=pd.Index(arrays[f'{element}/index']))
+        if 'config_hash' in arrays:
+            grid.config_hash = str(arrays['config_hash'])
+        if 'inner_line_idx' in arrays:
+            grid.inner_line_idx = pd.Index(arrays['inner_line_idx'])
+
+    # Maps for indexing tables by element name, as in create_toy_model
+    for element in NAME_MAPS:
+        names = grid[element]['name']
+        grid[f'{element}_name_map'] = pd.Series(names.index, index=names)
+    return grid
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Build a toy model and save it as a grid file.')
+    parser.add_argument('config_file', help='model configuration')
+    parser.add_argument('grid_file', help=f'output {GRID_EXTENSION} file')
+    parser.add_argument('--substations', type=int,
+                        help='number of central substations')
+    args = parser.parse_args()
+
+    from pp_toy_model import create_toy_model
+    save_grid(create_toy_model(args.config_file,
+                               substations=args.substations),
+              args.grid_file)
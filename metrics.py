@@ -1,28 +1,182 @@
+import numpy as np
+import pandas as pd
+
+# Zones of lines counted as inner: both endpoints in one of these zones
+INNER_ZONES = ('center', 'inner')
+
+def inner_lines(net):
+    """Index of lines with both endpoints in the center or inner zone.
+    
+    Uses the index precomputed by `create_toy_model` when available.
+    """
+    if hasattr(net, 'inner_line_idx'):
+        return net.inner_line_idx
+    zones = net.bus['zone']
+    from_inner = zones.loc[net.line['from_bus']].isin(INNER_ZONES).values
+    to_inner = zones.loc[net.line['to_bus']].isin(INNER_ZONES).values
+    return net.line.index[from_inner & to_inner]
+
 METRICS = {'max_loading_inner':   lambda net: net.res_line
-                                                 .loc[:7, 'loading_percent']
+                                                 .loc[inner_lines(net),
+                                                      'loading_percent']
                                                  .max(),
            'max_loading_all':     lambda net: net.res_line
                                                  .loc[:, 'loading_percent']
                                                  .max(),
            'avg_loading_inner':   lambda net: net.res_line
+                                                 .loc[inner_lines(net)]
                                                  .loc[net.line['in_service'] == True]
-                                                 .loc[:7, 'loading_percent'].mean(),
+                                                 .loc[:, 'loading_percent'].mean(),
            'avg_loading_all':     lambda net: net.res_line
                                                  .loc[net.line['in_service'] == True]
                                                  .loc[:, 'loading_percent']
                                                  .mean(),
            'total_current_inner': lambda net: net.res_line
-                                                 .loc[:7, 'i_ka']
+                                                 .loc[inner_lines(net), 'i_ka']
                                                  .sum(),
            'total_current_all':   lambda net: net.res_line
                                                  .loc[:, 'i_ka']
                                                  .sum()}
 
+# Vectorizable form of METRICS: (quantity, lines, reduction)
+# Reduction 'mean' only averages over lines in service
+METRIC_SPECS = {'max_loading_inner':   ('loading_percent', 'inner', 'max'),
+                'max_loading_all':     ('loading_percent', 'all', 'max'),
+                'avg_loading_inner':   ('loading_percent', 'inner', 'mean'),
+                'avg_loading_all':     ('loading_percent', 'all', 'mean'),
+                'total_current_inner': ('i_ka', 'inner', 'sum'),
+                'total_current_all':   ('i_ka', 'all', 'sum')}
+
 def create_metrics(metric_names):
     return [(metric_name, METRICS[metric_name]) for metric_name in metric_names]
 
+class MetricEngine:
+    """Evaluates a list of metrics on raw line result arrays.
+    
+    Metrics with an entry in `METRIC_SPECS` are computed together: line
+    subsets are resolved to positions once, and the in-service mask is
+    computed once per evaluation. Other metrics fall back to calling their
+    function on the network.
+    
+    Parameters
+    ----------
+    net : pandapowerNet
+        Network the metrics are evaluated on.
+    metrics : list
+        Output of `create_metrics`.
+    """
+    
+    def __init__(self, net, metrics):
+        self.net = net
+        self.names = pd.Index([metric_name for metric_name, _ in metrics])
+        self.line_pos = {'all': np.arange(len(net.line.index)),
+                         'inner': net.line.index.get_indexer(inner_lines(net))}
+        
+        # Group compiled metrics by the line results they read
+        self.groups = {}
+        self.fallback = []
+        for m, (metric_name, metric_func) in enumerate(metrics):
+            if (metric_name in METRIC_SPECS 
+                and metric_func is METRICS[metric_name]):
+                quantity, lines, reduction = METRIC_SPECS[metric_name]
+                self.groups.setdefault((quantity, lines), []).append(
+                    (m, reduction))
+            else:
+                self.fallback.append((m, metric_func))
+    
+    def evaluate_batch(self, res, in_service=None):
+        """Evaluate metrics for a batch of steps.
+        
+        Parameters
+        ----------
+        res : dict
+            Maps 'loading_percent' and 'i_ka' to arrays of shape 
+            (steps, lines) in line table order.
+        in_service : ndarray, optional
+            Line in-service mask, of shape (lines,) or (steps, lines).
+            The default is the current state of the network.
+        
+        Returns
+        -------
+        values : ndarray
+            Array of shape (steps, metrics).
+        """
+        if in_service is None:
+            in_service = self.net.line['in_service'].values.astype(bool)
+        n_steps = len(next(iter(res.values())))
+        in_service = np.broadcast_to(in_service, 
+                                     (n_steps, len(self.line_pos['all'])))
+        
+        values = np.empty((n_steps, len(self.names)))
+        for (quantity, lines), reductions in self.groups.items():
+            pos = self.line_pos[lines]
+            x = np.asarray(res[quantity])[:, pos]
+            for (m, reduction) in reductions:
+                values[:, m] = _reduce(x, reduction, in_service[:, pos])
+        
+        # Metrics without vectorized form are evaluated step by step
+        if self.fallback:
+            for n, row in enumerate(_fallback_values(self, res, in_service)):
+                values[n, [m for m, _ in self.fallback]] = row
+        return values
+    
+    def evaluate(self, net=None):
+        """Evaluate metrics on the current power flow results of `net`."""
+        net = self.net if net is None else net
+        res = {quantity: net.res_line[quantity].values[None]
+               for quantity in ['loading_percent', 'i_ka']}
+        values = self.evaluate_batch(res, net.line['in_service'].values
+                                           .astype(bool))
+        return pd.Series(values[0], index=self.names)
+    
+    def frame(self, res, index=None, in_service=None):
+        """Like `evaluate_batch`, but returns a frame indexed by step."""
+        return pd.DataFrame(self.evaluate_batch(res, in_service), 
+                            index=index, columns=self.names)
+
+def _reduce(x, reduction, mask):
+    
+    # NaN handling follows pandas: NaN values are skipped
+    if reduction == 'max':
+        if x.shape[1] == 0:
+            return np.nan
+        return np.fmax.reduce(x, axis=1)
+    elif reduction == 'sum':
+        return np.nansum(x, axis=1)
+    elif reduction == 'mean':
+        valid = mask & ~np.isnan(x)
+        count = valid.sum(axis=1)
+        total = np.where(valid, x, 0.).sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(count > 0, total/count, np.nan)
+    raise ValueError(f'Unknown reduction: {reduction}')
+
+def _fallback_values(engine, res, in_service):
+    from types import SimpleNamespace
+    
+    # Write every step to a copy of the line results before each call
+    net = engine.net
+    line = net.line.copy()
+    res_line = pd.DataFrame({'loading_percent': 0., 'i_ka': 0.},
+                            index=net.line.index)
+    view = SimpleNamespace(line=line, bus=net.bus, res_line=res_line)
+    
+    # Bus results, where given for the whole bus table
+    bus_quantities = [quantity for quantity in ['vm_pu', 'va_degree']
+                      if quantity in res 
+                      and np.shape(res[quantity])[1] == len(net.bus.index)]
+    if bus_quantities:
+        view.res_bus = pd.DataFrame(0., index=net.bus.index,
+                                    columns=bus_quantities)
+    for n in range(len(in_service)):
+        line['in_service'] = in_service[n]
+        for quantity in ['loading_percent', 'i_ka']:
+            res_line[quantity] = res[quantity][n]
+        for quantity in bus_quantities:
+            view.res_bus[quantity] = res[quantity][n]
+        yield [metric_func(view) for _, metric_func in engine.fallback]
+
 def apply_load_gen_noise(net, mean_outer_mw=10000, std_outer_mw=2000, mean_inner_mw=5000, std_inner_mw=1000):
-    import numpy as np
     
     # Total deviation in MW
     dev_outer_mw = np.random.normal(mean_outer_mw, std_outer_mw)
@@ -62,4 +216,47 @@ def apply_load_gen_noise(net, mean_outer_mw=10000, std_outer_mw=2000, mean_inner
     
     # Apply noise to network
     net.load.loc[:4, 'p_mw'] += load_noise_inner
-    net.gen.loc[:4, 'p_mw'] += gen_noise_inner
\ No newline at end of file
+    net.gen.loc[:4, 'p_mw'] += gen_noise_inner
+
+def sample_load_gen_noise(load_p_mw, gen_p_mw, length, rng=None,
+                          mean_outer_mw=10000, std_outer_mw=2000,
+                          mean_inner_mw=5000, std_inner_mw=1000):
+    """Draw many noisy load and generator profiles at once.
+    
+    Follows the same distribution as `apply_load_gen_noise` applied to
+    tables with the given base active powers, but draws all steps as
+    arrays in one go.
+    
+    Parameters
+    ----------
+    load_p_mw, gen_p_mw : array-like
+        Base active power of loads and generators in table order.
+    length : int
+        Number of noisy profiles to draw.
+    rng : numpy.random.Generator or int, optional
+        Random generator or seed. The default is a fresh generator.
+    
+    Returns
+    -------
+    load, gen : ndarray
+        Arrays of shape (length, loads) and (length, generators).
+    """
+    rng = np.random.default_rng(rng)
+    load = np.tile(np.asarray(load_p_mw, dtype=float), (length, 1))
+    gen = np.tile(np.asarray(gen_p_mw, dtype=float), (length, 1))
+    
+    # Outer (table rows 5 to 8) and inner (rows 0 to 4) loads and generators
+    for (rows, mean_mw, std_mw) in [(slice(5, 9), mean_outer_mw, std_outer_mw),
+                                    (slice(0, 5), mean_inner_mw, std_inner_mw)]:
+        
+        # Total deviation in MW, shared by loads and generators
+        dev_mw = rng.normal(mean_mw, std_mw, size=(length, 1))
+        
+        for p in (load, gen):
+            
+            # Generate noise, normalize to distribution and scale
+            noise = rng.uniform(0, p[:, rows])
+            noise /= noise.sum(axis=1, keepdims=True)
+            p[:, rows] += noise*dev_mw
+            
+    return load, gen
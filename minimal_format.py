@@ -1,52 +1,142 @@
+import os
 from itertools import chain
+
+import numpy as np
 import pandas as pd
 
 import pp_toy_model
 from network_topology_optimization.grid.data import Grid, GridParams
 from network_topology_optimization.grid.powerflow import GridData
 
-def create_toy_model(config_file='config/example_config.yaml'):
+# Input file, element prefix and factor from MW to W of the injections
+INJECTION_FILES = (('load', 'load_p_mw', -10**6),
+                   ('gen', 'gen_p_mw', 10**6))
+
+def create_toy_model(config_file='config/example_config.yaml', cache=True):
     
-    net = pp_toy_model.create_toy_model(config_file=config_file)
+    net = pp_toy_model.create_toy_model(config_file=config_file, cache=cache)
     
-    cn_list = {'line_' + c.name: frozenset({net.bus.loc[c.from_bus]['name'],
-                                            net.bus.loc[c.to_bus]['name']})
-               for c in net.line.itertuples()}
+    # Bus names of element endpoints, looked up for all elements at once
+    bus_names = net.bus['name']
+    line_names = 'line_' + net.line['name']
+    load_names = 'load_' + net.load['name']
+    gen_names = 'gen_' + net.gen['name']
+    from_names = bus_names.loc[net.line['from_bus']].values
+    to_names = bus_names.loc[net.line['to_bus']].values
     
-    ln_list = {'load_' + l.name: net.bus.loc[l.bus]['name']
-               for l in net.load.itertuples()}
+    cn_list = dict(zip(line_names, map(frozenset, zip(from_names, 
+                                                      to_names))))
     
-    gn_list = {'gen_' + g.name: net.bus.loc[g.bus]['name']
-               for g in net.gen.itertuples()}
+    ln_list = dict(zip(load_names, bus_names.loc[net.load['bus']].values))
     
-    y_list = {'line_' + c.name: 1/complex(real=c.r_ohm_per_km,
-                                          imag=c.x_ohm_per_km)
-              for c in net.line.itertuples()}
+    gn_list = dict(zip(gen_names, bus_names.loc[net.gen['bus']].values))
     
-    s_list = {g: 1/len(net.gen.index)
-              for g in gn_list}
+    y_list = {name: 1/complex(real=r, imag=x)
+              for (name, r, x) in zip(line_names, 
+                                      net.line['r_ohm_per_km'].values,
+                                      net.line['x_ohm_per_km'].values)}
     
-    v_list = {e: net.bus['vn_kv'][0]*10**3
-              for e in chain(cn_list, ln_list, gn_list)}
+    s_list = dict.fromkeys(gn_list, 1/len(net.gen.index))
+    
+    v_list = dict.fromkeys(chain(cn_list, ln_list, gn_list), 
+                           net.bus['vn_kv'][0]*10**3)
     
     p_base = 10**9
     
     return (Grid(cn_list, ln_list, gn_list),
             GridParams(y_list, s_list, v_list, p_base))
 
-def grid_data(path):
+def _injection_frames(path, chunk_size):
     
-    load = pd.read_csv(path + 'load_p_mw.csv', index_col=0)
-    gen = pd.read_csv(path + 'gen_p_mw.csv', index_col=0)
+    # Simulation directories stream through the input reader, which 
+    # memory-maps binary inputs when they exist
+    if os.path.isfile(path + 'input_config.yaml'):
+        from simulations import InputReader, count_steps
+        
+        reader = InputReader(path, 0, count_steps(path), chunk_size)
+        for eq_frame_dict in reader:
+            yield [eq_frame_dict[(element, 'p_mw')] 
+                   for (element, _, _) in INJECTION_FILES]
+        return
+        
+    readers = [pd.read_csv(path + f'{name}.csv', index_col=0, 
+                           chunksize=chunk_size)
+               for (_, name, _) in INJECTION_FILES]
+    yield from zip(*readers)
+
+def injection_columns(path):
+    """Names of the injections in the column order of `iter_injections`."""
+    columns = []
+    for (element, name, _) in INJECTION_FILES:
+        header = pd.read_csv(path + f'{name}.csv', index_col=0, nrows=0)
+        columns += list(element + '_' + header.columns)
+    return columns
+
+def iter_injections(path, chunk_size=10000, columns=None):
+    """Stream active power injections in W as NumPy arrays.
     
-    load.columns = 'load_' + load.columns
-    gen.columns = 'gen_' + gen.columns
+    Loads are negative and generators positive, as in `grid_data`. Each
+    chunk is one array of shape (steps, injections) with a fixed column
+    order, so rows are views instead of dictionaries.
     
-    p = pd.concat([-load*(10**6), gen*(10**6)], axis=1)
+    Parameters
+    ----------
+    path : str
+        Directory of load_p_mw.csv and gen_p_mw.csv, e.g. a simulation
+        directory.
+    chunk_size : int
+        Number of steps per chunk.
+    columns : list of str, optional
+        Injection names, e.g. 'load_inner_north', in the order of the
+        array columns. The default is `injection_columns(path)`.
+        
+    Yields
+    ------
+    index : Index
+        Steps of the chunk.
+    p : ndarray
+        Injections of the chunk, shape (steps, injections).
+    """
+    order = None
+    for frames in _injection_frames(path, chunk_size):
+        n_steps = min(len(frame.index) for frame in frames)
+        if order is None:
+            names = pd.Index([f'{element}_{column}' 
+                              for ((element, _, _), frame) 
+                              in zip(INJECTION_FILES, frames)
+                              for column in frame.columns])
+            order = (np.arange(len(names)) if columns is None 
+                     else names.get_indexer(columns))
+            if (order < 0).any():
+                raise KeyError(f'Unknown injections: '
+                               f'{list(pd.Index(columns)[order < 0])}')
+            
+        p = np.concatenate([frame.values[:n_steps]*factor
+                            for ((_, _, factor), frame) 
+                            in zip(INJECTION_FILES, frames)], axis=1)
+        yield frames[0].index[:n_steps], p[:, order]
+        
+        # Inputs end with the shorter of the two files
+        if any(len(frame.index) > n_steps for frame in frames):
+            return
+
+def injection_matrix(path, columns=None, chunk_size=100000):
+    """All injections of `iter_injections` in a single array."""
+    chunks = list(iter_injections(path, chunk_size, columns))
+    if len(chunks) == 0:
+        return pd.Index([]), np.empty((0, 0))
+    return (chunks[0][0].append([index for (index, _) in chunks[1:]]),
+            np.concatenate([p for (_, p) in chunks]))
+
+def grid_data(path, chunk_size=10000):
     
-    for i in range(min(len(load.index), len(gen.index))):
-        yield GridData(p_list=dict(p.loc[i, :]), q_list={}, mag_list={})
+    # Per-step GridData objects, kept for compatibility
+    columns = injection_columns(path)
+    for (_, p) in iter_injections(path, chunk_size, columns):
+        for p_row in p.tolist():
+            yield GridData(p_list=dict(zip(columns, p_row)), q_list={}, 
+                           mag_list={})
 
 if __name__ == '__main__':
     
-    grid, params = create_toy_model()
\ No newline at end of file
+    grid, params = create_toy_model()
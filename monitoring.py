@@ -0,0 +1,206 @@
+import json
+import time
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+__all__ = ['PHASES',
+           'StepRecord',
+           'SimulationMonitor',
+           'merge_summaries']
+
+# Phases of a simulation step, in order of execution
+PHASES = ('set_inputs', 'step', 'metrics', 'write')
+
+# Outcome of one simulation step, passed to the monitor callbacks
+StepRecord = namedtuple('StepRecord', ['step', 'seconds', 'converged',
+                                       'iterations', 'error'])
+
+class SimulationMonitor:
+    """Times the phases of simulation steps and records their outcome.
+
+    Pass a monitor to `simulations.run_simulations` to time, per step,
+    applying the inputs, the step function without its metrics, the
+    metrics and writing the results. Metrics are timed by wrapping the
+    metric functions. After each step, the power flow convergence and
+    iteration count are read from the network, and every callback is
+    called with a `StepRecord`. Without a monitor, the simulation loop
+    runs uninstrumented.
+
+    Parameters
+    ----------
+    callbacks : list of callable, optional
+        Functions called with the `StepRecord` of every step.
+    skip_failed : bool
+        Log NaN results for steps whose step function raises, e.g. as the
+        power flow did not converge, and continue. Otherwise the error is
+        counted and raised.
+    save_summary : bool
+        Write the summary next to the results when the run ends.
+    """
+
+    def __init__(self, callbacks=None, skip_failed=False, save_summary=True):
+        self.callbacks = list(callbacks or [])
+        self.skip_failed = skip_failed
+        self.save_summary = save_summary
+        self.phase_total = dict.fromkeys(PHASES, 0.)
+        self.phase_max = dict.fromkeys(PHASES, 0.)
+        self.steps = 0
+        self.failed_steps = []
+        self.converged = 0
+        self.iterations = {}
+        self.wall_seconds = 0.
+        self._metric_seconds = 0.
+
+    def wrap_metrics(self, metrics):
+        """Metrics that add their evaluation time to the metrics phase."""
+        def timed(metric):
+            def timed_metric(net):
+                start = time.perf_counter()
+                try:
+                    return metric(net)
+                finally:
+                    self._metric_seconds += time.perf_counter() - start
+            return timed_metric
+        return [(name, timed(metric)) for (name, metric) in metrics]
+
+    def run(self, l, set_eq, simulation_step_func, net, metrics, start, stop,
+            progress_bar):
+        """Run and log simulation steps `start` to `stop`.
+
+        Counterpart of `simulations._run_steps`, with `set_eq(net, n)`
+        applying the inputs of step `n` separately from the step function.
+        """
+        metrics = self.wrap_metrics(metrics)
+        if l.last_run is not None:
+            start = max(start, l.last_run + 1)
+
+        # Failed steps before the first result wait for the column names
+        pending = []
+        wall_start = time.perf_counter()
+        try:
+            for n in progress_bar(range(start, stop)):
+                seconds, results, error = self._run_step(
+                    n, set_eq, simulation_step_func, net, metrics)
+
+                write_start = time.perf_counter()
+                if results is not None and not l.header:
+                    l.write_header(results.index)
+                    for failed in pending:
+                        l.write_res(failed, self._failed_results(l))
+                    pending = []
+                if results is not None:
+                    l.write_res(n, results)
+                elif l.header:
+                    l.write_res(n, self._failed_results(l))
+                else:
+                    pending.append(n)
+                seconds['write'] = time.perf_counter() - write_start
+
+                self._record(n, seconds, net, error)
+        finally:
+            self.wall_seconds += time.perf_counter() - wall_start
+
+    def _run_step(self, n, set_eq, simulation_step_func, net, metrics):
+        seconds = {}
+        start = time.perf_counter()
+        set_eq(net, n)
+        seconds['set_inputs'] = time.perf_counter() - start
+
+        self._metric_seconds = 0.
+        start = time.perf_counter()
+        try:
+            results = simulation_step_func(net, metrics)
+            error = None
+        except Exception as step_error:
+            if not self.skip_failed:
+                self._record(n, self._step_seconds(seconds, start), net,
+                             step_error)
+                raise
+            results, error = None, step_error
+        return self._step_seconds(seconds, start), results, error
+
+    def _step_seconds(self, seconds, start):
+        seconds['step'] = (time.perf_counter() - start
+                           - self._metric_seconds)
+        seconds['metrics'] = self._metric_seconds
+        return seconds
+
+    @staticmethod
+    def _failed_results(l):
+        return pd.Series(np.nan, index=l.columns)
+
+    def _record(self, n, seconds, net, error):
+        seconds = {phase: seconds.get(phase, 0.) for phase in PHASES}
+        for (phase, value) in seconds.items():
+            self.phase_total[phase] += value
+            self.phase_max[phase] = max(self.phase_max[phase], value)
+
+        # Power flow outcome as stored by Pandapower
+        converged = bool(net.get('converged', False)) and error is None
+        ppc = net.get('_ppc') or {}
+        iterations = ppc.get('iterations')
+        if iterations is not None:
+            iterations = int(iterations)
+            self.iterations[iterations] = (self.iterations.get(iterations, 0)
+                                           + 1)
+
+        self.steps += 1
+        self.converged += converged
+        if error is not None:
+            self.failed_steps.append(n)
+
+        record = StepRecord(n, seconds, converged, iterations,
+                            None if error is None else repr(error))
+        for callback in self.callbacks:
+            callback(record)
+
+    def summary(self):
+        """Totals of all monitored steps as a JSON-serializable dict."""
+        steps = max(self.steps, 1)
+        counted = sum(self.iterations.values())
+        return {'steps': self.steps,
+                'wall_seconds': self.wall_seconds,
+                'steps_per_s': (self.steps/self.wall_seconds
+                                if self.wall_seconds > 0 else None),
+                'phases': {phase: {'total': self.phase_total[phase],
+                                   'mean': self.phase_total[phase]/steps,
+                                   'max': self.phase_max[phase]}
+                           for phase in PHASES},
+                'converged': self.converged,
+                'not_converged': self.steps - self.converged,
+                'failed': len(self.failed_steps),
+                'failed_steps': self.failed_steps,
+                'iterations': {
+                    'mean': (sum(k*v for (k, v) in self.iterations.items())
+                             /counted if counted else None),
+                    'max': max(self.iterations, default=None),
+                    'histogram': {str(k): v for (k, v)
+                                  in sorted(self.iterations.items())}}}
+
+    def write_summary(self, summary_file, summary=None):
+        with open(summary_file, 'w') as summary_json:
+            json.dump(self.summary() if summary is None else summary,
+                      summary_json, indent=2)
+
+def merge_summaries(summaries):
+    """Combine the summaries of monitors that ran in parallel.
+
+    Phase and wall times are summed, so `steps_per_s` is the throughput
+    of a single worker.
+    """
+    monitor = SimulationMonitor()
+    for summary in summaries:
+        monitor.steps += summary['steps']
+        monitor.wall_seconds += summary['wall_seconds']
+        monitor.converged += summary['converged']
+        monitor.failed_steps += summary['failed_steps']
+        for (phase, times) in summary['phases'].items():
+            monitor.phase_total[phase] += times['total']
+            monitor.phase_max[phase] = max(monitor.phase_max[phase],
+                                           times['max'])
+        for (k, v) in summary['iterations']['histogram'].items():
+            monitor.iterations[int(k)] = monitor.iterations.get(int(k), 0) + v
+    monitor.failed_steps.sort()
+    return monitor.summary()
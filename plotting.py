@@ -1,5 +1,8 @@
-import seaborn as sns
-import matplotlib.pyplot as plt
+from collections import namedtuple
+
+import numpy as np
+
+from result_store import load_results, iter_results
 
 LABELS = {'max_loading_inner': 'Max loading inner (%)',
           'max_loading_all': 'Max loading all (%)',
@@ -12,6 +15,9 @@ HUE_LABELS = {'line_cuts': 'Number of lines cut',
               'node_split': 'Number of substations split'}
 
 def compare_to_main(res_df, metrics_to_compare, topo_metric, hue=None, height=4, **kwargs):
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+    
     x, y = [], []
     for metric in metrics_to_compare:
         x.append(f'{metric}')
@@ -20,6 +26,10 @@ def compare_to_main(res_df, metrics_to_compare, topo_metric, hue=None, height=4,
     if hue:
         data_subset.append(f'{hue}_best_{topo_metric}')
         
+    # Read only the compared columns when given a simulation directory
+    if isinstance(res_df, str):
+        res_df = load_results(res_df, columns=data_subset)
+        
     res_df = res_df[data_subset].copy()
     
     x = [f'{LABELS[metric]}, main topology' for metric in metrics_to_compare]
@@ -36,4 +46,224 @@ def compare_to_main(res_df, metrics_to_compare, topo_metric, hue=None, height=4,
     grid.set(**kwargs)
     grid.fig.subplots_adjust(top=0.9)
     grid.fig.suptitle(f'Best: {LABELS[topo_metric]}', fontsize=20)
-    return grid
\ No newline at end of file
+    return grid
+
+# Step counts of main-vs-best metric pairs on a grid, see `binned_counts`
+BinnedCounts = namedtuple('BinnedCounts', ['x', 'y', 'edges', 'categories',
+                                           'counts'])
+
+def _iter_frames(res_df, columns, chunk_size):
+    if isinstance(res_df, str):
+        yield from iter_results(res_df, columns=columns,
+                                chunk_size=chunk_size)
+    else:
+        for start in range(0, len(res_df), chunk_size):
+            yield res_df.iloc[start:start + chunk_size][columns]
+
+def _bin_index(values, edges):
+    bins = len(edges) - 1
+    lo, hi = edges[0], edges[-1]
+    valid = (values >= lo) & (values <= hi)
+    index = np.zeros(len(values), dtype=np.int64)
+    index[valid] = np.minimum(((values[valid] - lo)/(hi - lo)*bins)
+                              .astype(np.int64), bins - 1)
+    return index, valid
+
+def binned_counts(res_df, metrics_to_compare, topo_metric, hue=None,
+                  bins=100, limits=None, chunk_size=100000):
+    """Count steps per bin of every main-vs-best metric pair.
+
+    Results are read in chunks of `chunk_size` rows, so memory use does
+    not depend on the number of steps. Without `limits` for all compared
+    columns, a first pass over the results finds their ranges. Rows with
+    NaN in a pair, or outside the limits, are not counted.
+
+    Parameters
+    ----------
+    res_df : DataFrame or str
+        Results, or a simulation directory to read them from.
+    metrics_to_compare : list of str
+        Metrics of the main topology, compared to the same metrics of the
+        best topology.
+    topo_metric : str
+        Metric by which the best topology was selected.
+    hue : str, optional
+        'line_cuts' or 'node_split', counted separately per value.
+    bins : int
+        Number of bins per axis.
+    limits : dict, optional
+        Maps result columns to (min, max) of their bins.
+    chunk_size : int
+        Number of rows processed at once.
+
+    Returns
+    -------
+    counts : BinnedCounts
+        Result columns `x` and `y`, bin `edges` per column, the hue
+        `categories` and the `counts` of shape (len(y), len(x),
+        categories, bins, bins), indexed by the x and then the y bin.
+    """
+    x = [f'{metric}' for metric in metrics_to_compare]
+    y = [f'{metric}_best_{topo_metric}' for metric in metrics_to_compare]
+    columns = list(dict.fromkeys(x + y))
+    hue_column = f'{hue}_best_{topo_metric}' if hue else None
+    read_columns = columns + ([hue_column] if hue else [])
+    limits = dict(limits or {})
+
+    # Ranges and hue categories of all results
+    categories = np.zeros(1)
+    missing = [column for column in columns if column not in limits]
+    if missing or hue:
+        lo = dict.fromkeys(missing, np.inf)
+        hi = dict.fromkeys(missing, -np.inf)
+        found = set()
+        for res_chunk in _iter_frames(res_df, read_columns, chunk_size):
+            for column in missing:
+                values = res_chunk[column].values
+                if len(values) and not np.isnan(values).all():
+                    lo[column] = min(lo[column], np.nanmin(values))
+                    hi[column] = max(hi[column], np.nanmax(values))
+            if hue:
+                values = res_chunk[hue_column].values
+                found.update(np.unique(values[~np.isnan(values)]))
+        for column in missing:
+            if lo[column] > hi[column]:
+                lo[column], hi[column] = 0., 1.
+            elif lo[column] == hi[column]:
+                lo[column], hi[column] = lo[column] - 0.5, hi[column] + 0.5
+            limits[column] = (lo[column], hi[column])
+        if hue:
+            categories = np.array(sorted(found))
+    edges = {column: np.linspace(*limits[column], bins + 1)
+             for column in columns}
+
+    # Flat bin codes of (category, x bin, y bin), counted per pair
+    n_cat = len(categories)
+    counts = np.zeros((len(y), len(x), n_cat*bins*bins), dtype=np.int64)
+    for res_chunk in _iter_frames(res_df, read_columns, chunk_size):
+        index = {column: _bin_index(res_chunk[column].values, edges[column])
+                 for column in columns}
+        if hue:
+            values = res_chunk[hue_column].values
+            code = np.searchsorted(categories, values)*bins*bins
+            in_category = np.isin(values, categories)
+        else:
+            code = 0
+            in_category = True
+        for (j, y_column) in enumerate(y):
+            (y_index, y_valid) = index[y_column]
+            for (i, x_column) in enumerate(x):
+                (x_index, x_valid) = index[x_column]
+                valid = x_valid & y_valid & in_category
+                flat = (code + x_index*bins + y_index)[valid]
+                counts[j, i] += np.bincount(flat, minlength=n_cat*bins*bins)
+    counts = counts.reshape(len(y), len(x), n_cat, bins, bins)
+    return BinnedCounts(x, y, edges, categories, counts)
+
+def _alpha_cmap(color):
+    from matplotlib.colors import ListedColormap, to_rgb
+
+    colors = np.ones((256, 4))
+    colors[:, :3] = to_rgb(color)
+    colors[:, 3] = np.linspace(0.1, 1, 256)
+    return ListedColormap(colors)
+
+def _plot_bins(ax, count, x_edges, y_edges, kind, bins, cmap):
+    from matplotlib.colors import LogNorm
+
+    if count.max() == 0:
+        return None
+    norm = LogNorm(vmin=1, vmax=max(count.max(), 2))
+    if kind == 'hex':
+        x_centers = (x_edges[:-1] + x_edges[1:])/2
+        y_centers = (y_edges[:-1] + y_edges[1:])/2
+        (x_grid, y_grid) = np.meshgrid(x_centers, y_centers, indexing='ij')
+        filled = count > 0
+        return ax.hexbin(x_grid[filled], y_grid[filled], C=count[filled],
+                         reduce_C_function=np.sum, gridsize=max(bins//2, 1),
+                         extent=(x_edges[0], x_edges[-1],
+                                 y_edges[0], y_edges[-1]),
+                         cmap=cmap, norm=norm)
+    return ax.pcolormesh(x_edges, y_edges,
+                         np.ma.masked_equal(count, 0).T,
+                         cmap=cmap, norm=norm)
+
+def compare_to_main_binned(res_df, metrics_to_compare, topo_metric, hue=None,
+                           height=4, bins=100, kind='hist', limits=None,
+                           chunk_size=100000, **kwargs):
+    """Aggregated counterpart of `compare_to_main` for large results.
+
+    Instead of drawing every step, main-vs-best metric pairs are binned
+    with `binned_counts` and drawn as 2-D histograms (`kind='hist'`) or
+    hexbins (`kind='hex'`) with a logarithmic color scale. Rendering time
+    depends on the number of bins only. With `hue`, every category is a
+    density layer in its own color, normalized per category so that rare
+    categories stay visible.
+
+    Parameters
+    ----------
+    res_df : DataFrame or str
+        Results, or a simulation directory to read them from in chunks.
+    metrics_to_compare, topo_metric, hue
+        As in `compare_to_main`.
+    height : float
+        Height and width of each subplot in inches.
+    bins : int
+        Number of bins per axis.
+    kind : str
+        'hist' or 'hex'.
+    limits : dict, optional
+        Maps result columns to (min, max) of their bins.
+    chunk_size : int
+        Number of rows read at once.
+    **kwargs
+        Axes properties set on every subplot.
+
+    Returns
+    -------
+    fig : Figure
+    """
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+    from matplotlib.patches import Patch
+
+    binned = binned_counts(res_df, metrics_to_compare, topo_metric, hue=hue,
+                           bins=bins, limits=limits, chunk_size=chunk_size)
+    (fig, axes) = plt.subplots(len(binned.y), len(binned.x), squeeze=False,
+                               sharex='col', sharey='row',
+                               figsize=(height*len(binned.x),
+                                        height*len(binned.y)))
+    if hue:
+        colors = sns.color_palette(n_colors=len(binned.categories))
+        cmaps = [_alpha_cmap(color) for color in colors]
+    else:
+        cmaps = ['viridis']
+
+    mesh = None
+    for (j, y_column) in enumerate(binned.y):
+        for (i, x_column) in enumerate(binned.x):
+            ax = axes[j, i]
+            for (c, cmap) in enumerate(cmaps):
+                mesh = _plot_bins(ax, binned.counts[j, i, c],
+                                  binned.edges[x_column],
+                                  binned.edges[y_column], kind, bins,
+                                  cmap) or mesh
+            ax.axline(xy1=(0, 0), xy2=(1, 1), color='r', dashes=(5, 2))
+            if j == len(binned.y) - 1:
+                ax.set_xlabel(f'{LABELS[metrics_to_compare[i]]}, '
+                              f'main topology')
+            if i == 0:
+                ax.set_ylabel(f'{LABELS[metrics_to_compare[j]]}, '
+                              f'best topology')
+            ax.set(**kwargs)
+
+    fig.subplots_adjust(top=0.9, right=0.85, wspace=0.25)
+    if hue:
+        handles = [Patch(color=color, label=f'{category:g}')
+                   for (color, category) in zip(colors, binned.categories)]
+        fig.legend(handles=handles, title=HUE_LABELS[hue],
+                   loc='center right')
+    elif mesh is not None:
+        fig.colorbar(mesh, ax=axes, label='Steps')
+    fig.suptitle(f'Best: {LABELS[topo_metric]}', fontsize=20)
+    return fig
@@ -0,0 +1,173 @@
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import pandapower as pp
+
+__all__ = ['PowerFlowCache']
+
+# Result tables restored on a cache hit
+RESULT_TABLES = ('res_bus', 'res_line', 'res_load', 'res_gen', 'res_ext_grid')
+
+# Columns that define the topology and parameters of the network
+TOPOLOGY_COLUMNS = {'bus': ['vn_kv', 'in_service'],
+                    'line': ['from_bus', 'to_bus', 'length_km',
+                             'r_ohm_per_km', 'x_ohm_per_km', 'c_nf_per_km',
+                             'parallel', 'in_service'],
+                    'load': ['bus', 'in_service'],
+                    'gen': ['bus', 'slack', 'in_service'],
+                    'ext_grid': ['bus', 'in_service']}
+
+# Injection columns, quantized in MW (Mvar) or per unit
+INJECTION_COLUMNS = {'load': [('p_mw', 'mw'), ('q_mvar', 'mw'),
+                              ('scaling', 'pu')],
+                     'gen': [('p_mw', 'mw'), ('vm_pu', 'pu'),
+                             ('scaling', 'pu')],
+                     'ext_grid': [('vm_pu', 'pu'), ('va_degree', 'pu')]}
+
+# Pandapower structures of the previous solve that are reused if the
+# topology did not change
+RECYCLE = {'bus_pq': True, 'gen': True, 'trafo': False}
+
+class PowerFlowCache:
+    """AC power flow with warm starts and an LRU cache of solutions.
+
+    Use `runpp` in place of `pandapower.runpp` in a simulation step
+    function, e.g. `simulation_step`. Every solve is warm-started from the
+    voltages of the previous step, and as long as the topology does not
+    change, the internal Pandapower case is updated instead of rebuilt.
+    Solutions are cached by the topology and the injections rounded to
+    `resolution_mw` and `resolution_pu`; operating points that round to a
+    cached key skip the solve, and the cached results are copied to the
+    network. Results of hits therefore deviate from an exact solve by up
+    to the effect of the rounding.
+
+    Parameters
+    ----------
+    max_size : int
+        Maximum number of cached solutions; least recently used
+        solutions are dropped first. 0 disables the cache.
+    resolution_mw : float
+        Rounding of active and reactive power injections in the key.
+    resolution_pu : float
+        Rounding of voltage setpoints and scaling factors in the key.
+    warm_start : bool
+        Initialize each solve with the previous voltages.
+    recycle : bool
+        Reuse the internal case of the previous solve if the topology
+        did not change.
+    """
+
+    def __init__(self, max_size=1024, resolution_mw=1e-3, resolution_pu=1e-6,
+                 warm_start=True, recycle=True):
+        self.max_size = max_size
+        self.resolution = {'mw': resolution_mw, 'pu': resolution_pu}
+        self.warm_start = warm_start
+        self.recycle = recycle
+        self.cache = OrderedDict()
+        self._last = None
+        self.hits = 0
+        self.failures = 0
+        self.iterations = {'warm': [], 'cold': []}
+        self.solve_seconds = 0.
+
+    def clear(self):
+        """Drop all cached solutions and the warm-start state."""
+        self.cache.clear()
+        self._last = None
+
+    def _topology_key(self, net):
+        return b''.join(np.asarray(net[element][column].values,
+                                   dtype=float).tobytes()
+                        for (element, columns) in TOPOLOGY_COLUMNS.items()
+                        for column in columns)
+
+    def _injection_key(self, net):
+        return b''.join(np.round(np.asarray(net[element][column].values,
+                                            dtype=float)
+                                 / self.resolution[unit]).astype(np.int64)
+                        .tobytes()
+                        for (element, columns) in INJECTION_COLUMNS.items()
+                        for (column, unit) in columns)
+
+    def runpp(self, net, **kwargs):
+        """Solve the AC power flow of `net`, or restore a cached solution.
+
+        Keyword arguments are passed on to `pandapower.runpp`. A hit
+        records 0 iterations in the internal case, as read by
+        `monitoring.SimulationMonitor`.
+        """
+        topology = self._topology_key(net)
+        key = (topology, self._injection_key(net))
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            for (table, res_frame) in self.cache[key].items():
+                net[table] = res_frame.copy()
+            net['converged'] = True
+
+            # No solve ran, so the count of the previous one is not reused
+            if isinstance(net.get('_ppc'), dict):
+                net._ppc['iterations'] = 0
+            self.hits += 1
+            self._last = (id(net), topology)
+            return
+
+        # Previous solution of the same network and topology
+        warm = self._last == (id(net), topology)
+        if warm and self.warm_start:
+            kwargs.setdefault('init', 'results')
+        if warm and self.recycle:
+            kwargs.setdefault('recycle', RECYCLE)
+
+        start = time.perf_counter()
+        try:
+            pp.runpp(net, **kwargs)
+        except Exception:
+            self.failures += 1
+            self._last = None
+            raise
+        finally:
+            self.solve_seconds += time.perf_counter() - start
+
+        self.iterations['warm' if warm else 'cold'].append(
+            int(net._ppc['iterations']))
+        self._last = (id(net), topology)
+        if self.max_size > 0:
+            self.cache[key] = {table: net[table].copy()
+                               for table in RESULT_TABLES if table in net}
+            if len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+    def simulation_step(self, net, metrics):
+        """Step function for `run_simulations` using the cached solver."""
+        self.runpp(net)
+        return pd.Series({name: metric(net) for (name, metric) in metrics})
+
+    def stats(self):
+        """Hit rate and iteration counts of all calls to `runpp`.
+
+        Saved iterations are estimated with the mean iteration count of
+        solves without a previous solution as the reference, for every
+        cache hit and warm-started solve.
+        """
+        warm, cold = self.iterations['warm'], self.iterations['cold']
+        solves = len(warm) + len(cold)
+        calls = solves + self.hits + self.failures
+        cold_mean = np.mean(cold) if cold else None
+        saved = None
+        if cold_mean is not None:
+            saved = float(self.hits*cold_mean
+                          + len(warm)*cold_mean - sum(warm))
+        return {'calls': calls,
+                'hits': self.hits,
+                'hit_rate': self.hits/calls if calls else None,
+                'solves': solves,
+                'warm_solves': len(warm),
+                'failures': self.failures,
+                'cached': len(self.cache),
+                'iterations_warm_mean': float(np.mean(warm)) if warm else None,
+                'iterations_cold_mean': (None if cold_mean is None
+                                         else float(cold_mean)),
+                'iterations_saved': saved,
+                'solve_seconds': self.solve_seconds}
@@ -1,18 +1,35 @@
+import hashlib
+import os
+import pickle
+
+import numpy as np
 import pandas as pd
-import pandapower as pp
 import yaml
 
 __all__ = ['create_toy_model', 
+           'ring_layout',
            'set_eq_by_bus_name',
+           'InputPlan',
            'apply_load_from_series', 
            'apply_gen_from_series', 
            'apply_eq_from_yaml',
            'eq_yaml_parser']
 
-# Hard-coded node coordinates
-COORDS_PATH = {1: 'swiss_toy_grid/config/one_sub_coords.yaml', 
-               2: 'swiss_toy_grid/config/two_sub_coords.yaml',
-               4: 'swiss_toy_grid/config/four_sub_coords.yaml'}
+# Hard-coded node coordinates, shipped next to this module
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'config')
+COORDS_PATH = {1: os.path.join(CONFIG_DIR, 'one_sub_coords.yaml'), 
+               2: os.path.join(CONFIG_DIR, 'two_sub_coords.yaml'),
+               4: os.path.join(CONFIG_DIR, 'four_sub_coords.yaml')}
+
+# Revision of the network builder, part of the build cache key
+_BUILD_VERSION = 2
+
+# Pickled networks by build key, shared by all calls in this process
+_NET_CACHE = {}
+
+# Conventional directory of the on-disk network cache, ignored by git
+CACHE_DIR = 'net_cache'
 
 # Hard-coded mapping from zone to line type
 LINE_PARAMS_MAP = {('center', 'center'): 'internal',
@@ -21,6 +38,9 @@ LINE_PARAMS_MAP = {('center', 'center'): 'internal',
                    ('inner', 'outer'): 'internal_external',
                    ('outer', 'outer'): 'external'}
 
+# Distance between rings of computed layouts
+RING_SPACING = 2000.
+
 # Conversion of total line parameter values to per kilometer in Pandapower
 def _line_params_to_pp(params):
     pp_params = {}
@@ -34,24 +54,49 @@ def _line_params_to_pp(params):
         
     return pp_params
 
-def create_toy_model(config_file='config/example_config.yaml'):
+def create_toy_model(config_file='config/example_config.yaml', cache=True,
+                     substations=None, ring_buses=None, rings=None,
+                     cache_dir=None):
     """Generates the toy model as a Pandapower network object.
     
     The model is implemented for 1, 2 or 4 central substations.
     Number of substations, voltage and line parameters can be
     specified in the config file: see config/example_config.yaml.
     
+    If the number of ring buses or rings is given, in the config file
+    or as an argument, the layout is computed by `ring_layout` instead
+    of read from `COORDS_PATH`. Any number of substations, ring buses
+    and rings is then supported, e.g. to test how the pipeline scales
+    with the grid size.
+    
+    Networks are built once per content of the configuration files.
+    Later calls return a copy of the network built before, kept in
+    memory and, if `cache_dir` is given, in a pickle file there.
+    
     Parameters
     ----------
     config_file : str
         Path to YAML file containing model parameters. 
         The default is 'config/example_config.yaml'.
+    cache : bool
+        Reuse networks built from identical configuration files.
+        The default is True.
+    substations : int, optional
+        Number of central substations, overrides the config file.
+    ring_buses : int, optional
+        Number of buses per ring of a computed layout. The default is
+        4 per substation.
+    rings : int, optional
+        Number of rings of a computed layout. The default is 2.
+    cache_dir : str or None
+        Directory of the on-disk cache, e.g. `CACHE_DIR`. The default
+        None only caches in memory.
 
     Raises
     ------
     NotImplementedError
-        In case the number of substations specified in the
-        config file is anything other than 1, 2 or 4.
+        In case the number of substations is anything other than 
+        1, 2 or 4 and the layout is not computed.
 
     Returns
     -------
@@ -61,64 +106,220 @@ def create_toy_model(config_file='config/example_config.yaml'):
     """
     
     # Load configuration files
-    with open(config_file, 'r') as config:
-        config = yaml.safe_load(config)
-    if config['substations'] not in COORDS_PATH.keys():
-        raise NotImplementedError('This model is defined for'
-                                  ' 1, 2 or 4 substations.')
+    with open(config_file, 'rb') as config:
+        config_bytes = config.read()
+    config = yaml.safe_load(config_bytes)
+    for (key, value) in [('substations', substations),
+                         ('ring_buses', ring_buses),
+                         ('rings', rings)]:
+        if value is not None:
+            config[key] = value
+    
+    # Layout computed from its parameters
+    if 'ring_buses' in config or 'rings' in config:
+        layout = {'substations': config['substations'],
+                  'ring_buses': config.get('ring_buses', 
+                                           4*config['substations']),
+                  'rings': config.get('rings', 2)}
+        coords_config = ring_layout(**layout)
+        coords_bytes = repr(sorted(layout.items())).encode()
+        config_bytes = yaml.safe_dump(config).encode()
+    
+    # Layout read from a coordinates file
+    else:
+        if config['substations'] not in COORDS_PATH.keys():
+            raise NotImplementedError('This model is defined for'
+                                      ' 1, 2 or 4 substations.')
+        with open(COORDS_PATH[config['substations']], 'rb') as coords:
+            coords_bytes = coords.read()
+        coords_config = yaml.safe_load(coords_bytes)
+        if substations is not None:
+            config_bytes = yaml.safe_dump(config).encode()
+        
+    # Content hash of the configuration, used to key derived data
+    config_hash = hashlib.sha256(config_bytes + coords_bytes).hexdigest()
+    if not cache:
+        return _build_net(config, coords_config, config_hash)
+    
+    key = _cache_key(config_hash)
+    if key not in _NET_CACHE:
+        cache_file = (None if cache_dir is None
+                      else os.path.join(cache_dir, key[:16] + '.p'))
+        net_bytes = None if cache_file is None else _read_net_cache(cache_file)
+        if net_bytes is None:
+            net = _build_net(config, coords_config, config_hash)
+            net_bytes = pickle.dumps(net, pickle.HIGHEST_PROTOCOL)
+            if cache_file is not None:
+                _write_net_cache(cache_file, net_bytes)
+        _NET_CACHE[key] = net_bytes
         
+    # Every call unpickles its own copy, so the cached net stays unchanged
+    return pickle.loads(_NET_CACHE[key])
+
+def _cache_key(config_hash):
+    import pandapower as pp
+    
+    # Builds differ between builder revisions, and pickles between
+    # versions of the libraries whose objects they hold
+    return hashlib.sha256(f'{config_hash}:{pp.__version__}:'
+                          f'{pd.__version__}:{np.__version__}:'
+                          f'{_BUILD_VERSION}'.encode()).hexdigest()
+
+def ring_layout(substations, ring_buses, rings=2):
+    """Computed coordinates of a toy model with any number of buses.
+    
+    Ring buses are spread evenly over circles around the center, in
+    clockwise order starting from the north, and every central 
+    substation sits in front of the ring buses it connects to. Rings are
+    named 'inner', 'ring_2', ..., 'ring_{rings - 1}' and 'outer', from 
+    the center outwards; lines between rings beyond the inner ring are 
+    typed as between 'outer' rings in `LINE_PARAMS_MAP`.
+    
+    Parameters
+    ----------
+    substations : int
+        Number of central substations.
+    ring_buses : int
+        Number of buses per ring, a multiple of `substations`.
+    rings : int
+        Number of rings. The default is 2.
+
+    Raises
+    ------
+    ValueError
+        In case the ring buses cannot be distributed evenly over the
+        substations, or the layout has fewer than 3 ring buses or no ring.
+
+    Returns
+    -------
+    coords_config : dict
+        Coordinates and clockwise order of the buses, structured as the
+        files in `COORDS_PATH`, and the ring zones under 'rings'.
+    """
+    if ring_buses < 3 or rings < 1 or substations < 1:
+        raise ValueError('A layout needs at least 1 substation, 1 ring '
+                         'and 3 buses per ring.')
+    if ring_buses % substations:
+        raise ValueError(f'{ring_buses} ring buses cannot be distributed '
+                         f'over {substations} substations.')
+    
+    # Ring zones from the center outwards
+    ring_zones = ['inner', *[f'ring_{r}' for r in range(2, rings)]]
+    if rings > 1:
+        ring_zones.append('outer')
+    
+    # Zero-padded numbers as bus names, in clockwise order
+    def names(n):
+        return [f'{k:0{len(str(n - 1))}d}' for k in range(n)]
+    
+    def circle(n, radius):
+        angle = np.pi/2 - 2*np.pi*(np.arange(n) + 0.5)/n
+        xy = np.column_stack([radius*np.cos(angle), radius*np.sin(angle)])
+        return np.round(xy, 6) + 0.
+    
+    # Substations on a circle within the inner ring, unless only one
+    center_radius = RING_SPACING/2 if substations > 1 else 0.
+    center_order = names(substations)
+    ring_order = names(ring_buses)
+    coordinates = {'center': dict(zip(center_order, 
+                                      circle(substations, 
+                                             center_radius).tolist()))}
+    for (r, zone) in enumerate(ring_zones):
+        radius = center_radius + (r + 1)*RING_SPACING
+        coordinates[zone] = dict(zip(ring_order, 
+                                     circle(ring_buses, radius).tolist()))
+    
+    return {'coordinates': coordinates,
+            'order': {'ring': ring_order, 'center': center_order},
+            'rings': ring_zones}
+
+def _line_type(zones):
+    
+    # Rings beyond the inner ring are typed as the outer ring
+    zones = tuple(zone if zone in ('center', 'inner') else 'outer'
+                  for zone in zones)
+    return LINE_PARAMS_MAP[zones]
+
+def _read_net_cache(cache_file):
+    
+    # Any file that does not unpickle, whatever the error, is a miss
+    try:
+        with open(cache_file, 'rb') as cached:
+            net_bytes = cached.read()
+        pickle.loads(net_bytes)
+    except Exception:
+        return None
+    return net_bytes
+
+def _write_net_cache(cache_file, net_bytes):
+    
+    # Replace atomically, as parallel workers may build at the same time
+    tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+        with open(tmp_file, 'wb') as cached:
+            cached.write(net_bytes)
+        os.replace(tmp_file, cache_file)
+    
+    # Read-only cache directories only use the in-memory cache
+    except OSError:
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+
+def _build_net(config, coords_config, config_hash):
+    import pandapower as pp
+    
     n_subs = config['substations']
     voltage = config['voltage_kv']
-    line_params = config['parameters']
-    
-    coords_config = yaml.safe_load(open(COORDS_PATH[n_subs]))
     center_order = coords_config['order']['center']
     ring_order = coords_config['order']['ring']
     bus_coords = coords_config['coordinates']
+    ring_zones = coords_config.get('rings', ['inner', 'outer'])
+    zones = ['center', *ring_zones]
     
     # Unpack line parameters to pandapower, setting length to 1 km
-    line_params = _line_params_to_pp(line_params)
+    line_params = _line_params_to_pp(config['parameters'])
     
     # Create Pandapower Network object
     net = pp.create_empty_network()
     
-    # Inner logic for adding buses of one zone
-    def add_buses(zone, bus_coords):
-        bus_idx_map = {}
-        
-        # Specific order for adding center buses
-        if zone == 'center':
-            buses = center_order
+    # Bus names, zones and coordinates from center outwards
+    bus_rows = []
+    for zone in zones:
         
-        # General order for adding all ring buses
-        else:
-            buses = ring_order
-        
-        # Store bus indices after creating buses
-        for bus in buses:
-            name = f'{zone}_{bus}'
-            bus_idx = pp.create_bus(net, vn_kv=voltage, name=name, 
-                                    zone=zone, geodata=bus_coords[bus])
-            bus_idx_map[bus] = bus_idx
-            
-            # Add a zero-P-and-Q load to every bus
-            pp.create_load(net, bus_idx, p_mw=0, name=name)
-            
-            # Add a zero-P generator to every bus, slack if in center
-            if zone == 'center':
-                slack = True
-            else:
-                slack = False
-                
-            pp.create_gen(net, bus_idx, p_mw=0, name=name, slack=slack)
-
-        return bus_idx_map
+        # Specific order for center buses, general order for ring buses
+        buses = center_order if zone == 'center' else ring_order
+        bus_rows += [(zone, bus, f'{zone}_{bus}', 
+                      tuple(bus_coords[zone][bus])) for bus in buses]
+    bus_zones, buses, names, geodata = zip(*bus_rows)
+    
+    # Create all buses at once, with a zero-P-and-Q load and a zero-P
+    # generator on every bus, slack if in center
+    bus_idx = pp.create_buses(net, len(bus_rows), vn_kv=voltage, 
+                              name=names, zone=bus_zones, geodata=geodata)
+    pp.create_loads(net, bus_idx, p_mw=0., name=names)
+    pp.create_gens(net, bus_idx, p_mw=0., name=names,
+                   slack=[zone == 'center' for zone in bus_zones])
+    
+    # Store bus indices by zone and bus
+    bus_idx_map = {zone: {} for zone in zones}
+    for (zone, bus, idx) in zip(bus_zones, buses, bus_idx):
+        bus_idx_map[zone][bus] = idx
+    
+    # Line endpoints and types, added by the inner logic below
+    line_rows = []
+    
+    def add_lines(zones, from_buses, to_buses):
+        line_type = _line_type(zones)
+        line_rows.extend((bus_idx_map[zones[0]][from_bus],
+                          bus_idx_map[zones[1]][to_bus],
+                          f'{zones[0]}_{from_bus}_{zones[1]}_{to_bus}',
+                          line_type)
+                         for (from_bus, to_bus) in zip(from_buses, 
+                                                       to_buses))
 
     # Inner logic for adding lines between buses in center zone
     def add_center_lines(zones):
-
-        # Map zones to correct line parameters
-        params = line_params[LINE_PARAMS_MAP[zones]]
         
         # No line if only one center bus
         if n_subs == 1:
@@ -126,104 +327,52 @@ def create_toy_model(config_file='config/example_config.yaml'):
         
         # Line endpoints hard-coded as each of two center buses
         if n_subs == 2:
-            from_buses_idx = [bus_idx_map[zones[0]][center_order[0]]]
-            to_buses_idx = [bus_idx_map[zones[0]][center_order[1]]]
-            names = [f'{zones[0]}_{center_order[0]}_'
-                     f'{zones[1]}_{center_order[1]}']
+            add_lines(zones, center_order[:1], center_order[1:2])
 
         # Lines connect from one bus to the next bus in the provided order
         if n_subs > 2:
             to_buses = center_order[:]
             to_buses.append(to_buses.pop(0))
-            
-            from_buses_idx = [bus_idx_map[zones[0]][bus] 
-                              for bus in center_order]
-            to_buses_idx = [bus_idx_map[zones[1]][bus] 
-                            for bus in to_buses]
-            names = [f'{zones[0]}_{from_bus}_{zones[1]}_{to_bus}'
-                     for (from_bus, to_bus) in zip(center_order, to_buses)]
-          
-        for (from_bus, to_bus, name) in zip(from_buses_idx, 
-                                            to_buses_idx, 
-                                            names): 
-            pp.create_line_from_parameters(net, 
-                                           from_bus=from_bus, 
-                                           to_bus=to_bus,
-                                           name=name,
-                                           **params)
+            add_lines(zones, center_order, to_buses)
             
     # Inner logic for adding radial lines between zones
     def add_radial_lines(zones):
         
-        # Map zones to correct line parameters
-        params = line_params[LINE_PARAMS_MAP[zones]]
-        
         # Lines connecting to center are distributed over center buses
         if zones[0] == 'center':
             lines_per_bus = range(len(ring_order)//len(center_order))
             from_buses = [bus for bus in center_order
                           for l in lines_per_bus]
-            from_buses_idx = [bus_idx_map[zones[0]][bus] 
-                              for bus in from_buses]
         
         # Lines between rings connect buses with the same name
         else:
             from_buses = ring_order
-            
-        # Look up bus indices and create line names
-        from_buses_idx = [bus_idx_map[zones[0]][bus] 
-                          for bus in from_buses]   
-        to_buses_idx = [bus_idx_map[zones[1]][bus] 
-                        for bus in ring_order]
-        names = [f'{zones[0]}_{from_bus}_{zones[1]}_{to_bus}'
-                 for (from_bus, to_bus) in zip(from_buses, ring_order)]
-        
-        for (from_bus, to_bus, name) in zip(from_buses_idx, 
-                                            to_buses_idx, 
-                                            names): 
-            pp.create_line_from_parameters(net, 
-                                           from_bus=from_bus, 
-                                           to_bus=to_bus,
-                                           name=name,
-                                           **params)
+        add_lines(zones, from_buses, ring_order)
             
     # Inner logic for adding tangential lines within a zone
     def add_tangential_lines(zones):
         
-        # Map zones to correct line parameters
-        params = line_params[LINE_PARAMS_MAP[zones]]
-        
         # Lines connect from one bus to the next bus in the provided order
         to_buses = ring_order[:]
         to_buses.append(to_buses.pop(0))
-        
-        from_buses_idx = [bus_idx_map[zones[0]][bus] 
-                          for bus in ring_order]
-        to_buses_idx = [bus_idx_map[zones[1]][bus] 
-                        for bus in to_buses]
-        names = [f'{zones[0]}_{from_bus}_{zones[1]}_{to_bus}'
-                 for (from_bus, to_bus) in zip(ring_order, to_buses)]
-        
-        for (from_bus, to_bus, name) in zip(from_buses_idx, 
-                                            to_buses_idx, 
-                                            names): 
-            pp.create_line_from_parameters(net, 
-                                           from_bus=from_bus, 
-                                           to_bus=to_bus,
-                                           name=name,
-                                           **params)
-    
-    # Create buses from center outwards and store indices
-    bus_idx_map = {}
-    for zone in ['center', 'inner', 'outer']:
-        bus_idx_map[zone] = add_buses(zone, bus_coords[zone])
-    
-    # Add lines from center outwards and store indices
+        add_lines(zones, ring_order, to_buses)
+    
+    # Add lines from center outwards
     add_center_lines(('center', 'center'))
-    add_radial_lines(('center', 'inner'))
-    add_tangential_lines(('inner', 'inner'))
-    add_radial_lines(('inner', 'outer'))
-    add_tangential_lines(('outer', 'outer'))
+    add_radial_lines(('center', ring_zones[0]))
+    add_tangential_lines((ring_zones[0], ring_zones[0]))
+    for (inner_zone, outer_zone) in zip(ring_zones[:-1], ring_zones[1:]):
+        add_radial_lines((inner_zone, outer_zone))
+        add_tangential_lines((outer_zone, outer_zone))
+    
+    # Create all lines at once with the parameters of their type
+    from_buses, to_buses, names, line_types = zip(*line_rows)
+    params = {param: [line_params[line_type][param] 
+                      for line_type in line_types]
+              for param in ['length_km', 'r_ohm_per_km', 'x_ohm_per_km',
+                            'c_nf_per_km', 'max_i_ka']}
+    pp.create_lines_from_parameters(net, from_buses, to_buses, name=names,
+                                    std_type=None, **params)
     
     # Create maps for indexing tables by element name
     def create_name_map(element):
@@ -235,12 +384,75 @@ def create_toy_model(config_file='config/example_config.yaml'):
     net.line_name_map = create_name_map('line')
     net.load_name_map = create_name_map('load')  
     net.gen_name_map = create_name_map('gen')    
+    
+    net.config_hash = config_hash
+    
+    # Index of lines within the center and inner zones, used by metrics
+    inner = net.bus['zone'].isin(['center', 'inner'])
+    net.inner_line_idx = net.line.index[inner[net.line['from_bus']].values
+                                        & inner[net.line['to_bus']].values]
 
     return net
 
 def set_eq_by_bus_name(net, element, eq_series):
-    pp_idx = getattr(net, element + '_name_map')[eq_series.index]
-    getattr(net, element).loc[pp_idx, eq_series.name] = eq_series.values
+    rows = _rows_by_name(net, element, eq_series.index)
+    _set_column(getattr(net, element), eq_series.name, rows, 
+                eq_series.values)
+
+def _rows_by_name(net, element, names):
+    
+    # Positions of named elements in the element table
+    name_map = getattr(net, element + '_name_map')
+    map_pos = name_map.index.get_indexer(names)
+    if (map_pos < 0).any():
+        raise KeyError(f'Unknown {element} names: '
+                       f'{list(pd.Index(names)[map_pos < 0])}')
+    return getattr(net, element).index.get_indexer(name_map.values[map_pos])
+
+def _set_column(table, column, rows, values):
+    
+    # Positional assignment keeps the cached columns of the table in sync
+    table.iloc[rows, table.columns.get_loc(column)] = values
+
+class InputPlan:
+    """Precompiled application of simulation inputs to a network.
+    
+    Element names are resolved to table positions once, and the input
+    frames are kept as contiguous float arrays. `apply` then writes the
+    values of a step by positional assignment into the element tables,
+    without building intermediate pandas objects.
+    
+    Parameters
+    ----------
+    net : pandapowerNet
+        Network object from `create_toy_model`.
+    eq_frame_dict : dict
+        Maps (element, quantity) to a frame with one row per step and
+        element names as columns.
+    """
+    
+    def __init__(self, net, eq_frame_dict):
+        self.net = net
+        self.entries = []
+        for (element, quantity), eq_frame in eq_frame_dict.items():
+            rows = _rows_by_name(net, element, eq_frame.columns)
+            values = np.ascontiguousarray(eq_frame.values, dtype=float)
+            
+            # Step labels of contiguous ranges map to rows by an offset
+            index = eq_frame.index
+            offset = None
+            if (len(index) > 0 and pd.api.types.is_integer_dtype(index)
+                and (np.diff(index.values) == 1).all()):
+                offset = int(index[0])
+            self.entries.append((element, quantity, rows, values,
+                                 index, offset))
+    
+    def apply(self, net, n):
+        for (element, quantity, rows, values, index, offset) in self.entries:
+            pos = n - offset if offset is not None else -1
+            if not 0 <= pos < len(values):
+                pos = index.get_loc(n)
+            _set_column(net[element], quantity, rows, values[pos])
        
 def apply_load_from_series(net, p_mw=None, q_mvar=None):      
     if p_mw is not None:
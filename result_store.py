@@ -0,0 +1,547 @@
+import json
+import numbers
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+__all__ = ['ResLogger',
+           'NpyResLogger',
+           'RAW_QUANTITIES',
+           'RawResultStore',
+           'RESULT_BACKENDS',
+           'result_logger',
+           'load_results',
+           'iter_results']
+
+# Bytes read from the end of a CSV file to find its last line
+_TAIL_BLOCK = 4096
+
+def _column_positions(all_columns, columns):
+    positions = all_columns.get_indexer(columns)
+    if (positions < 0).any():
+        raise KeyError(f'Unknown result columns: '
+                       f'{list(pd.Index(columns)[positions < 0])}')
+    return positions
+
+def _check_numbers(columns, values):
+    
+    # Float chunks would coerce or lose labels and other non-numbers
+    labels = [column for (column, column_values) in zip(columns, values)
+              if not all(isinstance(value, numbers.Real)
+                         for value in column_values)]
+    if labels:
+        raise TypeError(f'Results {labels} are not numbers, which the npy '
+                        f'backend cannot store; use the csv backend.')
+
+class _BoundedReader:
+    """Binary file reader that stops at a byte offset."""
+
+    def __init__(self, file, size):
+        self.file = file
+        self.remaining = size - file.tell()
+
+    def read(self, n=-1):
+        if n is None or n < 0 or n > self.remaining:
+            n = self.remaining
+        data = self.file.read(n)
+        self.remaining -= len(data)
+        return data
+
+    def __iter__(self):
+        return iter(lambda: self.read(_TAIL_BLOCK), b'')
+
+class ResLogger:
+    """Result logger writing one CSV row per simulation step.
+
+    The first column holds the step index, the header the result names.
+    Only the first and the last line are read to resume, so opening a
+    large result file takes constant time.
+
+    A partially written last line of a killed run is removed when the
+    logger is opened for writing. With `read_only`, the file is never
+    changed and no directory is created; reads stop at the last complete
+    line, so results of a running simulation can be loaded safely.
+    """
+
+    def __init__(self, path, name='res', read_only=False):
+        self.path = path
+        self.file = path + name + '.csv'
+        self.read_only = read_only
+        if not read_only:
+            os.makedirs(path, exist_ok=True)
+
+        # Infer the last result computation that has been run
+        self.header = False
+        self.last_run = None
+        self.size = None
+        if os.path.isfile(self.file):
+            with open(self.file, 'rb' if read_only else 'rb+') as res:
+                first_line = res.readline()
+
+                # File has header
+                if first_line.endswith(b'\n'):
+                    self.columns = pd.Index((first_line.decode()[1:]
+                                             .rstrip().split(',')))
+                    self.header = True
+                    last_line = self._last_line(res, len(first_line))
+
+                    # Previous result computations exists
+                    if last_line is not None:
+                        self.last_run = int(last_line.split(b',')[0])
+
+                # File is empty or has a partially written header
+                elif not read_only:
+                    res.truncate(0)
+                else:
+                    self.size = 0
+
+    def _last_line(self, res, header_size):
+
+        # Drop a partially written last line of a killed run, or only
+        # skip it when reading
+        end = res.seek(0, os.SEEK_END)
+        self.size = end
+        if end == header_size:
+            return None
+        res.seek(end - 1)
+        if res.read(1) != b'\n':
+            pos = ResLogger._line_start(res, end - 1, header_size)
+            if not self.read_only:
+                res.truncate(pos)
+            end = pos
+            self.size = end
+            if end == header_size:
+                return None
+        start = ResLogger._line_start(res, end - 1, header_size)
+        res.seek(start)
+        return res.read(end - start)
+
+    @staticmethod
+    def _line_start(res, end, header_size):
+
+        # Read backwards in blocks until the previous newline
+        pos = end
+        while pos > header_size:
+            block_start = max(header_size, pos - _TAIL_BLOCK)
+            res.seek(block_start)
+            block = res.read(pos - block_start)
+            newline = block.rfind(b'\n')
+            if newline >= 0:
+                return block_start + newline + 1
+            pos = block_start
+        return header_size
+
+    def __enter__(self):
+        if self.read_only:
+            raise ValueError(f'{self.file} is opened read-only')
+        self.res = open(self.file, 'a', buffering=2**20).__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.res.__exit__(exc_type, exc_value, traceback)
+
+    def write_header(self, columns):
+        self.columns = columns
+        self.res.write(''.join(','+column for column in columns) + '\n')
+        self.header = True
+
+    def write_res(self, idx, res_series):
+        res_list = res_series[self.columns].values
+        self.res.write(str(idx) + ''.join(','+str(res) for res in res_list)
+                       + '\n')
+        self.last_run = idx
+
+    def write_frame(self, res_frame):
+        res_frame[self.columns].to_csv(self.res, header=False)
+        if len(res_frame.index):
+            self.last_run = res_frame.index[-1]
+
+    def flush(self):
+        self.res.flush()
+
+    def _open_read(self):
+
+        # Read-only loggers stop at the last complete line when opened
+        res = open(self.file, 'rb')
+        if self.read_only and self.size is not None:
+            return res, _BoundedReader(res, self.size)
+        return res, res
+
+    def read(self, columns=None):
+        usecols = (None if columns is None
+                   else [0, *(_column_positions(self.columns, columns) + 1)])
+        res, reader = self._open_read()
+        with res:
+            res_frame = pd.read_csv(reader, index_col=0, usecols=usecols)
+        return res_frame if columns is None else res_frame[columns]
+
+    def iter_chunks(self, columns=None, chunk_size=100000):
+        """Yield result frames of `chunk_size` rows."""
+        usecols = (None if columns is None
+                   else [0, *(_column_positions(self.columns, columns) + 1)])
+        res, reader = self._open_read()
+        with res, pd.read_csv(reader, index_col=0, usecols=usecols,
+                              chunksize=chunk_size) as chunks:
+            for res_frame in chunks:
+                yield res_frame if columns is None else res_frame[columns]
+
+    def exists(self):
+        return os.path.isfile(self.file)
+
+    def remove(self):
+        os.remove(self.file)
+
+class NpyResLogger:
+    """Result logger writing buffered, column-major NumPy chunks.
+
+    Results are stored in the directory `path + name + '/'`. Rows are
+    buffered in memory and written as one `.npy` file per chunk of
+    `chunk_size` steps, with the values of each result contiguous on disk.
+    A small `index.json` lists the chunks and the last step, so resuming
+    takes constant time. Steps that were still buffered when a run was
+    killed are recomputed on resume.
+
+    All results are stored as floats. Results that are not numbers, e.g.
+    labels, raise a TypeError when written; use `ResLogger` for them.
+
+    Parameters
+    ----------
+    path : str
+        Simulation directory.
+    name : str
+        Name of the store within the directory. The default is 'res'.
+    chunk_size : int
+        Number of steps per chunk file.
+    read_only : bool
+        Only read existing results, without creating the directory.
+    """
+
+    def __init__(self, path, name='res', chunk_size=10000, read_only=False):
+        self.path = path
+        self.file = path + name + '/'
+        self.chunk_size = chunk_size
+        self.read_only = read_only
+        if not read_only:
+            os.makedirs(self.file, exist_ok=True)
+
+        self.header = False
+        self.last_run = None
+        self.chunks = []
+        if os.path.isfile(self.file + 'index.json'):
+            with open(self.file + 'index.json', 'r') as index_file:
+                index = json.load(index_file)
+            self.columns = pd.Index(index['columns'])
+            self.header = True
+            self.last_run = index['last_run']
+            self.chunks = index['chunks']
+
+    def __enter__(self):
+        if self.read_only:
+            raise ValueError(f'{self.file} is opened read-only')
+        self.idx_buffer = []
+        self.res_buffer = []
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def _write_index(self):
+        index = {'columns': list(self.columns),
+                 'last_run': self.last_run,
+                 'chunks': self.chunks}
+
+        # Replace atomically so a killed run never leaves a broken index
+        with open(self.file + 'index.json.tmp', 'w') as index_file:
+            json.dump(index, index_file)
+        os.replace(self.file + 'index.json.tmp', self.file + 'index.json')
+
+    def write_header(self, columns):
+        self.columns = pd.Index(columns)
+        self.header = True
+        self._write_index()
+
+    def write_res(self, idx, res_series):
+        values = res_series[self.columns].values
+        _check_numbers(self.columns, values[:, None])
+        self.idx_buffer.append(idx)
+        self.res_buffer.append(np.asarray(values, dtype=float))
+        if len(self.idx_buffer) >= self.chunk_size:
+            self.flush()
+
+    def write_frame(self, res_frame):
+        self.flush()
+        res_frame = res_frame[self.columns]
+        other = [column for (column, dtype) in res_frame.dtypes.items()
+                 if not pd.api.types.is_numeric_dtype(dtype)]
+        _check_numbers(other, res_frame[other].values.T)
+        values = res_frame.values.astype(float)
+        idx = np.asarray(res_frame.index, dtype=np.int64)
+        for start in range(0, len(idx), self.chunk_size):
+            stop = start + self.chunk_size
+            self._write_chunk(idx[start:stop], values[start:stop])
+
+    def flush(self):
+        if self.idx_buffer:
+            self._write_chunk(np.asarray(self.idx_buffer, dtype=np.int64),
+                              np.stack(self.res_buffer))
+            self.idx_buffer = []
+            self.res_buffer = []
+
+    def _write_chunk(self, idx, values):
+        if len(idx) == 0:
+            return
+        name = f'chunk_{len(self.chunks):06d}'
+        np.save(self.file + name + '_index.npy', idx)
+        np.save(self.file + name + '.npy', np.ascontiguousarray(values.T))
+        self.chunks.append(name)
+        self.last_run = int(idx[-1])
+        self._write_index()
+
+    def iter_chunks(self, columns=None):
+        """Yield memory-mapped result frames chunk by chunk.
+
+        Each frame is a view on the file; only the requested result
+        columns are read from disk.
+        """
+        col_pos = (slice(None) if columns is None
+                   else _column_positions(self.columns, columns))
+        col_names = self.columns if columns is None else pd.Index(columns)
+        for name in self.chunks:
+            idx = np.load(self.file + name + '_index.npy')
+            values = np.load(self.file + name + '.npy', mmap_mode='r')
+            yield pd.DataFrame(values[col_pos].T, index=idx,
+                               columns=col_names, copy=False)
+
+    def read(self, columns=None):
+        frames = list(self.iter_chunks(columns))
+        if len(frames) == 0:
+            return pd.DataFrame(columns=self.columns if columns is None
+                                else columns)
+        if len(frames) == 1:
+            return frames[0]
+        return pd.concat(frames)
+
+    def exists(self):
+        return os.path.isfile(self.file + 'index.json')
+
+    def remove(self):
+        shutil.rmtree(self.file)
+
+# Raw power flow results kept per step: quantity -> result table
+RAW_QUANTITIES = {'loading_percent': 'res_line',
+                  'i_ka': 'res_line',
+                  'vm_pu': 'res_bus',
+                  'va_degree': 'res_bus'}
+
+class RawResultStore:
+    """Store of raw power flow results for evaluating metrics offline.
+
+    Per step, the line results `loading_percent` and `i_ka`, the bus
+    results `vm_pu` and `va_degree` and the line in-service states are
+    buffered and written as one `.npy` file per quantity and chunk of
+    `chunk_size` steps, in the directory `path + name + '/'`. Values are
+    stored as `dtype`, rows in step order, so chunks can be
+    memory-mapped and passed to `metrics.MetricEngine.evaluate_batch`
+    as they are. Like `NpyResLogger`, steps that were still buffered
+    when a run was killed are missing from the store.
+
+    Parameters
+    ----------
+    path : str
+        Simulation directory.
+    name : str
+        Name of the store within the directory.
+    chunk_size : int
+        Number of steps per chunk.
+    dtype : str
+        Data type of the stored results.
+    """
+
+    def __init__(self, path, name='raw', chunk_size=10000, dtype='float32'):
+        self.file = path + name + '/'
+        self.chunk_size = chunk_size
+        self.dtype = dtype
+        self.chunks = []
+        self.last_run = None
+        self.lines = None
+        self.buses = None
+        self.idx_buffer = []
+        self.buffer = []
+        self._step = None
+        if os.path.isfile(self.file + 'index.json'):
+            with open(self.file + 'index.json', 'r') as index_file:
+                index = json.load(index_file)
+            self.chunks = index['chunks']
+            self.last_run = index['last_run']
+            self.lines = index['lines']
+            self.buses = index['buses']
+            self.dtype = index['dtype']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def _write_index(self):
+        index = {'chunks': self.chunks,
+                 'last_run': self.last_run,
+                 'lines': self.lines,
+                 'buses': self.buses,
+                 'dtype': self.dtype}
+        with open(self.file + 'index.json.tmp', 'w') as index_file:
+            json.dump(index, index_file)
+        os.replace(self.file + 'index.json.tmp', self.file + 'index.json')
+
+    def _last_step(self):
+        return self.idx_buffer[-1] if self.idx_buffer else self.last_run
+
+    def _set_elements(self, net):
+        if self.lines is None:
+            self.lines = [int(line) for line in net.line.index]
+            self.buses = [int(bus) for bus in net.bus.index]
+
+    def write_step(self, idx, net):
+        """Buffer the current power flow results of `net` as step `idx`."""
+        last = self._last_step()
+        if last is not None and idx <= last:
+            return
+        self._set_elements(net)
+        row = {quantity: np.array(net[table][quantity].values,
+                                  dtype=self.dtype)
+               for (quantity, table) in RAW_QUANTITIES.items()}
+        row['in_service'] = net.line['in_service'].values.astype(bool)
+        self.idx_buffer.append(idx)
+        self.buffer.append(row)
+        if len(self.idx_buffer) >= self.chunk_size:
+            self.flush()
+
+    def write_batch(self, idx, res, net, bus_index=None):
+        """Write batch results, e.g. of `BatchPowerFlow.solve`.
+
+        Bus results of the buses in `bus_index` are scattered to the bus
+        table of `net`; other buses are stored as NaN.
+        """
+        self.flush()
+        self._set_elements(net)
+        idx = np.asarray(idx, dtype=np.int64)
+        keep = idx > (-1 if self.last_run is None else self.last_run)
+        arrays = {'in_service': np.broadcast_to(
+            net.line['in_service'].values.astype(bool),
+            (len(idx), len(self.lines)))}
+        bus_pos = (slice(None) if bus_index is None
+                   else net.bus.index.get_indexer(bus_index))
+        for (quantity, table) in RAW_QUANTITIES.items():
+            values = np.asarray(res[quantity])
+            if table == 'res_bus':
+                full = np.full((len(idx), len(self.buses)), np.nan)
+                full[:, bus_pos] = values
+                values = full
+            arrays[quantity] = values
+        for start in range(0, int(keep.sum()), self.chunk_size):
+            rows = np.flatnonzero(keep)[start:start + self.chunk_size]
+            self._write_chunk(idx[rows], {quantity: values[rows]
+                                          for (quantity, values)
+                                          in arrays.items()})
+
+    def wrap(self, set_eq, simulation_step_func):
+        """Input and step functions that write the results of every step.
+
+        Returns counterparts of `set_eq(net, n)` and
+        `simulation_step_func(net, metrics)` for the simulation loops;
+        results are written after the step function returned.
+        """
+        def set_eq_and_track(net, n):
+            self._step = n
+            set_eq(net, n)
+
+        def step_and_write(net, metrics):
+            results = simulation_step_func(net, metrics)
+            self.write_step(self._step, net)
+            return results
+
+        return set_eq_and_track, step_and_write
+
+    def flush(self):
+        if self.idx_buffer:
+            arrays = {quantity: np.stack([row[quantity]
+                                          for row in self.buffer])
+                      for quantity in self.buffer[0]}
+            self._write_chunk(np.asarray(self.idx_buffer, dtype=np.int64),
+                              arrays)
+            self.idx_buffer = []
+            self.buffer = []
+
+    def _write_chunk(self, idx, arrays):
+        if len(idx) == 0:
+            return
+        os.makedirs(self.file, exist_ok=True)
+        name = f'chunk_{len(self.chunks):06d}'
+        np.save(self.file + name + '_index.npy', idx)
+        for (quantity, values) in arrays.items():
+            dtype = bool if quantity == 'in_service' else self.dtype
+            np.save(f'{self.file}{name}_{quantity}.npy',
+                    np.ascontiguousarray(values, dtype=dtype))
+        self.chunks.append(name)
+        self.last_run = int(idx[-1])
+        self._write_index()
+
+    def iter_chunks(self, quantities=None):
+        """Yield (steps, arrays) chunk by chunk.
+
+        `arrays` maps every quantity, and 'in_service', to a
+        memory-mapped array of shape (steps, lines) or (steps, buses).
+        """
+        if quantities is None:
+            quantities = list(RAW_QUANTITIES)
+        for name in self.chunks:
+            idx = np.load(self.file + name + '_index.npy')
+            yield idx, {quantity: np.load(f'{self.file}{name}_{quantity}.npy',
+                                          mmap_mode='r')
+                        for quantity in [*quantities, 'in_service']}
+
+    def exists(self):
+        return os.path.isfile(self.file + 'index.json')
+
+    def remove(self):
+        shutil.rmtree(self.file)
+
+RESULT_BACKENDS = {'csv': ResLogger,
+                   'npy': NpyResLogger}
+
+def result_logger(path, name='res', backend='csv', read_only=False):
+    """Create a result logger of the given backend for a simulation."""
+    return RESULT_BACKENDS[backend](path, name, read_only=read_only)
+
+def load_results(path, name='res', columns=None):
+    """Load simulation results from any backend.
+
+    The backend is detected from the files in `path`. Results in the
+    binary backend are memory-mapped, and only `columns` are read. Files
+    are opened read-only, so results of a running simulation can be
+    loaded while it writes them.
+
+    Returns
+    -------
+    res_df : DataFrame
+        Results indexed by simulation step.
+    """
+    if os.path.isfile(path + name + '/index.json'):
+        return NpyResLogger(path, name, read_only=True).read(columns)
+    return ResLogger(path, name, read_only=True).read(columns)
+
+def iter_results(path, name='res', columns=None, chunk_size=100000):
+    """Yield simulation results from any backend chunk by chunk.
+
+    CSV results are parsed `chunk_size` rows at a time; binary results
+    are yielded in their stored chunks. Memory use is bounded by one
+    chunk regardless of the number of steps.
+    """
+    if os.path.isfile(path + name + '/index.json'):
+        logger = NpyResLogger(path, name, read_only=True)
+        yield from logger.iter_chunks(columns)
+    else:
+        yield from ResLogger(path, name, read_only=True).iter_chunks(
+            columns, chunk_size)
@@ -0,0 +1,288 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+from batch_powerflow import _mask_unconverged
+from metrics import MetricEngine
+from sensitivities import load_sensitivities
+
+__all__ = ['FIDELITY',
+           'FIDELITY_COLUMN',
+           'DCScreen']
+
+# Values of the fidelity column: power flow the metrics were computed with
+FIDELITY = {'dc': 0, 'ac': 1}
+FIDELITY_COLUMN = 'fidelity'
+
+# Reasons for an AC solve, counted in the statistics
+REASONS = ('calibration', 'near_limit', 'exact', 'audit')
+
+def _net_values(net):
+    return {('load', 'p_mw'): net.load['p_mw'].values[None],
+            ('load', 'q_mvar'): net.load['q_mvar'].values[None],
+            ('gen', 'p_mw'): net.gen['p_mw'].values[None],
+            ('gen', 'vm_pu'): net.gen['vm_pu'].values[None]}
+
+class DCScreen:
+    """Skips AC power flows of steps that are far from the thermal limits.
+
+    Every step is first estimated with the DC power flow, from the PTDF of
+    `sensitivities.load_sensitivities`. The estimate is bounded per line
+    by the largest underestimate of the AC loading seen so far,
+    `bound`, which is learned from every AC solve. A step gets the full
+    AC solve if its bounded loading reaches `limit_percent - margin` on
+    any line in service, while the bound is calibrated, if a requested
+    metric is listed in `exact_metrics`, or as an audit every
+    `audit_every` steps. Otherwise its metrics are computed from the DC
+    estimate. Results carry a `fidelity` column, see `FIDELITY`.
+
+    Audits solve steps that screening would skip, so `stats` can report
+    how often the screen misses a step that is within the margin in AC.
+
+    Parameters
+    ----------
+    net : pandapowerNet
+        Network object from `create_toy_model`. The topology must stay
+        as it is.
+    margin : float
+        Distance to the limit in percentage points below which steps get
+        the AC solve.
+    limit_percent : float or array-like
+        Thermal limit of the lines in % of `max_i_ka`, for all lines or
+        per line in table order.
+    exact_metrics : list of str
+        Metrics that always need the AC solve.
+    calibration_steps : int
+        Number of AC solves before steps are screened.
+    audit_every : int, optional
+        Solve every n-th screened step in AC.
+    runpp : callable, optional
+        AC solver with the signature of `pandapower.runpp`, e.g.
+        `PowerFlowCache.runpp`.
+    """
+
+    def __init__(self, net, margin=10., limit_percent=100., exact_metrics=(),
+                 calibration_steps=10, audit_every=None, runpp=None):
+        self.net = net
+        self.sens = load_sensitivities(net)
+        self.margin = margin
+        self.limit = np.broadcast_to(np.asarray(limit_percent, dtype=float),
+                                     (len(net.line.index),))
+        self.exact_metrics = set(exact_metrics)
+        self.calibration_steps = calibration_steps
+        self.audit_every = audit_every
+        if runpp is None:
+            from pandapower import runpp
+        self.runpp = runpp
+        self.in_service = net.line['in_service'].values.astype(bool)
+        self.bound = np.zeros(len(net.line.index))
+        self._engines = {}
+
+        self.steps = 0
+        self.screened = 0
+        self.reasons = dict.fromkeys(REASONS, 0)
+        self.audit_missed = 0
+        self.unconverged = 0
+
+        # Error of the estimated max loading (AC - DC) over all AC solves
+        self.error_count = 0
+        self.error_sum = 0.
+        self.error_sum_sq = 0.
+        self.error_max_abs = 0.
+
+    @property
+    def ac_steps(self):
+        return sum(self.reasons.values())
+
+    def _engine(self, metrics):
+        key = tuple(name for (name, _) in metrics)
+        if key not in self._engines:
+            self._engines[key] = MetricEngine(self.net, metrics)
+        return self._engines[key]
+
+    def _reasons(self, upper, metrics):
+        """Reason for an AC solve of every step, None to skip it.
+
+        `upper` holds the bounded DC loading of steps past calibration.
+        """
+        near = ((upper >= self.limit - self.margin)
+                & self.in_service).any(axis=1)
+        exact = any(name in self.exact_metrics for (name, _) in metrics)
+        reasons = np.full(len(upper), None, dtype=object)
+        if self.audit_every:
+            counts = self.screened + np.arange(1, len(upper) + 1)
+            reasons[counts % self.audit_every == 0] = 'audit'
+        if exact:
+            reasons[:] = 'exact'
+        reasons[near] = 'near_limit'
+        self.screened += len(upper)
+        return reasons
+
+    def _record(self, estimate, loading, reason):
+        """Update the bound and error statistics with AC loadings."""
+        estimate = np.where(self.in_service, estimate, np.nan)
+        loading = np.where(self.in_service, loading, np.nan)
+        self.bound = np.fmax(self.bound,
+                             np.nanmax(loading - estimate, axis=0,
+                                       initial=0.))
+        error = np.nanmax(loading, axis=1) - np.nanmax(estimate, axis=1)
+        self.error_count += len(error)
+        self.error_sum += error.sum()
+        self.error_sum_sq += (error**2).sum()
+        self.error_max_abs = max(self.error_max_abs,
+                                 float(np.abs(error).max(initial=0.)))
+        for value in reason:
+            self.reasons[value] += 1
+
+        # Audited steps that turn out to be within the margin
+        if 'audit' in reason:
+            audited = loading[np.asarray(reason) == 'audit']
+            self.audit_missed += int(
+                (audited >= self.limit - self.margin).any(axis=1).sum())
+
+    def simulation_step(self, net, metrics):
+        """Step function for `run_simulations` with DC screening.
+
+        Returns the metrics and the fidelity column.
+        """
+        values = _net_values(net)
+        estimate = self.sens.line_results(
+            self.sens.flows(self.sens.bus_injections(values)))
+        if self.ac_steps < self.calibration_steps:
+            reason = 'calibration'
+        else:
+            reason = self._reasons(estimate['loading_percent'] + self.bound,
+                                   metrics)[0]
+        self.steps += 1
+
+        if reason is None:
+            engine = self._engine(metrics)
+            results = pd.Series(engine.evaluate_batch(estimate,
+                                                      self.in_service)[0],
+                                index=engine.names)
+            results[FIDELITY_COLUMN] = FIDELITY['dc']
+            return results
+
+        self.runpp(net)
+        self._record(estimate['loading_percent'],
+                     net.res_line['loading_percent'].values[None], [reason])
+        results = pd.Series({name: metric(net) for (name, metric) in metrics})
+        results[FIDELITY_COLUMN] = FIDELITY['ac']
+        return results
+
+    def run(self, eq_frame_dict, metrics, steps=None, chunk_size=1000,
+            **ac_kwargs):
+        """Screen the steps of input frames in batch.
+
+        Counterpart of `simulation_step` on `batch_powerflow.BatchPowerFlow`:
+        all steps of a chunk are estimated at once, and the steps that
+        need it are solved together with the batched AC power flow.
+
+        Parameters
+        ----------
+        eq_frame_dict : dict
+            Maps (element, quantity) to an input frame.
+        metrics : list
+            Output of `metrics.create_metrics`.
+        steps : range, optional
+            Steps to screen. The default is all rows of the inputs.
+        chunk_size : int
+            Number of steps screened at once.
+        **ac_kwargs
+            Passed on to `BatchPowerFlow.solve_ac`.
+
+        Returns
+        -------
+        res_frame : DataFrame
+            Metrics and fidelity per step.
+        """
+        model = self.sens.model
+        engine = self._engine(metrics)
+        if steps is None:
+            steps = next(iter(eq_frame_dict.values())).index
+        frames = []
+        for start in range(0, len(steps), chunk_size):
+            chunk = steps[start:start + chunk_size]
+            values = model.element_frames(eq_frame_dict, chunk)
+            s_bus, vm_set = model.injections(values)
+            estimate = self.sens.line_results(
+                self.sens.flows(s_bus.real*model.sn_mva))
+
+            # Calibrate on the first steps before screening the rest
+            n_cal = min(max(self.calibration_steps - self.ac_steps, 0),
+                        len(chunk))
+            reasons = np.full(len(chunk), None, dtype=object)
+            reasons[:n_cal] = 'calibration'
+            converged = np.ones(len(chunk), dtype=bool)
+            if n_cal:
+                converged[:n_cal] = self._solve(estimate, s_bus, vm_set,
+                                                reasons, np.arange(n_cal),
+                                                ac_kwargs)
+            rest = np.arange(n_cal, len(chunk))
+            reasons[rest] = self._reasons(
+                estimate['loading_percent'][rest] + self.bound, metrics)
+            self.steps += len(chunk)
+            ac_rows = rest[reasons[rest] != None]
+            if len(ac_rows):
+                converged[ac_rows] = self._solve(estimate, s_bus, vm_set,
+                                                 reasons, ac_rows, ac_kwargs)
+
+            res_frame = engine.frame(estimate, index=chunk,
+                                     in_service=self.in_service)
+            res_frame.iloc[~converged] = np.nan
+            res_frame[FIDELITY_COLUMN] = np.where(reasons == None,
+                                                  FIDELITY['dc'],
+                                                  FIDELITY['ac'])
+            frames.append(res_frame)
+        return pd.concat(frames)
+
+    def _solve(self, estimate, s_bus, vm_set, reasons, rows, ac_kwargs):
+
+        # Replace the estimate of the solved rows by the AC results;
+        # steps that did not converge are not recorded
+        res = _mask_unconverged(
+            self.sens.model.solve_ac(s_bus[rows], vm_set[rows], **ac_kwargs))
+        converged = res['converged']
+        self._record(estimate['loading_percent'][rows][converged],
+                     res['loading_percent'][converged],
+                     reasons[rows][converged])
+        for value in reasons[rows][~converged]:
+            self.reasons[value] += 1
+        self.unconverged += int((~converged).sum())
+        for quantity in ['loading_percent', 'i_ka']:
+            estimate[quantity][rows] = res[quantity]
+        return converged
+
+    def stats(self):
+        """Skip rate and estimate error as a JSON-serializable dict.
+
+        `error` describes the AC minus the DC max loading of all AC
+        solves, in percentage points; `bound` is the current bound per
+        line. `audit_missed` counts audited steps that the screen would
+        have skipped but whose AC loading is within the margin.
+        `unconverged` counts AC solves of `run` that did not converge;
+        their metrics are NaN and they are left out of `error` and `bound`.
+        """
+        n = self.error_count
+        mean = self.error_sum/n if n else None
+        std = (float(np.sqrt(max(self.error_sum_sq/n - mean**2, 0.)))
+               if n else None)
+        return {'steps': self.steps,
+                'ac_steps': self.ac_steps,
+                'dc_steps': self.steps - self.ac_steps,
+                'skip_rate': ((self.steps - self.ac_steps)/self.steps
+                              if self.steps else None),
+                'reasons': dict(self.reasons),
+                'audit_missed': self.audit_missed,
+                'unconverged': self.unconverged,
+                'margin': self.margin,
+                'error': {'mean': mean,
+                          'std': std,
+                          'max_abs': self.error_max_abs if n else None},
+                'bound': {'max': float(self.bound.max(initial=0.)),
+                          'lines': self.bound.tolist()}}
+
+    def write_stats(self, stats_file):
+        with open(stats_file, 'w') as stats_json:
+            json.dump(self.stats(), stats_json, indent=2)
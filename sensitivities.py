@@ -0,0 +1,329 @@
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+from batch_powerflow import BatchPowerFlow, SQRT3
+
+__all__ = ['DCSensitivities',
+           'TopologyUpdate',
+           'IslandingError',
+           'sensitivity_key',
+           'load_sensitivities']
+
+# Conventional directory of the on-disk sensitivity cache, ignored by git
+CACHE_DIR = 'sensitivity_cache/'
+
+# Sensitivity arrays by key, shared by all networks in this process
+_CACHE = {}
+
+# Relative singular value below which a topology change is islanding
+_MIN_SINGULAR = 1e-10
+
+class IslandingError(ValueError):
+    pass
+
+class DCSensitivities:
+    """DC sensitivities (PTDF, LODF) of a network topology.
+
+    Line flows of the DC power flow are linear in the bus injections:
+    with the power transfer distribution factors (PTDF), flows for a
+    batch of injections are one matrix product. Line outage distribution
+    factors (LODF) give the change of flows after single line outages.
+
+    Parameters
+    ----------
+    net : pandapowerNet
+        Network object, e.g. from `pp_toy_model.create_toy_model`.
+    model : BatchPowerFlow, optional
+        Precomputed batch power flow model of `net`.
+    arrays : dict, optional
+        Precomputed 'ptdf', 'lodf' and 'b_red_inv', as from `arrays`.
+    """
+
+    def __init__(self, net, model=None, arrays=None):
+        self.model = BatchPowerFlow(net) if model is None else model
+        m = self.model
+        self.n_lines = len(m.line_index)
+        self.line_pos = np.flatnonzero(m.line_on)
+
+        # Reduced position of every bus, -1 for reference buses
+        self.red_pos = np.full(m.n_bus, -1)
+        self.red_pos[m.pvpq] = np.arange(len(m.pvpq))
+        self.b_line = 1/m.x_pu
+
+        # Flow per unit injection at each bus, withdrawn at the references
+        inc = np.zeros((len(self.line_pos), m.n_bus))
+        inc[np.arange(len(self.line_pos)), m.f] = 1.
+        inc[np.arange(len(self.line_pos)), m.t] = -1.
+        self._inc = inc
+        if arrays is not None:
+            m._b_red_inv = arrays['b_red_inv']
+            self.ptdf = arrays['ptdf']
+            self._lodf = arrays['lodf']
+            return
+        
+        ptdf = np.zeros((self.n_lines, m.n_bus))
+        ptdf[np.ix_(self.line_pos, m.pvpq)] = (self.b_line[:, None]
+                                               * inc[:, m.pvpq]
+                                               @ m.b_red_inv)
+        self.ptdf = ptdf
+        self._lodf = None
+
+    @property
+    def lodf(self):
+        """Line outage distribution factors, shape (lines, lines).
+
+        Column k holds the change of flow on every line per unit of
+        pre-outage flow on line k when k is taken out of service.
+        Outages that split the network give infinite or NaN factors.
+        """
+        if self._lodf is None:
+            on = self.line_pos
+            h = np.zeros((self.n_lines, self.n_lines))
+            h[:, on] = self.ptdf @ self._inc.T
+            denominator = 1 - np.diag(h)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                lodf = h/denominator[None, :]
+            lodf[on, on] = -1.
+            off = np.setdiff1d(np.arange(self.n_lines), on)
+            lodf[:, off] = 0.
+            self._lodf = lodf
+        return self._lodf
+
+    def arrays(self):
+        """Arrays that define the sensitivities, for caching."""
+        return {'ptdf': self.ptdf,
+                'lodf': self.lodf,
+                'b_red_inv': self.model.b_red_inv}
+
+    def bus_injections(self, values):
+        """Active power bus injections in MW from `element_frames` values."""
+        s_bus, _ = self.model.injections(values)
+        return s_bus.real*self.model.sn_mva
+
+    def flows(self, p_bus):
+        """DC line flows in MW for bus injections of shape (steps, buses)."""
+        return p_bus @ self.ptdf.T
+
+    def line_results(self, p_line):
+        """Line current (kA) and loading (%) from DC line flows in MW."""
+        m = self.model
+        vn_kv = np.ones(self.n_lines)
+        vn_kv[self.line_pos] = np.minimum(m.vn_kv[m.f], m.vn_kv[m.t])
+        i_max_ka = np.ones(self.n_lines)
+        i_max_ka[self.line_pos] = m.i_max_ka
+        i_ka = np.abs(p_line)/(SQRT3*vn_kv)
+        return {'i_ka': i_ka, 'loading_percent': i_ka/i_max_ka*100}
+
+    def loading_percent(self, p_bus):
+        """DC line loading (%) for bus injections in MW."""
+        return self.line_results(self.flows(p_bus))['loading_percent']
+
+    def base_angles(self, p_bus):
+        """Reduced bus voltage angles of the base topology in radians."""
+        return (p_bus[..., self.model.pvpq]/self.model.sn_mva
+                @ self.model.b_red_inv)
+
+def sensitivity_key(net):
+    """Hash of the network configuration and the line states.
+
+    Uses the configuration hash that `create_toy_model` stores, and
+    otherwise the bus and line tables.
+    """
+    key = hashlib.sha256()
+    if 'config_hash' in net:
+        key.update(net.config_hash.encode())
+    else:
+        columns = ['from_bus', 'to_bus', 'length_km', 'r_ohm_per_km',
+                   'x_ohm_per_km', 'max_i_ka', 'df', 'parallel']
+        key.update(pd.util.hash_pandas_object(net.line[columns]).values)
+        key.update(pd.util.hash_pandas_object(net.bus[['vn_kv']]).values)
+        key.update(net.gen['slack'].values.astype(bool).tobytes())
+    key.update(net.line['in_service'].values.astype(bool).tobytes())
+    key.update(net.bus['in_service'].values.astype(bool).tobytes())
+    return key.hexdigest()
+
+def load_sensitivities(net, cache_dir=None, model=None):
+    """Sensitivities of a network, computed once per configuration.
+
+    Looks up the sensitivities of the configuration and line states of
+    `net` in memory, then in `cache_dir`, and only computes them if both
+    miss. Computed sensitivities are saved to `cache_dir`.
+
+    Parameters
+    ----------
+    net : pandapowerNet
+        Network object, e.g. from `pp_toy_model.create_toy_model`.
+    cache_dir : str or None
+        Directory of the on-disk cache, e.g. `CACHE_DIR`. The default
+        None only caches in memory.
+    model : BatchPowerFlow, optional
+        Precomputed batch power flow model of `net`.
+
+    Returns
+    -------
+    sens : DCSensitivities
+    """
+    key = sensitivity_key(net)
+    if key not in _CACHE and cache_dir is not None:
+        cache_file = os.path.join(cache_dir, key + '.npz')
+        if os.path.isfile(cache_file):
+            with np.load(cache_file) as cached:
+                _CACHE[key] = dict(cached)
+                
+    if key in _CACHE:
+        return DCSensitivities(net, model, arrays=_CACHE[key])
+    
+    sens = DCSensitivities(net, model)
+    _CACHE[key] = sens.arrays()
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        
+        # Write to a temporary file so concurrent readers never see parts
+        tmp_file = os.path.join(cache_dir, f'{key}.{os.getpid()}.tmp.npz')
+        np.savez(tmp_file, **_CACHE[key])
+        os.replace(tmp_file, os.path.join(cache_dir, key + '.npz'))
+    return sens
+
+class TopologyUpdate:
+    """DC flows after line outages and bus splits by low-rank updates.
+
+    The reduced susceptance matrix of the changed topology differs from
+    the base one by a few rank-one terms, one per changed line. Flows are
+    obtained from the base voltage angles with the Woodbury identity, so
+    no matrix of the full network size has to be factorized again. Bus
+    splits add a new busbar per split bus, which is eliminated with a
+    Schur complement. Injections stay on the original busbar.
+
+    Parameters
+    ----------
+    sens : DCSensitivities
+        Sensitivities of the base topology.
+    cuts : iterable of int
+        Labels of lines taken out of service.
+    splits : iterable of (int, iterable of int)
+        Pairs of a bus label and the labels of the lines connected to it
+        that are moved to a new busbar.
+
+    Raises
+    ------
+    IslandingError
+        If the changed topology leaves buses without connection to a
+        reference bus.
+    """
+
+    def __init__(self, sens, cuts=(), splits=()):
+        m = sens.model
+        self.sens = sens
+        line_pos = m.line_index.get_indexer(list(cuts))
+        on_pos = {pos: i for (i, pos) in enumerate(sens.line_pos)}
+        self.cut = np.zeros(sens.n_lines, dtype=bool)
+        self.cut[line_pos] = True
+
+        # Busbar of every line end: bus position, or twin number after bus
+        n_red = len(m.pvpq)
+        n_twins = len(splits)
+        f_ext = sens.red_pos[m.f].copy()
+        t_ext = sens.red_pos[m.t].copy()
+        bus_lookup = {bus: i for (i, bus) in enumerate(m.bus_index)}
+        for (j, (bus, lines)) in enumerate(splits):
+            b = bus_lookup[bus]
+            for pos in m.line_index.get_indexer(list(lines)):
+                i = on_pos[pos]
+                if m.f[i] == b:
+                    f_ext[i] = n_red + j
+                elif m.t[i] == b:
+                    t_ext[i] = n_red + j
+                else:
+                    raise ValueError(f'Line {m.line_index[pos]} is not '
+                                     f'connected to bus {bus}.')
+
+        # Rank-one terms w*u*u^T on the base block, borders to twins
+        u_list, w_list = [], []
+        c = np.zeros((n_red, n_twins))
+        d = np.zeros((n_twins, n_twins))
+
+        def unit(*entries):
+            u = np.zeros(n_red)
+            for (red, sign) in entries:
+                if red >= 0:
+                    u[red] += sign
+            return u
+
+        for (i, pos) in enumerate(sens.line_pos):
+            f0, t0 = sens.red_pos[m.f[i]], sens.red_pos[m.t[i]]
+            b = sens.b_line[i]
+            if self.cut[pos]:
+                u_list.append(unit((f0, 1), (t0, -1)))
+                w_list.append(-b)
+            elif f_ext[i] != f0 or t_ext[i] != t0:
+                u_list.append(unit((f0, 1), (t0, -1)))
+                w_list.append(-b)
+                ends = [e for e in (f_ext[i], t_ext[i]) if e < n_red]
+                twins = [e - n_red for e in (f_ext[i], t_ext[i])
+                         if e >= n_red]
+                for e in ends:
+                    if e < 0:
+                        continue
+                    u_list.append(unit((e, 1)))
+                    w_list.append(b)
+                    for j in twins:
+                        c[e, j] -= b
+                for j in twins:
+                    d[j, j] += b
+                if len(twins) == 2:
+                    d[twins[0], twins[1]] -= b
+                    d[twins[1], twins[0]] -= b
+
+        b_inv = m.b_red_inv
+        if u_list:
+            u = np.array(u_list).T
+            self.u = u
+            self.z = b_inv @ u
+            w_inv = 1/np.array(w_list)
+            k = np.diag(w_inv) + u.T @ self.z
+            self.k_inv = self._inverse(k, np.abs(w_inv).max())
+        else:
+            self.u = np.zeros((n_red, 0))
+            self.z = np.zeros((n_red, 0))
+            self.k_inv = np.zeros((0, 0))
+
+        # Schur complement of the twin busbars
+        self.c = c
+        if n_twins:
+            x = b_inv @ c - self.z @ (self.k_inv @ (self.u.T @ b_inv @ c))
+            self.x = x
+            self.s_inv = self._inverse(d - c.T @ x, np.abs(d).max())
+
+        self.n_red = n_red
+        self.n_twins = n_twins
+        self.f_ext = np.where(f_ext < 0, n_red + n_twins, f_ext)
+        self.t_ext = np.where(t_ext < 0, n_red + n_twins, t_ext)
+
+    @staticmethod
+    def _inverse(matrix, scale):
+        singular = np.linalg.svd(matrix, compute_uv=False)
+        if singular.min() <= _MIN_SINGULAR*max(singular.max(), scale):
+            raise IslandingError('Topology change disconnects buses '
+                                 'from the reference bus.')
+        return np.linalg.inv(matrix)
+
+    def flows(self, theta0):
+        """DC line flows in MW from base reduced angles (steps, buses)."""
+        sens = self.sens
+        theta = theta0 - (theta0 @ self.u) @ self.k_inv @ self.z.T
+        parts = [theta]
+        if self.n_twins:
+            theta_twin = -(theta @ self.c) @ self.s_inv.T
+            parts = [theta - theta_twin @ self.x.T, theta_twin]
+        parts.append(np.zeros(theta.shape[:-1] + (1,)))
+        ext = np.concatenate(parts, axis=-1)
+
+        p_line = np.zeros(theta.shape[:-1] + (sens.n_lines,))
+        p_line[..., sens.line_pos] = (sens.b_line*sens.model.sn_mva
+                                      *(ext[..., self.f_ext]
+                                        - ext[..., self.t_ext]))
+        p_line[..., self.cut] = 0.
+        return p_line
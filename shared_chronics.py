@@ -0,0 +1,385 @@
+import os
+from datetime import datetime, timedelta
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+import grid2op
+from grid2op.Chronics import GridStateFromFile
+
+__all__ = ['ENV_DIR',
+           'CHRONICS_NAMES',
+           'SharedChronics',
+           'SharedGridStateFromFile',
+           'make_env',
+           'VectorEnv']
+
+# Grid2op environment of the toy grid
+ENV_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'grid2op_env', '')
+
+# Injection files of a chronics folder, as read by GridStateFromFile
+CHRONICS_NAMES = ('load_p', 'load_q', 'prod_p', 'prod_v')
+
+# File extensions in the order GridStateFromFile looks for them
+FILE_EXTENSIONS = ('.csv', '.csv.bz2', '.zip', '.csv.xz')
+
+# Data type of chronics values in grid2op
+DT_FLOAT = np.float32
+
+# Shared memory blocks attached by this process, by block name
+_ATTACHED = {}
+
+def _file_ext(folder, data_name):
+    for ext in FILE_EXTENSIONS:
+        if os.path.exists(os.path.join(folder, data_name + ext)):
+            return ext
+    return None
+
+class SharedChronics:
+    """Chronics of a Multifolder directory in one shared memory block.
+
+    `create` parses the injection files of every chronics folder once
+    and copies them into a block of `multiprocessing.shared_memory`, as
+    float32 arrays in the column order of the files. The `handle` is a
+    small picklable dict; processes started by `multiprocessing` from the
+    creating process attach to the block with `attach` and read the
+    chronics as views, without copies. The block is removed when the
+    creating instance is closed with `unlink`, or leaves its `with` block.
+
+    Parameters
+    ----------
+    handle : dict
+        Block name and layout, from `create`.
+    shm : SharedMemory
+        The attached block.
+    owner : bool
+        Whether this instance created the block.
+    """
+
+    def __init__(self, handle, shm, owner=False):
+        self.handle = handle
+        self.shm = shm
+        self.owner = owner
+        self.folders = {folder: {data_name: self._view(layout)
+                                 for (data_name, layout) in files.items()}
+                        for (folder, files) in handle['folders'].items()}
+
+    def _view(self, layout):
+        values = np.ndarray(tuple(layout['shape']), dtype=DT_FLOAT,
+                            buffer=self.shm.buf, offset=layout['offset'])
+        values.flags.writeable = False
+        return values, pd.Index(layout['columns']), layout['ext']
+
+    @classmethod
+    def create(cls, chronics_dir=ENV_DIR + 'chronics', sep=';'):
+        """Load every chronics folder of `chronics_dir` into shared memory."""
+        arrays = {}
+        for name in sorted(os.listdir(chronics_dir)):
+            folder = os.path.abspath(os.path.join(chronics_dir, name))
+            if not os.path.isdir(folder):
+                continue
+            for data_name in CHRONICS_NAMES:
+                ext = _file_ext(folder, data_name)
+                if ext is not None:
+                    frame = pd.read_csv(os.path.join(folder, data_name + ext),
+                                        sep=sep)
+                    arrays[(folder, data_name)] = (
+                        frame.to_numpy(dtype=DT_FLOAT), list(frame.columns),
+                        ext)
+
+        # One block, with every array aligned to 64 bytes
+        layout = {}
+        offset = 0
+        for ((folder, data_name), (values, columns, ext)) in arrays.items():
+            layout.setdefault(folder, {})[data_name] = {
+                'offset': offset, 'shape': list(values.shape),
+                'columns': columns, 'ext': ext}
+            offset += -(-values.nbytes//64)*64
+        shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        for ((folder, data_name), (values, _, _)) in arrays.items():
+            start = layout[folder][data_name]['offset']
+            shm.buf[start:start + values.nbytes] = values.tobytes()
+
+        handle = {'name': shm.name, 'size': offset, 'folders': layout}
+        _ATTACHED[shm.name] = cls(handle, shm, owner=True)
+        return _ATTACHED[shm.name]
+
+    @classmethod
+    def attach(cls, handle):
+        """Attach to a block once per process."""
+        if handle['name'] not in _ATTACHED:
+            shm = shared_memory.SharedMemory(name=handle['name'])
+            _ATTACHED[handle['name']] = cls(handle, shm)
+        return _ATTACHED[handle['name']]
+
+    def frame(self, folder, data_name):
+        """Chronics of one file as a frame viewing the block, or None."""
+        files = self.folders.get(os.path.abspath(folder), {})
+        if data_name not in files:
+            return None
+        values, columns, _ = files[data_name]
+        return pd.DataFrame(values, columns=columns, copy=False)
+
+    def file_ext(self, folder, data_name):
+        files = self.folders.get(os.path.abspath(folder), {})
+        return files[data_name][2] if data_name in files else None
+
+    @property
+    def nbytes(self):
+        return self.handle['size']
+
+    def close(self):
+        self.folders = {}
+        _ATTACHED.pop(self.handle['name'], None)
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.owner:
+            self.unlink()
+        else:
+            self.close()
+
+class SharedGridStateFromFile(GridStateFromFile):
+    """GridStateFromFile reading its chronics from a `SharedChronics` block.
+
+    Pass it to `grid2op.make` with the handle, e.g. through `make_env`:
+    `data_feeding_kwargs={'gridvalueClass': SharedGridStateFromFile,
+    'shared_chronics': handle}`. Loading a chronics folder at a reset
+    then only creates views on the block, and the injections are kept as
+    views as long as the file columns are in the order of the backend.
+    Folders or files that are not in the block, as well as hazards and
+    maintenance, are read from disk as by GridStateFromFile.
+    """
+
+    def __init__(self, path, sep=';', time_interval=timedelta(minutes=5),
+                 max_iter=-1, start_datetime=datetime(year=2019, month=1,
+                                                       day=1),
+                 chunk_size=None, shared_chronics=None):
+        GridStateFromFile.__init__(self, path, sep=sep,
+                                   time_interval=time_interval,
+                                   max_iter=max_iter,
+                                   start_datetime=start_datetime,
+                                   chunk_size=chunk_size)
+
+        # Only the handle is kept, so copies of this object stay small
+        self.shared_chronics = shared_chronics
+
+    def _shared(self):
+        if self.shared_chronics is None:
+            return None
+        return SharedChronics.attach(self.shared_chronics)
+
+    def _get_fileext(self, data_name):
+        shared = self._shared()
+        if shared is not None and shared.file_ext(self.path, data_name):
+            return shared.file_ext(self.path, data_name)
+        return GridStateFromFile._get_fileext(self, data_name)
+
+    def _get_data(self, data_name, chunksize=-1, nrows=None):
+        shared = self._shared()
+        frame = None if shared is None else shared.frame(self.path, data_name)
+        if frame is None:
+            return GridStateFromFile._get_data(self, data_name, chunksize,
+                                               nrows)
+        if nrows is None and self._max_iter > 0:
+            nrows = self._max_iter + 1
+        if nrows is not None:
+            frame = frame.iloc[:nrows]
+        if chunksize == -1:
+            chunksize = self.chunk_size
+        if chunksize is None:
+            return frame
+        return (frame.iloc[start:start + chunksize]
+                for start in range(0, len(frame), chunksize))
+
+    def _file_len(self, fname, ext_):
+        shared = self._shared()
+        if shared is not None:
+            folder, file_name = os.path.split(fname)
+            frame = shared.frame(folder, file_name[:-len(ext_)])
+            if frame is not None:
+                return len(frame)
+        return GridStateFromFile._file_len(fname, ext_)
+
+    def _init_attrs(self, load_p, load_q, prod_p, prod_v, hazards=None,
+                    maintenance=None, is_init=False):
+        GridStateFromFile._init_attrs(self, None, None, None, None,
+                                      hazards=hazards,
+                                      maintenance=maintenance,
+                                      is_init=is_init)
+
+        # Views in file order, copies only if the backend order differs
+        for (name, frame, order) in [('load_p', load_p, self._order_load_p),
+                                     ('load_q', load_q, self._order_load_q),
+                                     ('prod_p', prod_p, self._order_prod_p),
+                                     ('prod_v', prod_v, self._order_prod_v)]:
+            if frame is None:
+                continue
+            values = frame.to_numpy().astype(DT_FLOAT, copy=False)
+            if not np.array_equal(order, np.arange(values.shape[1])):
+                values = values[:, order]
+            setattr(self, name, values)
+
+def make_env(shared_chronics=None, dataset=ENV_DIR, **kwargs):
+    """Grid2op environment of the toy grid.
+
+    With the handle of a `SharedChronics` block, chronics are read from
+    shared memory by `SharedGridStateFromFile`. Keyword arguments are
+    passed on to `grid2op.make`.
+    """
+    if shared_chronics is not None:
+        data_feeding_kwargs = dict(kwargs.pop('data_feeding_kwargs', {}))
+        data_feeding_kwargs.update(gridvalueClass=SharedGridStateFromFile,
+                                   shared_chronics=shared_chronics)
+        kwargs['data_feeding_kwargs'] = data_feeding_kwargs
+    return grid2op.make(dataset, **kwargs)
+
+def _env_step(env, action_dict):
+    obs, reward, done, info = env.step(env.action_space(action_dict or {}))
+    if done:
+        obs = env.reset()
+    return (obs.to_vect(), reward, done,
+            {'exception': [repr(error) for error in info['exception']]})
+
+def _worker(conn, n_envs, shared_chronics, seeds, env_kwargs):
+    import warnings
+
+    warnings.filterwarnings('ignore')
+    envs = [make_env(shared_chronics, **env_kwargs) for _ in range(n_envs)]
+    for (env, seed) in zip(envs, seeds):
+        env.seed(seed)
+    try:
+        while True:
+            command, data = conn.recv()
+            if command == 'reset':
+                conn.send([env.reset().to_vect() for env in envs])
+            elif command == 'step':
+                conn.send([_env_step(env, action_dict)
+                           for (env, action_dict) in zip(envs, data)])
+            elif command == 'close':
+                break
+    finally:
+        for env in envs:
+            env.close()
+        conn.close()
+
+class VectorEnv:
+    """Steps several grid2op environments of the toy grid together.
+
+    The environments are spread over `n_workers` processes, which all
+    read the chronics from one `SharedChronics` block, so memory for the
+    chronics does not grow with the number of environments. `step`
+    sends the actions of all environments at once and returns stacked
+    observation vectors; environments that are done are reset
+    automatically, and their row holds the first observation of the next
+    episode.
+
+    Parameters
+    ----------
+    n_envs : int
+        Number of environments.
+    n_workers : int, optional
+        Number of worker processes. The default is the number of CPUs, at
+        most `n_envs`.
+    chronics_dir : str
+        Multifolder chronics directory loaded into shared memory.
+    seed : int, optional
+        Environment `i` is seeded with `seed + i`.
+    **env_kwargs
+        Passed on to `make_env` in every worker.
+    """
+
+    def __init__(self, n_envs, n_workers=None, chronics_dir=None, seed=None,
+                 **env_kwargs):
+        import multiprocessing
+
+        if n_workers is None:
+            n_workers = os.cpu_count() or 1
+        n_workers = max(1, min(n_workers, n_envs))
+        if chronics_dir is None:
+            chronics_dir = os.path.join(env_kwargs.get('dataset', ENV_DIR),
+                                        'chronics')
+        self.n_envs = n_envs
+        self.shared = SharedChronics.create(chronics_dir)
+
+        # Contiguous groups of environments per worker
+        bounds = np.linspace(0, n_envs, n_workers + 1).astype(int)
+        self.groups = [range(a, b) for (a, b) in zip(bounds[:-1], bounds[1:])]
+        self.conns = []
+        self.processes = []
+        try:
+            for group in self.groups:
+                seeds = [None if seed is None else seed + i for i in group]
+                parent_conn, child_conn = multiprocessing.Pipe()
+                process = multiprocessing.Process(
+                    target=_worker, daemon=True,
+                    args=(child_conn, len(group), self.shared.handle, seeds,
+                          env_kwargs))
+                process.start()
+                child_conn.close()
+                self.conns.append(parent_conn)
+                self.processes.append(process)
+        except Exception:
+            self.close()
+            raise
+
+    def reset(self):
+        """Reset all environments; observations of shape (n_envs, dim)."""
+        for conn in self.conns:
+            conn.send(('reset', None))
+        return np.stack([obs for conn in self.conns for obs in conn.recv()])
+
+    def step(self, actions=None):
+        """Step all environments.
+
+        Parameters
+        ----------
+        actions : list of dict, optional
+            One action dict per environment, as accepted by the action
+            space, or None to do nothing. The default does nothing in
+            every environment.
+
+        Returns
+        -------
+        obs : ndarray
+            Observation vectors, shape (n_envs, dim).
+        rewards : ndarray
+        dones : ndarray
+        infos : list of dict
+        """
+        if actions is None:
+            actions = [None]*self.n_envs
+        for (conn, group) in zip(self.conns, self.groups):
+            conn.send(('step', [actions[i] for i in group]))
+        results = [result for conn in self.conns for result in conn.recv()]
+        obs, rewards, dones, infos = zip(*results)
+        return (np.stack(obs), np.array(rewards, dtype=float),
+                np.array(dones, dtype=bool), list(infos))
+
+    def close(self):
+        for conn in self.conns:
+            try:
+                conn.send(('close', None))
+            except (BrokenPipeError, OSError):
+                pass
+        for process in self.processes:
+            process.join(timeout=10)
+        self.conns = []
+        self.processes = []
+        if self.shared is not None:
+            self.shared.unlink()
+            self.shared = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
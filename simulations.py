@@ -1,120 +1,601 @@
 import os
+from contextlib import nullcontext
+
+import numpy as np
 import pandas as pd
 import yaml
-from tqdm import tqdm
 
-from pp_toy_model import (eq_yaml_parser, apply_eq_from_yaml,
-                          set_eq_by_bus_name)
+from pp_toy_model import eq_yaml_parser, apply_eq_from_yaml, InputPlan
+from batch_powerflow import run_batch
+from result_store import (ResLogger, RawResultStore, result_logger,
+                          iter_results)
 
-class ResLogger:
-    def __init__(self, path):       
-        self.path = path
-        if not os.path.isdir(path): 
-            os.mkdir(path)
+# Subdirectory for results of parallel shards
+SHARD_DIR = 'shards/'
+
+# Summary of monitored runs, next to the results
+SUMMARY_FILE = 'res_summary.json'
+
+# Store of raw power flow results, see `result_store.RawResultStore`
+RAW_NAME = 'raw'
+
+def _input_list(path):
+    with open(path+'input_config.yaml', 'r') as config_file:
+        return [tuple(eq) for eq in yaml.safe_load(config_file)]
+
+def _binary_inputs(path, eq_list):
+    
+    # Column names are written last by convert_inputs_to_npy and removed
+    # first when the CSV inputs are rewritten
+    return (os.path.isfile(path+'input_columns.yaml')
+            and all(os.path.isfile(path+f'{e}_{q}.npy') for (e, q) in eq_list))
+
+def _remove_binary_inputs(path, eq_list):
+    
+    # Binary copies of earlier inputs would take precedence over new CSVs
+    if os.path.isfile(path+'input_config.yaml'):
+        eq_list = [*eq_list, *_input_list(path)]
+    if os.path.isfile(path+'input_columns.yaml'):
+        os.remove(path+'input_columns.yaml')
+    for (element, quantity) in eq_list:
+        if os.path.isfile(path+f'{element}_{quantity}.npy'):
+            os.remove(path+f'{element}_{quantity}.npy')
+
+def count_steps(path):
+    """Number of input steps of a simulation, without parsing the inputs."""
+    eq_list = _input_list(path)
+    element, quantity = eq_list[0]
+    if _binary_inputs(path, eq_list):
+        return len(np.load(path+f'{element}_{quantity}.npy', mmap_mode='r'))
+    with open(path+f'{element}_{quantity}.csv', 'rb') as eq_file:
+        return sum(1 for _ in eq_file) - 1
+
+def convert_inputs_to_npy(path, chunk_size=100000):
+    """Write a binary copy of the CSV inputs for memory-mapped reading.
+    
+    Each `{element}_{quantity}.csv` gets a float `.npy` counterpart, and
+    the column names are stored in `input_columns.yaml`. Input readers
+    prefer the binary files once they exist. Conversion streams in
+    chunks, so memory use is bounded by `chunk_size`.
+    """
+    from numpy.lib.format import open_memmap
+    
+    n_steps = count_steps(path)
+    columns = {}
+    for (element, quantity) in _input_list(path):
+        name = f'{element}_{quantity}'
+        chunks = pd.read_csv(path+name+'.csv', index_col=0,
+                             chunksize=chunk_size)
+        array = None
+        for eq_frame in chunks:
+            if array is None:
+                array = open_memmap(path+name+'.npy.tmp', mode='w+',
+                                    dtype=float,
+                                    shape=(n_steps, len(eq_frame.columns)))
+                columns[name] = list(eq_frame.columns)
             
-        # Infer the last result computation that has been run
-        if os.path.isfile(path+'res.csv'):
-            with open(path+'res.csv', 'r') as res:
-                lines = res.readlines()
-                
-                # File is empty with no header
-                if len(lines) == 0:
-                    self.header = False
-                    self.last_run = None  
-                    
-                # File has header
-                else:
-                    first_line = lines[0]
-                    last_line= lines[0]
-                    self.columns = pd.Index((first_line[1:]
-                                             .rstrip().split(',')))
-                    self.header = True
-                    
-                    # File is empty with header
-                    if last_line.split(',')[0] == 0:
-                        self.last_run = None
-                    
-                    # Previous result computations exists
-                    else:
-                        self.last_run = int(lines[-1].split(',')[0])
-        
-        # If result file does not exist
-        else:
-            self.header = False
-            self.last_run = None
-    
-    def __enter__(self):
-        self.res = open(self.path+'res.csv', 'a').__enter__()
-        return self
-    
-    def __exit__(self, exc_type, exc_value, traceback):
-        self.res.__exit__(exc_type, exc_value, traceback)
-        
-    def write_header(self, columns):
-        self.columns = columns
-        for column in columns:
-            self.res.write(','+column)
-        self.res.write('\n')
-        
-    def write_res(self, idx, res_series):
-        res_list = res_series[self.columns].values
-        self.res.write(str(idx))
-        for res in res_list:
-            self.res.write(','+str(res))
-        self.res.write('\n')
+            # Binary inputs are addressed by position, steps 0 to n-1
+            first = eq_frame.index[0]
+            last = first + len(eq_frame.index)
+            if not (eq_frame.index == range(first, last)).all():
+                raise ValueError(f'{name}.csv is not indexed by consecutive '
+                                 f'steps.')
+            array[first:last] = eq_frame.values
+        array.flush()
+        del array
+        os.replace(path+name+'.npy.tmp', path+name+'.npy')
+    
+    with open(path+'input_columns.yaml', 'w') as columns_file:
+        yaml.dump(columns, columns_file)
+
+class InputReader:
+    """Streams simulation inputs in chunks aligned with a step range.
+    
+    Inputs are read from the binary files of `convert_inputs_to_npy` by
+    memory-mapping when they exist, and otherwise parsed from the CSV
+    files, skipping rows before `start`. A background thread prepares the
+    next chunk while the current one is used, so at most a few chunks are
+    held in memory regardless of the scenario length.
+    
+    Parameters
+    ----------
+    path : str
+        Simulation directory created with `init_simulations`.
+    start, stop : int
+        Step range to read.
+    chunk_size : int
+        Number of steps per chunk.
+    prefetch : bool
+        Whether to read ahead in a background thread.
+    """
+    
+    def __init__(self, path, start, stop, chunk_size=10000, prefetch=True):
+        self.path = path
+        self.start = start
+        self.stop = stop
+        self.chunk_size = chunk_size
+        self.prefetch = prefetch
+        self.eq_list = _input_list(path)
+        self.binary = _binary_inputs(path, self.eq_list)
+        self._chunks = None
+        self._plan = None
+    
+    def _read_binary(self):
+        with open(self.path+'input_columns.yaml', 'r') as columns_file:
+            columns = yaml.safe_load(columns_file)
+        arrays = {(e, q): np.load(self.path+f'{e}_{q}.npy', mmap_mode='r')
+                  for (e, q) in self.eq_list}
+        stop = min(self.stop, len(next(iter(arrays.values()))))
+        for start in range(self.start, stop, self.chunk_size):
+            chunk_stop = min(start + self.chunk_size, stop)
+            index = pd.RangeIndex(start, chunk_stop)
+            yield {(e, q): pd.DataFrame(array[start:chunk_stop], index=index,
+                                        columns=columns[f'{e}_{q}'],
+                                        copy=False)
+                   for (e, q), array in arrays.items()}
+    
+    def _read_csv(self):
+        if self.stop <= self.start:
+            return
+        readers = [pd.read_csv(self.path+f'{e}_{q}.csv', index_col=0,
+                               skiprows=range(1, self.start + 1),
+                               nrows=max(self.stop - self.start, 0),
+                               chunksize=self.chunk_size)
+                   for (e, q) in self.eq_list]
+        for eq_frames in zip(*readers):
+            yield dict(zip(self.eq_list, eq_frames))
+    
+    def __iter__(self):
+        chunks = self._read_binary() if self.binary else self._read_csv()
+        if self.prefetch:
+            chunks = _prefetch(chunks)
+        return chunks
+    
+    def apply(self, net, n):
+        """Apply the inputs of step `n`; steps must be ascending."""
+        if self._chunks is None:
+            self._chunks = iter(self)
+        while self._plan is None or n > self._last:
+            eq_frame_dict = next(self._chunks)
+            self._plan = InputPlan(net, eq_frame_dict)
+            self._last = next(iter(eq_frame_dict.values())).index[-1]
+        self._plan.apply(net, n)
+
+def _prefetch(iterable, size=1, timeout=0.1):
+    import queue
+    import threading
+    
+    # Produce items in a background thread, at most `size` ahead
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    done = object()
+    
+    # Wait for space in the queue until the consumer stops
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=timeout)
+                return True
+            except queue.Full:
+                pass
+        return False
+    
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except BaseException as error:
+            put((None, error))
+            return
+        put((done, None))
         
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    
+    # Closing the generator early, e.g. on an error in the step loop,
+    # stops the producer as well
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
 def run_simulations(path, net, metrics, simulation_step_func,
-                    until=None, overwrite=False):
-               
-    # Load simulation inputs   
-    with open(path+'input_config.yaml', 'r') as config_file:
-        eq_list = yaml.safe_load(config_file)
-        
-    eq_frame_dict = {}
-    for (element, quantity) in eq_list:
-        eq_frame = pd.read_csv(path+f'{element}_{quantity}.csv',
-                               index_col=0)
-        eq_frame_dict[(element, quantity)] = eq_frame
+                    until=None, overwrite=False, batch=None,
+                    chunk_size=10000, backend='csv', monitor=None,
+                    raw=False):
+    from tqdm import tqdm
     
     # Set final simulation step
     if until==None:
-        stop = len(eq_frame.index)
+        stop = count_steps(path)
     else:
         stop = until
         
-    # Logic for applying n-th inputs and running simulation step
-    def set_eq_and_run(n): 
-        for (e_name, q_name), q_value in eq_frame_dict.items():
-            q_series = pd.Series(q_value.loc[n, :], name=q_name)
-            set_eq_by_bus_name(net, e_name, q_series)
-        return simulation_step_func(net, metrics)
-        
-    # Check progress with logger
-    with ResLogger(path) as l:
-        
-        # If no header, run zeroth simulation step to infer column names
-        if not l.header:
-            progress = iter(tqdm(range(stop)))
-            results = set_eq_and_run(next(progress))
-            l.write_header(results.index)
-            l.write_res(0, results)
-        
-        # If header but no last run, start from beginning
-        elif not l.last_run:
-            progress = tqdm(range(stop))
+    # Batch mode: solve chunks of steps at once, no step function; steps
+    # whose AC power flow does not converge get NaN metrics
+    if batch is not None:
+        from batch_powerflow import BatchPowerFlow
+        solver = BatchPowerFlow(net)
+        with result_logger(path, backend=backend) as l, \
+             _raw_store(path, RAW_NAME, raw) as raw_store:
+            start = 0 if l.last_run is None else l.last_run + 1
+            reader = InputReader(path, start, stop, chunk_size)
+            for eq_frame_dict in tqdm(reader, total=-(-(stop - start)
+                                                      // chunk_size)):
+                steps = next(iter(eq_frame_dict.values())).index
+                res_frame, = run_batch(net, metrics, eq_frame_dict,
+                                       range(steps[0], steps[-1] + 1),
+                                       mode=batch, chunk_size=chunk_size,
+                                       solver=solver, raw_store=raw_store)
+                if not l.header:
+                    l.write_header(res_frame.columns)
+                l.write_frame(res_frame)
+        return
+        
+    # Check progress with logger, then stream inputs from the first step
+    with result_logger(path, backend=backend) as l, \
+         _raw_store(path, RAW_NAME, raw) as raw_store:
+        start = 0 if l.last_run is None else l.last_run + 1
+        reader = InputReader(path, start, stop, chunk_size)
+        set_eq, step_func = _raw_step(raw_store, reader.apply,
+                                      simulation_step_func)
+        
+        # Instrumented loop, with the summary written next to the results
+        if monitor is not None:
+            try:
+                monitor.run(l, set_eq, step_func, net, metrics, start, stop,
+                            tqdm)
+            finally:
+                if monitor.save_summary:
+                    monitor.write_summary(path + SUMMARY_FILE)
+            return
+        
+        # Logic for applying n-th inputs and running simulation step
+        def set_eq_and_run(n): 
+            set_eq(net, n)
+            return step_func(net, metrics)
+        
+        _run_steps(l, set_eq_and_run, start, stop, tqdm)
+
+def _raw_store(path, name, raw):
+    return RawResultStore(path, name) if raw else nullcontext()
+
+def _raw_step(raw_store, set_eq, simulation_step_func):
+    if raw_store is None:
+        return set_eq, simulation_step_func
+    return raw_store.wrap(set_eq, simulation_step_func)
+
+def _run_steps(l, set_eq_and_run, start, stop, progress_bar):
+        
+    # If no header, run first simulation step to infer column names
+    if not l.header:
+        progress = iter(progress_bar(range(start, stop)))
+        n = next(progress, None)
+        if n is None:
+            return
+        results = set_eq_and_run(n)
+        l.write_header(results.index)
+        l.header = True
+        l.write_res(n, results)
+    
+    # If header but no last run, start from beginning
+    elif l.last_run is None:
+        progress = progress_bar(range(start, stop))
+        
+    # Otherwise start after last run
+    else:
+        progress = progress_bar(range(max(start, l.last_run + 1), stop))
+        
+    # Main loop
+    for n in progress:
+        results = set_eq_and_run(n)
+        l.write_res(n, results)
+
+def _run_shard(path, config_file, metric_names, simulation_step_func,
+               start, stop, backend, monitor=None, raw=False, net=None,
+               shard_dir=None, until=None):
+    from pp_toy_model import create_toy_model
+    from metrics import create_metrics
+    from grid_file import GRID_EXTENSION, load_grid
+    
+    # Every worker owns its network and reads only its own input rows
+    if net is None and config_file.endswith(GRID_EXTENSION):
+        net = load_grid(config_file)
+    elif net is None:
+        net = create_toy_model(config_file)
+    metrics = create_metrics(metric_names)
+    if shard_dir is None:
+        shard_dir = path+SHARD_DIR
+        
+    # Partial shards of a longer run are resumed only up to `until`
+    run_stop = stop if until is None else min(stop, until)
+    
+    with result_logger(shard_dir, f'res_{start}_{stop}', backend) as l, \
+         _raw_store(shard_dir, f'{RAW_NAME}_{start}_{stop}',
+                    raw) as raw_store:
+        first = start if l.last_run is None else max(start, l.last_run + 1)
+        reader = InputReader(path, first, run_stop)
+        set_eq, step_func = _raw_step(raw_store, reader.apply,
+                                      simulation_step_func)
+        
+        # Summaries of monitored shards are merged by the main process
+        if monitor is not None:
+            try:
+                monitor.run(l, set_eq, step_func, net, metrics, start,
+                            run_stop, lambda steps: steps)
+            finally:
+                summary = monitor.summary()
+            return start, stop, summary
+        
+        def set_eq_and_run(n):
+            set_eq(net, n)
+            return step_func(net, metrics)
+        
+        _run_steps(l, set_eq_and_run, start, run_stop, lambda steps: steps)
+        
+    return start, stop, None
+
+def _shard_loggers(path, read_only=False):
+    """Map (start, stop) of every shard of a run to its result logger."""
+    shards = {}
+    if os.path.isdir(path+SHARD_DIR):
+        for file_name in os.listdir(path+SHARD_DIR):
+            if not file_name.startswith('res_'):
+                continue
+            if file_name.endswith('.csv'):
+                name, backend = file_name[:-4], 'csv'
+            elif os.path.isdir(path+SHARD_DIR+file_name):
+                name, backend = file_name, 'npy'
+            else:
+                continue
+            start, stop = name[4:].split('_')
+            shards[(int(start), int(stop))] = result_logger(
+                path+SHARD_DIR, name, backend, read_only=read_only)
+    return dict(sorted(shards.items()))
+
+def missing_steps(path, stop, backend='csv'):
+    """Step ranges of a run that are neither in the results nor in shards.
+    
+    Returns
+    -------
+    first : int
+        First step that is not in the merged result file.
+    ranges : list of tuple
+        Pairs (start, stop) of steps not yet computed, in ascending order.
+        Partially completed shards contribute the steps after their
+        last logged result.
+    """
+    last_run = result_logger(path, backend=backend, read_only=True).last_run
+    first = 0 if last_run is None else last_run + 1
+    
+    # Steps already covered by shard files, up to their last result
+    done = []
+    for (start, shard_stop), shard in _shard_loggers(path, True).items():
+        if shard.last_run is not None:
+            done.append((start, shard.last_run + 1))
+        
+    ranges = []
+    n = first
+    for (start, done_stop) in sorted(done):
+        if done_stop <= n:
+            continue
+        if start > n:
+            ranges.append((n, min(start, stop)))
+        n = max(n, done_stop)
+        if n >= stop:
+            break
+    if n < stop:
+        ranges.append((n, stop))
+    return first, [(a, b) for (a, b) in ranges if a < b]
+
+def merge_shards(path, backend='csv'):
+    """Append completed shard results to the run results in step order.
+    
+    Shards are merged as long as they continue the result file without
+    gaps; fully merged shard files are removed.
+    """
+    with result_logger(path, backend=backend) as l:
+        n = 0 if l.last_run is None else l.last_run + 1
+        for (start, stop), shard in _shard_loggers(path).items():
+            if shard.last_run is None or shard.last_run < n:
+                if shard.last_run is not None or stop <= n:
+                    shard.remove()
+                continue
+            if start > n:
+                break
+            res_frame = shard.read().loc[n:]
+            if not l.header:
+                l.write_header(res_frame.columns)
+            l.write_frame(res_frame)
+            n = shard.last_run + 1
             
-        # Otherwise start after last run
-        else:
-            progress = tqdm(range(l.last_run + 1, stop))
+            # Partial shards stay until their remaining steps are run
+            if n == stop:
+                shard.remove()
+            else:
+                break
+
+def run_simulations_parallel(path, config_file, metric_names,
+                             simulation_step_func, until=None,
+                             n_workers=None, shard_size=1000,
+                             backend='csv', monitor=None, raw=False):
+    """Run simulation steps in shards over a pool of worker processes.
+    
+    Every worker builds its own network from `config_file` and writes the
+    results of its shard to a separate file in `shards/`. Completed
+    shards are merged into the run results in step order. Rerunning after an
+    interruption only computes the steps that are still missing, including
+    the remainder of partially completed shards.
+    
+    Parameters
+    ----------
+    path : str
+        Simulation directory created with `init_simulations`.
+    config_file : str
+        Model configuration passed to `create_toy_model`, or a grid file
+        from `grid_file.save_grid` for step functions that do not need
+        Pandapower, so that workers do not import it.
+    metric_names : list of str
+        Keys of `metrics.METRICS`, passed to `create_metrics`.
+    simulation_step_func : callable
+        Module-level function (net, metrics) -> Series, so that it
+        can be sent to worker processes.
+    until : int, optional
+        Final simulation step. The default is all input steps.
+    n_workers : int, optional
+        Number of processes. The default is the number of CPUs.
+    shard_size : int
+        Maximum number of steps per shard.
+    backend : str
+        Result backend, a key of `result_store.RESULT_BACKENDS`.
+    monitor : monitoring.SimulationMonitor, optional
+        Monitor copied to every shard. Callbacks run in the worker
+        processes; the summary merges all shards of this call.
+    raw : bool
+        Store raw power flow results of every shard in `shards/`, for
+        `recompute_metrics`.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from monitoring import merge_summaries
+    from tqdm import tqdm
+    
+    if until is None:
+        stop = count_steps(path)
+    else:
+        stop = until
+        
+    # Pick up results of an interrupted run before planning shards
+    merge_shards(path, backend)
+    _, ranges = missing_steps(path, stop, backend)
+    
+    # Partial shards resume in their own file, new shards fill the gaps
+    existing = _shard_loggers(path)
+    shards = []
+    for (start, range_stop) in ranges:
+        for (shard_start, shard_stop) in existing:
+            if shard_start <= start < shard_stop:
+                shards.append((shard_start, shard_stop))
+                start = shard_stop
+        for shard_start in range(start, range_stop, shard_size):
+            shards.append((shard_start,
+                           min(shard_start + shard_size, range_stop)))
+    shards = sorted(set(shards))
+    
+    # Created once here, as all workers open their shard at the same time
+    os.makedirs(path+SHARD_DIR, exist_ok=True)
+    summaries = []
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = [pool.submit(_run_shard, path, config_file, metric_names,
+                               simulation_step_func, start, shard_stop,
+                               backend, monitor, raw, until=stop)
+                   for (start, shard_stop) in shards]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            summaries.append(future.result()[2])
             
-        # Main loop
-        for n in progress:
-            results = set_eq_and_run(n)
-            l.write_res(n, results)
+    merge_shards(path, backend)
+    if monitor is not None and monitor.save_summary:
+        monitor.write_summary(path + SUMMARY_FILE, 
+                              merge_summaries(summaries))
+        
+def _raw_stores(path):
+    """Raw result stores of a run: the main store, then shard stores."""
+    stores = [RawResultStore(path, RAW_NAME)]
+    if os.path.isdir(path+SHARD_DIR):
+        for dir_name in sorted(os.listdir(path+SHARD_DIR)):
+            if dir_name.startswith(RAW_NAME+'_'):
+                stores.append(RawResultStore(path+SHARD_DIR, dir_name))
+    return [store for store in stores if store.exists()]
+
+def recompute_metrics(path, net, metrics, name='res', overwrite=False):
+    """Evaluate metrics on stored raw results and add them to the results.
+    
+    Raw results written by `run_simulations` or `run_simulations_parallel`
+    with `raw=True` are read chunk by chunk and evaluated in batch with
+    `metrics.MetricEngine`, with the line states stored per step. No power
+    flow is solved. The metric columns are added to the results of the
+    run; steps without raw results get NaN.
+    
+    Parameters
+    ----------
+    path : str
+        Simulation directory.
+    net : pandapowerNet
+        Network the run was simulated on, from `create_toy_model`.
+    metrics : list
+        Output of `metrics.create_metrics`.
+    name : str
+        Name of the results.
+    overwrite : bool
+        Replace result columns of the same name. Otherwise existing
+        columns raise a ValueError.
+    
+    Returns
+    -------
+    res_frame : DataFrame
+        Values of the recomputed metrics, indexed by step.
+    """
+    from metrics import MetricEngine
+    
+    stores = _raw_stores(path)
+    if not stores:
+        raise FileNotFoundError(f'No raw results in {path}')
+    engine = MetricEngine(net, metrics)
+    
+    frames = []
+    for store in stores:
+        if store.lines != list(net.line.index):
+            raise ValueError(f'Raw results in {store.file} do not match '
+                             f'the lines of the network')
+        for (idx, arrays) in store.iter_chunks():
+            in_service = arrays.pop('in_service')
+            res = {quantity: np.asarray(values, dtype=float)
+                   for (quantity, values) in arrays.items()}
+            frames.append(engine.frame(res, index=idx,
+                                       in_service=in_service))
+    res_frame = pd.concat(frames)
+    res_frame = res_frame[~res_frame.index.duplicated(keep='last')]
+    res_frame = res_frame.sort_index()
+    
+    # Results are rewritten under a temporary name, then replaced
+    backend = 'npy' if os.path.isfile(path + name + '/index.json') else 'csv'
+    l = result_logger(path, name, backend)
+    if not l.exists():
+        with result_logger(path, name, backend) as l:
+            l.write_header(res_frame.columns)
+            l.write_frame(res_frame)
+        return res_frame
+    
+    existing = [column for column in res_frame.columns 
+                if column in l.columns]
+    if existing and not overwrite:
+        raise ValueError(f'Results already have columns {existing}')
+    columns = [column for column in l.columns if column not in existing]
+    tmp_name = name + '_tmp'
+    if result_logger(path, tmp_name, backend).exists():
+        result_logger(path, tmp_name, backend).remove()
+    with result_logger(path, tmp_name, backend) as tmp:
+        tmp.write_header([*l.columns, *(column for column in res_frame.columns
+                                        if column not in existing)])
+        for res_chunk in iter_results(path, name, columns):
+            res_chunk = res_chunk.join(res_frame.reindex(res_chunk.index))
+            tmp.write_frame(res_chunk)
+    if backend == 'npy':
+        l.remove()
+    os.replace(tmp.file, l.file)
+    return res_frame
         
 def init_simulations(path, eq_frame_dict):
     if not os.path.isdir(path): 
         os.mkdir(path)
+    _remove_binary_inputs(path, eq_frame_dict)
         
     eq_list = []
     for (element, quantity), eq_frame in eq_frame_dict.items():
@@ -149,4 +630,107 @@ def create_time_series(base_yaml, net, apply_noise_func, length,
             value_series.index = net[element]['name']
             eq_frame.loc[n, :] = value_series
             
-    return eq_frame_dict
\ No newline at end of file
+    return eq_frame_dict
+
+def iter_time_series(base_yaml, net, length, chunk_size=100000, rng=None,
+                     elements='all', quantities='all', **noise_kwargs):
+    """Generate noisy time series in chunks of vectorized draws.
+    
+    The base profile is parsed once, and noise for a whole chunk of steps
+    is drawn with `metrics.sample_load_gen_noise`, which follows the same
+    distribution as `metrics.apply_load_gen_noise`. Quantities other than
+    load and generator active power keep their base values.
+    
+    Parameters
+    ----------
+    base_yaml : str
+        Base profile in the format of `eq_yaml_parser`.
+    net : pandapowerNet
+        Network object from `create_toy_model`; the base profile is
+        applied to it.
+    length : int
+        Total number of steps.
+    chunk_size : int
+        Number of steps per yielded chunk.
+    rng : numpy.random.Generator or int, optional
+        Random generator or seed, used for all chunks. For a given seed,
+        the draws also depend on `chunk_size`.
+    **noise_kwargs
+        Passed on to `sample_load_gen_noise`.
+    
+    Yields
+    ------
+    eq_frame_dict : dict
+        Maps (element, quantity) to a frame of one chunk of steps.
+    """
+    from metrics import sample_load_gen_noise
+    
+    rng = np.random.default_rng(rng)
+    eq_series_dict = eq_yaml_parser(base_yaml)
+    apply_eq_from_yaml(net, base_yaml)
+    base = {('load', 'p_mw'): net.load['p_mw'].values.astype(float),
+            ('gen', 'p_mw'): net.gen['p_mw'].values.astype(float)}
+    
+    # Table positions of the columns of each selected element-quantity pair
+    selected = {}
+    for (element, quantity), eq_series in eq_series_dict.items():
+        if ((elements == 'all' or element in elements) 
+            and (quantities == 'all' or quantity in quantities)):
+            name_map = getattr(net, element + '_name_map')
+            rows = net[element].index.get_indexer(name_map[eq_series.index])
+            selected[(element, quantity)] = (eq_series.index, rows)
+    
+    for start in range(0, length, chunk_size):
+        n_steps = min(chunk_size, length - start)
+        index = pd.RangeIndex(start, start + n_steps)
+        load, gen = sample_load_gen_noise(base[('load', 'p_mw')],
+                                          base[('gen', 'p_mw')], n_steps,
+                                          rng=rng, **noise_kwargs)
+        noisy = {('load', 'p_mw'): load, ('gen', 'p_mw'): gen}
+        
+        eq_frame_dict = {}
+        for (element, quantity), (columns, rows) in selected.items():
+            if (element, quantity) in noisy:
+                values = noisy[(element, quantity)][:, rows]
+            else:
+                values = np.tile(net[element][quantity].values[rows]
+                                 .astype(float), (n_steps, 1))
+            eq_frame_dict[(element, quantity)] = pd.DataFrame(
+                values, index=index, columns=columns)
+        yield eq_frame_dict
+
+def generate_time_series(base_yaml, net, length, rng=None,
+                         elements='all', quantities='all', **noise_kwargs):
+    """Vectorized `create_time_series` with `apply_load_gen_noise`.
+    
+    Returns the whole scenario at once; see `iter_time_series`.
+    """
+    chunks = iter_time_series(base_yaml, net, length, chunk_size=max(length, 1),
+                              rng=rng, elements=elements,
+                              quantities=quantities, **noise_kwargs)
+    return next(chunks)
+
+def write_time_series(path, base_yaml, net, length, chunk_size=100000,
+                      rng=None, elements='all', quantities='all',
+                      **noise_kwargs):
+    """Stream generated time series into simulation input files.
+    
+    Writes the same files as `init_simulations`, one chunk at a time, so
+    memory use is bounded by `chunk_size` instead of `length`.
+    """
+    if not os.path.isdir(path): 
+        os.makedirs(path)
+        
+    chunks = iter_time_series(base_yaml, net, length, chunk_size=chunk_size,
+                              rng=rng, elements=elements,
+                              quantities=quantities, **noise_kwargs)
+    eq_frame_dict = {}
+    _remove_binary_inputs(path, [])
+    for n, eq_frame_dict in enumerate(chunks):
+        for (element, quantity), eq_frame in eq_frame_dict.items():
+            eq_frame.to_csv(path+f'{element}_{quantity}.csv',
+                            mode='w' if n == 0 else 'a', header=n == 0)
+    
+    eq_list = [[element, quantity] for (element, quantity) in eq_frame_dict]
+    with open(path+'input_config.yaml', 'w') as config_file:
+        yaml.dump(eq_list, config_file)
@@ -0,0 +1,610 @@
+import argparse
+import datetime
+import importlib
+import itertools
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+
+from simulations import (SHARD_DIR, RAW_NAME, init_simulations,
+                         generate_time_series, count_steps, merge_shards,
+                         _run_shard)
+from result_store import result_logger
+
+__all__ = ['MODEL_KEYS',
+           'SCENARIO_KEYS',
+           'expand_grid',
+           'scenario_net',
+           'LockLostError',
+           'SweepScheduler']
+
+# Sweep description, next to the scenario directories
+SWEEP_FILE = 'sweep.json'
+
+# Lock files of claimed work units and markers of finished ones
+LOCK_DIR = 'queue/locks/'
+DONE_DIR = 'queue/done/'
+
+# Shards of units in progress, per scenario and claim; moved to SHARD_DIR
+# when done
+UNIT_DIR = 'units/'
+
+# Grid parameters passed to create_toy_model
+MODEL_KEYS = ('config_file', 'substations', 'ring_buses', 'rings')
+
+# Grid parameters with a meaning of their own; all others are passed to
+# metrics.sample_load_gen_noise
+SCENARIO_KEYS = MODEL_KEYS + ('lines_out', 'seed', 'base_yaml')
+
+def expand_grid(grid):
+    """All combinations of a parameter grid, in the order of its keys.
+
+    Parameters
+    ----------
+    grid : dict
+        Maps parameter names to lists of values.
+
+    Returns
+    -------
+    scenarios : list of dict
+    """
+    keys = list(grid)
+    return [dict(zip(keys, values))
+            for values in itertools.product(*(grid[key] for key in keys))]
+
+def scenario_net(params):
+    """Network of a scenario: the toy model with `lines_out` cut.
+
+    `params` must contain 'config_file'; the other `MODEL_KEYS` are
+    passed on to `create_toy_model`, and the lines named in 'lines_out'
+    are taken out of service.
+    """
+    from pp_toy_model import create_toy_model
+
+    net = create_toy_model(params['config_file'],
+                           **{key: params[key] for key in MODEL_KEYS[1:]
+                              if key in params})
+    lines_out = list(params.get('lines_out') or [])
+    if lines_out:
+        net.line.loc[net.line_name_map[lines_out].values,
+                     'in_service'] = False
+    return net
+
+class LockLostError(RuntimeError):
+    pass
+
+def _claim(lock_file, owner):
+    """Create `lock_file` if it does not exist; atomic on NFS v3 and later.
+
+    Returns the token of the claim, written into the lock, or None if the
+    lock exists.
+    """
+    try:
+        fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return None
+    token = uuid.uuid4().hex
+    with os.fdopen(fd, 'w') as lock:
+        json.dump({'worker': owner, 'token': token, 'claimed': time.time()},
+                  lock)
+    return token
+
+def _owns(lock_file, token):
+    return (_read_json(lock_file) or {}).get('token') == token
+
+def _release(lock_file, token):
+    """Remove `lock_file` if it still holds the claim `token`."""
+    if _owns(lock_file, token):
+        try:
+            os.remove(lock_file)
+        except FileNotFoundError:
+            pass
+
+def _break_stale(lock_file, timeout):
+    """Remove `lock_file` if it was not refreshed for `timeout` seconds.
+
+    The lock is first renamed to a unique name, so of several workers
+    finding the same stale lock, only one removes it. A lock that turns
+    out to be fresh after the rename is put back.
+    """
+    try:
+        if time.time() - os.path.getmtime(lock_file) < timeout:
+            return False
+    except FileNotFoundError:
+        return True
+    stale_file = f'{lock_file}.{uuid.uuid4().hex}.stale'
+    try:
+        os.rename(lock_file, stale_file)
+    except FileNotFoundError:
+        return False
+    if time.time() - os.path.getmtime(stale_file) < timeout:
+        try:
+            os.link(stale_file, lock_file)
+        except FileExistsError:
+            pass
+        os.remove(stale_file)
+        return False
+    os.remove(stale_file)
+    return True
+
+def _read_json(file_name):
+    try:
+        with open(file_name, 'r') as json_file:
+            return json.load(json_file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def _write_json(file_name, content):
+    tmp_file = f'{file_name}.{uuid.uuid4().hex}.tmp'
+    with open(tmp_file, 'w') as json_file:
+        json.dump(content, json_file, indent=2)
+    os.replace(tmp_file, file_name)
+
+def _copy(source, target):
+    if os.path.isdir(source):
+        shutil.copytree(source, target)
+    elif os.path.isfile(source):
+        shutil.copy2(source, target)
+
+def _adopt(unit_dir, claim, names, backend):
+    """Copy the furthest partial shard of earlier claims of a unit.
+
+    Claims of a unit are directories `{start}_{stop}.{token}` in
+    `unit_dir`. The shard files `names` of the claim with the last result
+    furthest on are copied into the directory of `claim`, and the
+    earlier claims are removed. Copying, not moving, keeps a worker that
+    still writes to its old claim away from the new shard.
+    """
+    prefix = claim.split('.')[0] + '.'
+    claims = ([entry for entry in os.listdir(unit_dir)
+               if entry.startswith(prefix) and entry != claim]
+              if os.path.isdir(unit_dir) else [])
+    last_runs = {}
+    for entry in claims:
+        logger = result_logger(unit_dir + entry + '/', names[0], backend,
+                               read_only=True)
+        if logger.last_run is not None:
+            last_runs[entry] = logger.last_run
+    os.makedirs(unit_dir + claim, exist_ok=True)
+    if last_runs:
+        source = unit_dir + max(last_runs, key=last_runs.get) + '/'
+        for name in names:
+            _copy(source + name, unit_dir + claim + '/' + name)
+    for entry in claims:
+        shutil.rmtree(unit_dir + entry, ignore_errors=True)
+
+@contextmanager
+def _heartbeat(lock_file, interval, token):
+    """Refresh the lock in the background so it never looks stale.
+
+    Yields an event that is set once the lock no longer holds `token`,
+    i.e. after another worker broke it as stale; the lock is then no
+    longer refreshed.
+    """
+    stop = threading.Event()
+    lost = threading.Event()
+
+    def beat():
+        while not stop.wait(interval):
+            if not _owns(lock_file, token):
+                lost.set()
+                return
+            try:
+                os.utime(lock_file)
+            except FileNotFoundError:
+                pass
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield lost
+    finally:
+        stop.set()
+        thread.join()
+
+class SweepScheduler:
+    """Work queue of a sweep of simulations on a shared filesystem.
+
+    A sweep is a directory with one `run_simulations` directory per
+    scenario of a parameter grid, created by `SweepScheduler.create`. The
+    steps of every scenario are split into work units of `unit_size`
+    steps. Workers, on any node that mounts the sweep directory, claim
+    units by creating a lock file in `queue/locks/`, so any number of
+    workers can join or leave at any time. A running worker refreshes
+    the modification time of its locks; locks older than `lock_timeout`
+    are taken to be left by a dead worker, and their unit is resumed by
+    the next worker from the last result of its shard. Every claim writes
+    a token into its lock and runs in a directory of its own in `units/`,
+    so two workers never write the same shard; a worker whose lock was
+    taken over stops its unit with `LockLostError` at the next step.
+
+    Units run as shards of `simulations.run_simulations_parallel`, in the
+    scenario's `units/` directory, and are moved to `shards/` when
+    complete. The results of finished units are then merged into the
+    scenario results with `simulations.merge_shards`, by one worker at a
+    time. Finished units leave a marker in `queue/done/`, which `status`
+    reads for the throughput and ETA of the whole sweep.
+
+    Parameters
+    ----------
+    sweep_dir : str
+        Sweep directory created with `SweepScheduler.create`.
+    """
+
+    def __init__(self, sweep_dir):
+        self.sweep_dir = sweep_dir
+        sweep = _read_json(sweep_dir + SWEEP_FILE)
+        if sweep is None:
+            raise FileNotFoundError(f'No sweep in {sweep_dir}')
+        self.scenarios = sweep['scenarios']
+        self.metric_names = sweep['metric_names']
+        self.unit_size = sweep['unit_size']
+        self.backend = sweep['backend']
+        self.raw = sweep['raw']
+        self.units = [(scenario['name'], start,
+                       min(start + self.unit_size, scenario['steps']))
+                      for scenario in self.scenarios
+                      for start in range(0, scenario['steps'],
+                                         self.unit_size)]
+        self._by_name = {scenario['name']: scenario
+                         for scenario in self.scenarios}
+        self._nets = {}
+        self._tokens = {}
+
+    @classmethod
+    def create(cls, sweep_dir, grid, length, metric_names, base_yaml=None,
+               unit_size=1000, backend='csv', raw=False, seed=0):
+        """Create the scenario directories and the queue of a sweep.
+
+        Every combination of `grid` becomes a scenario: its network is
+        built with `scenario_net`, and `length` steps of noisy inputs are
+        generated with `simulations.generate_time_series` and written with
+        `init_simulations`. Scenarios whose inputs exist are kept, so an
+        interrupted creation can be repeated.
+
+        Parameters
+        ----------
+        sweep_dir : str
+            Directory of the sweep, on a filesystem shared by all workers.
+        grid : dict
+            Maps parameter names to lists of values; see `SCENARIO_KEYS`.
+            'config_file' is required.
+        length : int
+            Number of steps per scenario.
+        metric_names : list of str
+            Keys of `metrics.METRICS`.
+        base_yaml : str, optional
+            Base profile of all scenarios, unless given in the grid.
+        unit_size : int
+            Number of steps per work unit.
+        backend : str
+            Result backend, a key of `result_store.RESULT_BACKENDS`.
+        raw : bool
+            Store raw power flow results, see `simulations.recompute_metrics`.
+        seed : int
+            Seed from which the scenario seeds are drawn, unless the grid
+            gives 'seed'.
+
+        Returns
+        -------
+        scheduler : SweepScheduler
+        """
+        scenarios = expand_grid(grid)
+        seeds = np.random.default_rng(seed).integers(2**63,
+                                                     size=len(scenarios))
+        for (params, scenario_seed) in zip(scenarios, seeds):
+            params.setdefault('seed', int(scenario_seed))
+            params.setdefault('base_yaml', base_yaml)
+            if params['base_yaml'] is None:
+                raise ValueError('No base profile given for the sweep')
+
+        sweep = {'scenarios': [],
+                 'metric_names': list(metric_names),
+                 'unit_size': unit_size,
+                 'backend': backend,
+                 'raw': raw}
+        existing = _read_json(sweep_dir + SWEEP_FILE)
+        if existing is not None:
+            if ([scenario['params'] for scenario in existing['scenarios']]
+                    != json.loads(json.dumps(scenarios))):
+                raise ValueError(f'{sweep_dir} holds a different sweep')
+            return cls(sweep_dir)
+
+        for (i, params) in enumerate(scenarios):
+            name = f'scenario_{i:04d}'
+            path = sweep_dir + name + '/'
+            if not os.path.isfile(path + 'input_config.yaml'):
+                noise_kwargs = {key: value for (key, value) in params.items()
+                                if key not in SCENARIO_KEYS}
+                eq_frame_dict = generate_time_series(
+                    params['base_yaml'], scenario_net(params), length,
+                    rng=params['seed'], **noise_kwargs)
+                os.makedirs(path, exist_ok=True)
+                init_simulations(path, eq_frame_dict)
+            sweep['scenarios'].append({'name': name,
+                                       'path': path,
+                                       'params': params,
+                                       'steps': count_steps(path)})
+
+        os.makedirs(sweep_dir + LOCK_DIR, exist_ok=True)
+        os.makedirs(sweep_dir + DONE_DIR, exist_ok=True)
+        _write_json(sweep_dir + SWEEP_FILE, sweep)
+        return cls(sweep_dir)
+
+    @staticmethod
+    def unit_name(unit):
+        scenario, start, stop = unit
+        return f'{scenario}.{start}_{stop}'
+
+    def _lock_file(self, name):
+        return self.sweep_dir + LOCK_DIR + name + '.lock'
+
+    def _done_file(self, unit):
+        return self.sweep_dir + DONE_DIR + self.unit_name(unit) + '.json'
+
+    def claim(self, worker, lock_timeout=600.):
+        """Claim the first unit that is neither done nor locked.
+
+        Stale locks found on the way are broken, so their units are
+        claimed again.
+
+        Returns
+        -------
+        unit : tuple or None
+            (scenario name, start, stop), or None if no unit is free.
+        """
+        done = set(os.listdir(self.sweep_dir + DONE_DIR))
+        for unit in self.units:
+            name = self.unit_name(unit)
+            if name + '.json' in done:
+                continue
+            lock_file = self._lock_file(name)
+            if os.path.exists(lock_file):
+                if not _break_stale(lock_file, lock_timeout):
+                    continue
+            token = _claim(lock_file, worker)
+            if token is not None:
+                if os.path.exists(self._done_file(unit)):
+                    _release(lock_file, token)
+                    continue
+                self._tokens[lock_file] = token
+                return unit
+        return None
+
+    def _net(self, scenario):
+        if scenario['name'] not in self._nets:
+            self._nets[scenario['name']] = scenario_net(scenario['params'])
+        return self._nets[scenario['name']]
+
+    def run_unit(self, unit, simulation_step_func, worker,
+                 heartbeat=30., monitor=None):
+        """Run a claimed unit, publish its shard and release its lock.
+
+        Raises `LockLostError`, without publishing the shard, if the lock
+        of the unit was taken over by another worker.
+        """
+        scenario = self._by_name[unit[0]]
+        path = scenario['path']
+        (_, start, stop) = unit
+        lock_file = self._lock_file(self.unit_name(unit))
+        token = self._tokens.pop(lock_file)
+        names = [f'res_{start}_{stop}', f'res_{start}_{stop}.csv',
+                 f'{RAW_NAME}_{start}_{stop}']
+        claim = f'{start}_{stop}.{token}'
+        claim_dir = path + UNIT_DIR + claim + '/'
+        lost_error = LockLostError(f'Lock of {self.unit_name(unit)} was '
+                                   f'taken over')
+
+        started = time.time()
+        with _heartbeat(lock_file, heartbeat, token) as lost:
+
+            # Stop at the next step once another worker owns the unit
+            def step(net, metrics):
+                if lost.is_set():
+                    raise lost_error
+                return simulation_step_func(net, metrics)
+
+            # Units whose shard was published before a crash are not rerun
+            published = any(os.path.exists(path + SHARD_DIR + name)
+                            for name in names[:2])
+            if not published:
+                _adopt(path + UNIT_DIR, claim, names, self.backend)
+                try:
+                    _run_shard(path, None, self.metric_names, step, start,
+                               stop, self.backend, monitor=monitor,
+                               raw=self.raw, net=self._net(scenario),
+                               shard_dir=claim_dir)
+                except Exception:
+                    if lost.is_set() or not _owns(lock_file, token):
+                        raise lost_error from None
+                    raise
+                if not _owns(lock_file, token):
+                    raise lost_error
+                os.makedirs(path + SHARD_DIR, exist_ok=True)
+                for name in names:
+                    if os.path.exists(claim_dir + name):
+                        os.replace(claim_dir + name, path + SHARD_DIR + name)
+                shutil.rmtree(claim_dir, ignore_errors=True)
+
+        _write_json(self._done_file(unit),
+                    {'worker': worker,
+                     'steps': stop - start,
+                     'started': started,
+                     'finished': time.time()})
+        _release(lock_file, token)
+
+    def merge(self, scenario_name, lock_timeout=600., heartbeat=30.):
+        """Merge published shards into the results of a scenario.
+
+        The merge lock is refreshed while merging, like the locks of
+        units. Returns False without merging if another worker is merging.
+        """
+        lock_file = self._lock_file(scenario_name + '.merge')
+        if os.path.exists(lock_file):
+            _break_stale(lock_file, lock_timeout)
+        token = _claim(lock_file, socket.gethostname())
+        if token is None:
+            return False
+        try:
+            with _heartbeat(lock_file, heartbeat, token):
+                merge_shards(self._by_name[scenario_name]['path'],
+                             self.backend)
+        finally:
+            _release(lock_file, token)
+        return True
+
+    def run_worker(self, simulation_step_func, worker=None, max_units=None,
+                   lock_timeout=600., heartbeat=30., poll=None, monitor=None):
+        """Claim and run units until the queue is empty.
+
+        Parameters
+        ----------
+        simulation_step_func : callable
+            Module-level function (net, metrics) -> Series.
+        worker : str, optional
+            Name of the worker in the locks and done markers. The default
+            is the host name and process id.
+        max_units : int, optional
+            Leave the sweep after this many units.
+        lock_timeout : float
+            Age in seconds after which locks count as stale.
+        heartbeat : float
+            Interval in seconds at which locks are refreshed; must be well
+            below `lock_timeout`.
+        poll : float, optional
+            While units are locked by other workers, wait this many
+            seconds and claim again, to take over units of workers that
+            die. By default, the worker leaves when no unit is free.
+        monitor : monitoring.SimulationMonitor, optional
+            Passed on to every unit.
+
+        Returns
+        -------
+        n_units : int
+            Number of units run by this worker.
+        """
+        if worker is None:
+            worker = f'{socket.gethostname()}:{os.getpid()}'
+        n_units = 0
+        while max_units is None or n_units < max_units:
+            unit = self.claim(worker, lock_timeout)
+            if unit is None:
+                if poll is None or self.status()['units_running'] == 0:
+                    break
+                time.sleep(poll)
+                continue
+            try:
+                self.run_unit(unit, simulation_step_func, worker, heartbeat,
+                              monitor)
+            except LockLostError:
+                continue
+            self.merge(unit[0], lock_timeout, heartbeat)
+            n_units += 1
+        return n_units
+
+    def merge_all(self, lock_timeout=600., heartbeat=30.):
+        """Merge published shards of every scenario."""
+        for scenario in self.scenarios:
+            self.merge(scenario['name'], lock_timeout, heartbeat)
+
+    def status(self, now=None):
+        """Progress, throughput and ETA of the whole sweep.
+
+        Throughput counts the steps of finished units over the time from
+        the first start to the last finish, so it covers all workers
+        together; `steps_per_s_per_worker` is the mean rate of a single
+        worker.
+        """
+        now = time.time() if now is None else now
+        done = [_read_json(self.sweep_dir + DONE_DIR + file_name)
+                for file_name in os.listdir(self.sweep_dir + DONE_DIR)
+                if file_name.endswith('.json')]
+        done = [marker for marker in done if marker is not None]
+        locks = [file_name for file_name
+                 in os.listdir(self.sweep_dir + LOCK_DIR)
+                 if file_name.endswith('.lock')
+                 and not file_name.endswith('.merge.lock')]
+        workers = {marker['worker'] for marker in done}
+        running_workers = {(_read_json(self.sweep_dir + LOCK_DIR + file_name)
+                            or {}).get('worker') for file_name in locks}
+
+        total = sum(scenario['steps'] for scenario in self.scenarios)
+        steps_done = sum(marker['steps'] for marker in done)
+        steps_per_s = per_worker = eta = None
+        if done:
+            elapsed = (max(marker['finished'] for marker in done)
+                       - min(marker['started'] for marker in done))
+            busy = sum(marker['finished'] - marker['started']
+                       for marker in done)
+            if elapsed > 0:
+                steps_per_s = steps_done/elapsed
+                eta = (total - steps_done)/steps_per_s
+            if busy > 0:
+                per_worker = steps_done/busy
+        return {'scenarios': len(self.scenarios),
+                'units': len(self.units),
+                'units_done': len(done),
+                'units_running': len(locks),
+                'units_pending': len(self.units) - len(done) - len(locks),
+                'steps': total,
+                'steps_done': steps_done,
+                'workers': len(workers | running_workers - {None}),
+                'workers_running': len(running_workers - {None}),
+                'steps_per_s': steps_per_s,
+                'steps_per_s_per_worker': per_worker,
+                'eta_s': eta,
+                'time': now}
+
+    def report(self):
+        """One line of progress for logs."""
+        status = self.status()
+        line = (f"{status['units_done']}/{status['units']} units done, "
+                f"{status['units_running']} running; "
+                f"{status['steps_done']}/{status['steps']} steps")
+        if status['steps_per_s'] is not None:
+            line += (f"; {status['steps_per_s']:.1f} steps/s; "
+                     f"ETA {datetime.timedelta(seconds=round(status['eta_s']))}")
+        return line
+
+    def remove_queue(self):
+        """Remove the queue, e.g. to rerun all units of the sweep."""
+        shutil.rmtree(self.sweep_dir + 'queue/')
+        os.makedirs(self.sweep_dir + LOCK_DIR)
+        os.makedirs(self.sweep_dir + DONE_DIR)
+
+def _import_func(spec):
+    module_name, func_name = spec.split(':')
+    return getattr(importlib.import_module(module_name), func_name)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Join a sweep as a worker, or report its progress.')
+    parser.add_argument('sweep_dir')
+    parser.add_argument('--step', help='simulation step function as '
+                                       'module:function')
+    parser.add_argument('--status', action='store_true',
+                        help='print the progress and exit')
+    parser.add_argument('--max-units', type=int, default=None)
+    parser.add_argument('--lock-timeout', type=float, default=600.)
+    parser.add_argument('--heartbeat', type=float, default=30.)
+    parser.add_argument('--poll', type=float, default=None)
+    args = parser.parse_args()
+
+    scheduler = SweepScheduler(args.sweep_dir)
+    if args.status or args.step is None:
+        print(scheduler.report())
+    else:
+        n_units = scheduler.run_worker(_import_func(args.step),
+                                       max_units=args.max_units,
+                                       lock_timeout=args.lock_timeout,
+                                       heartbeat=args.heartbeat,
+                                       poll=args.poll)
+        scheduler.merge_all(args.lock_timeout, args.heartbeat)
+        print(f'{n_units} units run; {scheduler.report()}')
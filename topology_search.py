@@ -0,0 +1,291 @@
+from collections import namedtuple
+from itertools import combinations, product
+
+import numpy as np
+import pandas as pd
+
+from metrics import MetricEngine
+from sensitivities import DCSensitivities, TopologyUpdate, IslandingError
+
+__all__ = ['Topology',
+           'bus_splits',
+           'ring_symmetries',
+           'enumerate_topologies',
+           'TopologySearch']
+
+# Line cuts as sorted line labels, splits as sorted (bus, moved lines) pairs
+Topology = namedtuple('Topology', ['cuts', 'splits'])
+
+def _bus_lines(net, bus):
+    line = net.line[net.line['in_service'].values.astype(bool)]
+    connected = (line['from_bus'] == bus) | (line['to_bus'] == bus)
+    return tuple(line.index[connected.values])
+
+def bus_splits(net, bus, min_lines=2):
+    """All ways to split the lines at a bus over two busbars.
+
+    Every bipartition is returned once, as the tuple of lines moved to
+    the new busbar; the line with the lowest label stays on the original
+    busbar together with all loads and generators.
+    """
+    lines = _bus_lines(net, bus)
+    splits = []
+    for k in range(min_lines, len(lines) - min_lines + 1):
+        for moved in combinations(lines[1:], k):
+            splits.append(moved)
+    return splits
+
+def ring_symmetries(net):
+    """Symmetries of the ring layout as bus and line relabelings.
+
+    The rotations and reflections of the square are applied to the bus
+    coordinates; a transformation is a symmetry if it maps every bus onto
+    a bus of the same zone and every line onto a line with the same
+    parameters. The identity is always included.
+
+    Returns
+    -------
+    symmetries : list of (dict, dict)
+        Pairs of bus label and line label mappings.
+    """
+    identity = ({b: b for b in net.bus.index}, {l: l for l in net.line.index})
+    if 'bus_geodata' not in net or len(net.bus_geodata.index) == 0:
+        return [identity]
+
+    geo = net.bus_geodata.loc[net.bus.index, ['x', 'y']].values
+    scale = np.abs(geo).max() or 1.
+    keys = {(round(x/scale, 6), round(y/scale, 6), zone): b
+            for ((x, y), zone, b) in zip(geo, net.bus['zone'], net.bus.index)}
+    params = ['r_ohm_per_km', 'x_ohm_per_km', 'max_i_ka', 'length_km']
+    line_keys = {(frozenset((f, t)),
+                  tuple(row)): l
+                 for (l, f, t, row) in zip(net.line.index,
+                                           net.line['from_bus'],
+                                           net.line['to_bus'],
+                                           net.line[params].values)}
+
+    transforms = [lambda x, y: (x, y), lambda x, y: (-y, x),
+                  lambda x, y: (-x, -y), lambda x, y: (y, -x),
+                  lambda x, y: (x, -y), lambda x, y: (-x, y),
+                  lambda x, y: (y, x), lambda x, y: (-y, -x)]
+    symmetries = [identity]
+    for transform in transforms[1:]:
+        bus_map = {}
+        for ((x, y), zone, b) in zip(geo, net.bus['zone'], net.bus.index):
+            tx, ty = transform(x/scale, y/scale)
+            key = (round(tx, 6), round(ty, 6), zone)
+            if key not in keys:
+                break
+            bus_map[b] = keys[key]
+        else:
+            line_map = {}
+            for ((f, t), row), l in line_keys.items():
+                key = (frozenset(bus_map[b] for b in (f, t)), row)
+                if key not in line_keys:
+                    break
+                line_map[l] = line_keys[key]
+            else:
+                symmetries.append((bus_map, line_map))
+    return symmetries
+
+def _canonical(topology, symmetries):
+    forms = []
+    for (bus_map, line_map) in symmetries:
+        cuts = tuple(sorted(line_map[l] for l in topology.cuts))
+        splits = tuple(sorted((bus_map[b], tuple(sorted(line_map[l]
+                                                        for l in moved)))
+                              for (b, moved) in topology.splits))
+        forms.append((cuts, splits))
+    return min(forms)
+
+def enumerate_topologies(net, max_line_cuts=1, max_node_splits=1,
+                         split_buses=None, min_lines=2, deduplicate=False):
+    """Enumerate candidate topologies of line cuts and bus splits.
+
+    Parameters
+    ----------
+    net : pandapowerNet
+        Network object from `create_toy_model`.
+    max_line_cuts : int
+        Maximum number of lines out of service at once.
+    max_node_splits : int
+        Maximum number of buses split at once.
+    split_buses : list, optional
+        Labels of buses that may be split. The default is the central
+        substations, the buses of the center zone.
+    min_lines : int
+        Minimum number of lines on each busbar of a split bus.
+    deduplicate : bool
+        Keep only one candidate of each class that is equivalent under
+        the ring symmetries. Results are then only exact for injections
+        that share the symmetry, so this is off by default.
+
+    Returns
+    -------
+    topologies : list of Topology
+        Candidates, starting with the unchanged topology.
+    """
+    if split_buses is None:
+        split_buses = net.bus.index[net.bus['zone'] == 'center']
+    lines = net.line.index[net.line['in_service'].values.astype(bool)]
+
+    cut_sets = [cuts for k in range(max_line_cuts + 1)
+                for cuts in combinations(lines, k)]
+    split_options = {bus: bus_splits(net, bus, min_lines)
+                     for bus in split_buses}
+    split_sets = []
+    for k in range(max_node_splits + 1):
+        for buses in combinations(split_buses, k):
+            for moved in product(*(split_options[bus] for bus in buses)):
+                split_sets.append(tuple(zip(buses, moved)))
+
+    topologies = []
+    for (cuts, splits) in product(cut_sets, split_sets):
+
+        # Cutting a moved line equals a split with fewer lines
+        moved = {l for (_, lines) in splits for l in lines}
+        if moved.intersection(cuts):
+            continue
+        topologies.append(Topology(tuple(cuts), tuple(splits)))
+
+    if deduplicate:
+        symmetries = ring_symmetries(net)
+        seen = set()
+        unique = []
+        for topology in topologies:
+            form = _canonical(topology, symmetries)
+            if form not in seen:
+                seen.add(form)
+                unique.append(topology)
+        topologies = unique
+
+    return topologies
+
+class TopologySearch:
+    """Searches the best topology per step for each metric.
+
+    Candidate topologies are scored with the DC power flow. Flows of every
+    candidate are obtained from the base topology by low-rank updates
+    (see `sensitivities.TopologyUpdate`), so a step costs one base solve
+    plus a small correction per candidate instead of a full power flow.
+    Candidates that would island buses are dropped.
+
+    Parameters
+    ----------
+    net : pandapowerNet
+        Network object from `create_toy_model`.
+    metrics : list
+        Output of `metrics.create_metrics`. All metrics are minimized.
+    topologies : list of Topology, optional
+        Candidates to score. The default is `enumerate_topologies(net,
+        **enum_kwargs)`.
+    """
+
+    def __init__(self, net, metrics, topologies=None, **enum_kwargs):
+        self.net = net
+        self.sens = DCSensitivities(net)
+        self.engine = MetricEngine(net, metrics)
+        if topologies is None:
+            topologies = enumerate_topologies(net, **enum_kwargs)
+
+        self.topologies = []
+        self.updates = []
+        self.islanding = []
+        for topology in topologies:
+            try:
+                update = TopologyUpdate(self.sens, topology.cuts,
+                                        topology.splits)
+            except IslandingError:
+                self.islanding.append(topology)
+                continue
+            self.topologies.append(topology)
+            self.updates.append(update)
+
+        # Line states, cuts and splits per candidate
+        in_service = net.line['in_service'].values.astype(bool)
+        self.in_service = np.array([in_service & ~update.cut
+                                    for update in self.updates])
+        self.line_cuts = np.array([len(t.cuts) for t in self.topologies])
+        self.node_split = np.array([len(t.splits) for t in self.topologies])
+
+    def evaluate(self, p_bus):
+        """Metric values of all candidates.
+
+        Parameters
+        ----------
+        p_bus : ndarray
+            Active power bus injections in MW, shape (steps, buses).
+
+        Returns
+        -------
+        values : ndarray
+            Array of shape (steps, candidates, metrics).
+        """
+        theta = self.sens.base_angles(p_bus)
+        p_line = np.stack([update.flows(theta) for update in self.updates],
+                          axis=1)
+        n_steps, n_candidates, n_lines = p_line.shape
+        res = self.sens.line_results(p_line.reshape(-1, n_lines))
+        in_service = np.broadcast_to(self.in_service[None],
+                                     p_line.shape).reshape(-1, n_lines)
+        values = self.engine.evaluate_batch(res, in_service)
+        return values.reshape(n_steps, n_candidates, -1)
+
+    def best(self, values, index=None):
+        """Result frame of the base and the best topology per metric.
+
+        Columns are named as expected by `plotting.compare_to_main`: the
+        metrics of the unchanged topology, and for every metric used for
+        selection `{metric}_best_{topo_metric}`, `line_cuts_best_...`,
+        `node_split_best_...` and `topology_best_...`, the position of the
+        best candidate in `topologies`.
+        """
+        names = self.engine.names
+        steps = np.arange(len(values))
+        columns = {name: values[:, 0, m] for (m, name) in enumerate(names)}
+        for (j, topo_metric) in enumerate(names):
+            score = np.where(np.isnan(values[:, :, j]), np.inf,
+                             values[:, :, j])
+            best = score.argmin(axis=1)
+            for (m, name) in enumerate(names):
+                columns[f'{name}_best_{topo_metric}'] = values[steps, best, m]
+            columns[f'line_cuts_best_{topo_metric}'] = self.line_cuts[best]
+            columns[f'node_split_best_{topo_metric}'] = self.node_split[best]
+            columns[f'topology_best_{topo_metric}'] = best
+        return pd.DataFrame(columns, index=index)
+
+    def search(self, eq_frame_dict, steps=None, chunk_size=1000):
+        """Best topologies for every step of a set of input frames.
+
+        Parameters
+        ----------
+        eq_frame_dict : dict
+            Maps (element, quantity) to an input frame.
+        steps : range, optional
+            Steps to search. The default is all rows of the inputs.
+        chunk_size : int
+            Number of steps scored at once.
+
+        Returns
+        -------
+        res_frame : DataFrame
+            See `best`.
+        """
+        if steps is None:
+            steps = next(iter(eq_frame_dict.values())).index
+        frames = []
+        for start in range(0, len(steps), chunk_size):
+            chunk = steps[start:start + chunk_size]
+            values = self.sens.model.element_frames(eq_frame_dict, chunk)
+            p_bus = self.sens.bus_injections(values)
+            frames.append(self.best(self.evaluate(p_bus), index=chunk))
+        return pd.concat(frames)
+
+    def simulation_step(self, net, metrics=None):
+        """Step function for `run_simulations` using the current tables."""
+        values = {('load', 'p_mw'): net.load['p_mw'].values[None],
+                  ('load', 'q_mvar'): net.load['q_mvar'].values[None],
+                  ('gen', 'p_mw'): net.gen['p_mw'].values[None],
+                  ('gen', 'vm_pu'): net.gen['vm_pu'].values[None]}
+        p_bus = self.sens.bus_injections(values)
+        return self.best(self.evaluate(p_bus)).iloc[0]